@@ -1,6 +1,10 @@
 from django.contrib import admin
 
 from ai.models import AIResource
+from ai.models import AIGenerationJob
+from ai.models import AISemanticCacheEntry
+from ai.models import AIEmbedding
+from ai.models import TicketConversationSummary
 from ai.models import AITemporalComment
 
 
@@ -12,3 +16,28 @@ class AIResourceAdmin(admin.ModelAdmin):
 @admin.register(AITemporalComment)
 class AITemporalCommentAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(AIGenerationJob)
+class AIGenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('ticket', 'comment', 'status', 'attempts', 'run_after', 'heartbeat_at')
+    list_filter = ('status',)
+
+
+@admin.register(AISemanticCacheEntry)
+class AISemanticCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('question', 'app', 'hits', 'created_at')
+    list_filter = ('app',)
+    exclude = ('embedding',)
+
+
+@admin.register(TicketConversationSummary)
+class TicketConversationSummaryAdmin(admin.ModelAdmin):
+    list_display = ('ticket', 'summarized_messages', 'updated_at')
+
+
+@admin.register(AIEmbedding)
+class AIEmbeddingAdmin(admin.ModelAdmin):
+    list_display = ('text_hash', 'embedding_model', 'created_at')
+    list_filter = ('embedding_model',)
+    exclude = ('vector',)
@@ -0,0 +1,61 @@
+"""
+    pytest-benchmark counterpart of the benchmark_rag command, to compare the runs with `--benchmark-compare`:
+
+    pytest -p pytest_django --ds=cusupalm.settings ai/benchmarks.py --benchmark-autosave
+
+    Each scenario is timed end to end by pytest-benchmark, the p50/p95/p99 of its stages are saved in its extra info
+"""
+import random
+import tempfile
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('pytest_django')
+
+from ai.management.commands.benchmark_rag import STAGES
+from ai.management.commands.benchmark_rag import Command
+from ai.management.commands.benchmark_rag import FakeChatModel
+from ai.management.commands.benchmark_rag import stand_ins
+from ai.management.commands.benchmark_rag import percentile
+from ai.vectorizers.numpy_index import NumpyVectorClient
+
+ROUNDS = 10
+
+
+@pytest.fixture(params=(False, True), ids=('blocking', 'streaming'))
+def command(request, transactional_db):
+    """
+        Benchmark command seeded with the knowledge base and the users, the notifications are only queued once the
+        transaction is committed, hence the transactional database
+    """
+    command = Command()
+    command.rng = random.Random(42)
+    model = FakeChatModel(latency=0.2, token_latency=0.01, tokens=50, streaming=request.param)
+    vector_db_client = NumpyVectorClient(path=tempfile.mkdtemp(prefix='benchmark_rag_'))
+
+    with stand_ins(model, vector_db_client):
+        command.seed(vector_db_client, documents=200, agents=5)
+        yield command
+
+
+@pytest.mark.parametrize('thread_length', (0, 5, 20))
+@pytest.mark.parametrize('ticket_size', (200, 2000, 8000))
+def test_generation(benchmark, command, ticket_size, thread_length):
+    durations = {}
+
+    def generate():
+        for stage, values in command.generate(ticket_size, thread_length).items():
+            durations.setdefault(stage, []).append(sum(values))
+
+    benchmark.pedantic(generate, rounds=ROUNDS, warmup_rounds=1)
+
+    assert len(durations['total']) == ROUNDS + 1
+    benchmark.extra_info['stages'] = {
+        stage: {
+            'p50': round(percentile(durations[stage][1:], 50) * 1000, 3),
+            'p95': round(percentile(durations[stage][1:], 95) * 1000, 3),
+            'p99': round(percentile(durations[stage][1:], 99) * 1000, 3),
+        }
+        for stage in STAGES if stage in durations
+    }
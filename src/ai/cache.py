@@ -0,0 +1,206 @@
+######################################################################################################
+#    Caches used to answer a ticket or a comment without calling the LLM                            #
+######################################################################################################
+
+from __future__ import annotations
+
+import re
+import json
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from django.db.models import F
+from django.core.cache import caches
+
+from decouple import config
+
+from ai.utils import strip_html
+from ai.vectorizers.embeddings import DEFAULT_EMBEDDING_MODEL
+from ai.vectorizers.embeddings import query_embedding_cache
+
+
+class SemanticAnswerCache:
+    """
+        Answer a question with the validated answer of a similar question asked on the same app.
+        The questions embeddings are kept in memory, one matrix per app, and synchronized incrementally with the
+        AISemanticCacheEntry table so that the entries stored by the other processes are also used.
+    """
+
+    def __init__(self, threshold: float = None, enabled: bool = None, model_name: str = None):
+        self.logger = logging.getLogger('llm')
+        self.threshold = threshold or config('SEMANTIC_CACHE_THRESHOLD', default=0.92, cast=float)
+        self.enabled = enabled if enabled is not None else config('SEMANTIC_CACHE_ENABLED', default=True, cast=bool)
+        self.model_name = model_name or DEFAULT_EMBEDDING_MODEL
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, question: str) -> np.ndarray:
+        embedding = query_embedding_cache.embed([strip_html(question)], self.model_name)[0]
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+
+        return embedding / norm if norm else embedding
+
+    def lookup(self, question: str, app: str) -> tuple[object | None, float | None]:
+        """
+            :return: The closest cache entry if its similarity reaches the threshold (None otherwise) and the
+             similarity of the closest question, None if the cache is empty
+        """
+        from ai.models import AISemanticCacheEntry
+
+        if not self.enabled:
+            return None, None
+
+        ids, matrix = self._sync(app)
+        if not ids:
+            self._count(hit=False)
+            return None, None
+
+        similarities = matrix @ self.embed(question)
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+
+        if similarity < self.threshold:
+            self._count(hit=False)
+            self.logger.info(f'Semantic cache miss on {app}, best similarity {similarity:.4f}')
+            return None, similarity
+
+        entry = AISemanticCacheEntry.objects.filter(id=ids[best]).first()
+        if entry is None:
+            # Deleted by another process meanwhile
+            self.reset(app)
+            self._count(hit=False)
+            return None, similarity
+
+        AISemanticCacheEntry.objects.filter(id=entry.id).update(hits=F('hits') + 1)
+        self._count(hit=True)
+        self.logger.info(f'Semantic cache hit on {app}: entry #{entry.id}, similarity {similarity:.4f}')
+
+        return entry, similarity
+
+    def store(self, question: str, answer: str, app: str, proposal=None) -> object | None:
+        from ai.models import AISemanticCacheEntry
+
+        if not self.enabled:
+            return None
+
+        return AISemanticCacheEntry.objects.create(
+            app=app,
+            question=question,
+            answer=answer,
+            embedding=self.embed(question).tobytes(),
+            embedding_model=self.model_name,
+            proposal=proposal
+        )
+
+    def reset(self, app: str = None) -> None:
+        with self._lock:
+            if app is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(app, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': {app: len(index['ids']) for app, index in self._indexes.items()},
+            }
+
+    def _sync(self, app: str) -> tuple[list, np.ndarray]:
+        """
+            Append to the in-memory index of the app the entries created since the last lookup
+        """
+        from ai.models import AISemanticCacheEntry
+
+        with self._lock:
+            index = self._indexes.setdefault(app, {'ids': [], 'matrix': None, 'last_id': 0})
+
+            rows = list(
+                AISemanticCacheEntry.objects.filter(app=app, embedding_model=self.model_name, id__gt=index['last_id'])
+                .order_by('id').values_list('id', 'embedding')
+            )
+            if rows:
+                vectors = np.stack([np.frombuffer(bytes(embedding), dtype=np.float32) for _, embedding in rows])
+                index['matrix'] = vectors if index['matrix'] is None else np.vstack([index['matrix'], vectors])
+                index['ids'].extend(entry_id for entry_id, _ in rows)
+                index['last_id'] = rows[-1][0]
+
+            return index['ids'], index['matrix']
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+semantic_cache = SemanticAnswerCache()
+
+
+class GenerationCache:
+    """
+        Deterministic cache of the generated answers (the temperature of the model is 0.0), keyed by a hash of the
+        normalized question, the ids of the retrieved documents, the history and the model configuration.
+        It's stored in the `GENERATION_CACHE_ALIAS` Django cache, which bounds the number of entries and evicts the
+        least recently used ones. Each app has a version stamp in the database (a CacheVersion), bumped by any process
+        which ingests, updates or deletes its AIResource documents, which invalidates all the entries generated from
+        them in the caches of every process.
+    """
+
+    def __init__(self, alias: str = None, timeout: int = None):
+        self.logger = logging.getLogger('llm')
+        self.alias = alias or config('GENERATION_CACHE_ALIAS', default='generation')
+        self.timeout = timeout or config('GENERATION_CACHE_TIMEOUT', default=86400, cast=int)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, app: str, question: str, results: dict, history: list, model_signature: str) -> str:
+        question = re.sub(r'\s+', ' ', strip_html(question)).strip().lower()
+        context_ids = [document_id for ids in results.get('ids') or [] for document_id in ids]
+        history_digest = hashlib.sha256(
+            '\x1f'.join(f'{message.type}:{message.content}' for message in history).encode()
+        ).hexdigest()
+
+        payload = json.dumps([app, self.version(app), question, context_ids, history_digest, model_signature])
+
+        return f'generation:{hashlib.sha256(payload.encode()).hexdigest()}'
+
+    def get(self, key: str) -> str | None:
+        answer = self.cache.get(key)
+        if answer is not None:
+            self.logger.info(f'Generation cache hit {key}')
+
+        return answer
+
+    def set(self, key: str, answer: str) -> None:
+        self.cache.set(key, answer, timeout=self.timeout)
+
+    @staticmethod
+    def version_name(app: str) -> str:
+        return f'generation:{app}'
+
+    def version(self, app: str) -> int:
+        from core.models import CacheVersion
+
+        return CacheVersion.get(self.version_name(app))
+
+    def invalidate(self, app: str) -> None:
+        from core.models import CacheVersion
+
+        CacheVersion.bump(self.version_name(app))
+
+
+generation_cache = GenerationCache()
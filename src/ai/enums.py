@@ -17,3 +17,8 @@ class DataSourceType(CustomEnum):
     APP_TUTORIAL = 'TUTORIAL'
 
 
+class JobStatus(CustomEnum):
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
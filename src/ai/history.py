@@ -0,0 +1,195 @@
+######################################################################################################
+#    Conversation history of the tickets, in the langchain format used by the RAG chain             #
+######################################################################################################
+
+from __future__ import annotations
+
+import math
+import hashlib
+import logging
+
+from django.db.models import Q
+from django.db.models import Max
+from django.db.models import Count
+from django.core.cache import cache
+
+from decouple import config
+
+from langchain_core.messages import AIMessage
+from langchain_core.messages import BaseMessage
+from langchain_core.messages import HumanMessage
+from langchain_core.messages import SystemMessage
+
+from ai.utils import strip_html
+
+
+class TicketHistoryLoader:
+    """
+        Load the conversation of a ticket: its description, then each comment, as an AIMessage when it's written by an
+        agent, as a HumanMessage otherwise. The messages are plain text, without the CKEditor HTML.
+        The converted messages are cached per ticket. Next loads only fetch the comments created since, in a single
+        query, and append them.
+        The cache may be local to the process while the messages are edited by another one, so each load checks a
+        marker read from the database along with the description: the count and the last update of the comments
+        already converted. When an existing message changed, the history is converted again.
+    """
+
+    def __init__(self, timeout: int = None):
+        self.logger = logging.getLogger('llm')
+        self.timeout = timeout or config('HISTORY_CACHE_TIMEOUT', default=3600, cast=int)
+
+    @staticmethod
+    def cache_key(ticket_id: int) -> str:
+        return f'ticket-history:{ticket_id}'
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256((text or '').encode()).hexdigest()
+
+    def load(self, ticket_id: int) -> list[BaseMessage]:
+        from core.models import Ticket
+        from core.models import Comment
+
+        history = cache.get(self.cache_key(ticket_id))
+        last_comment_id = history['last_comment_id'] if history is not None else 0
+
+        converted = Q(comments__id__lte=last_comment_id)
+        description, comments_count, comments_updated_at = (
+            Ticket.objects.filter(id=ticket_id)
+            .annotate(converted_count=Count('comments', filter=converted),
+                      converted_updated_at=Max('comments__updated_at', filter=converted))
+            .values_list('description', 'converted_count', 'converted_updated_at')
+            .get()
+        )
+
+        is_cached = history is not None and history.get('marker') == (
+            self.digest(description), comments_count, comments_updated_at
+        )
+        if not is_cached:
+            if history is not None:
+                self.logger.info(f'History of ticket #{ticket_id} changed since it was cached')
+            history = {
+                'messages': [HumanMessage(content=strip_html(description))],
+                'marker': (self.digest(description), 0, None),
+                'last_comment_id': 0,
+            }
+
+        comments = list(
+            Comment.objects.filter(ticket_id=ticket_id, id__gt=history['last_comment_id'])
+            .select_related('created_by')
+            .only('id', 'content', 'created_at', 'updated_at', 'created_by__is_staff')
+            .order_by('created_at', 'id')
+        )
+        if comments or not is_cached:
+            history['messages'] = history['messages'] + [
+                AIMessage(content=strip_html(comment.content)) if comment.created_by.is_staff
+                else HumanMessage(content=strip_html(comment.content))
+                for comment in comments
+            ]
+            history['last_comment_id'] = max([history['last_comment_id']] + [comment.id for comment in comments])
+
+            description_digest, count, updated_at = history['marker']
+            updates = [updated_at] if updated_at is not None else []
+            history['marker'] = (description_digest, count + len(comments),
+                                 max(updates + [comment.updated_at for comment in comments], default=None))
+            cache.set(self.cache_key(ticket_id), history, timeout=self.timeout)
+
+        self.logger.info(f'History of ticket #{ticket_id} loaded: {len(history["messages"])} messages, '
+                         f'{len(comments)} new')
+
+        return list(history['messages'])
+
+    def invalidate(self, ticket_id: int) -> None:
+        cache.delete(self.cache_key(ticket_id))
+
+
+history_loader = TicketHistoryLoader()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+        Estimation of the number of tokens of a text, about 4 characters per token for the usual models
+    """
+    return math.ceil(len(text or '') / 4)
+
+
+def count_tokens(messages: list[BaseMessage]) -> int:
+    return sum(estimate_tokens(message.content) for message in messages)
+
+
+def digest_messages(messages: list[BaseMessage]) -> str:
+    """
+        sha256 of the roles and contents of the messages, changes when one of them is edited or removed
+    """
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(f'{message.type}\x1f{message.content}\x1e'.encode())
+
+    return digest.hexdigest()
+
+
+class HistoryWindowPolicy:
+    """
+        Bound the history sent to the model to `token_budget` tokens. The most recent messages are kept verbatim
+        and the older ones are folded into a rolling summary, persisted per
+        ticket and regenerated only when new messages fall out of the window.
+    """
+
+    def __init__(self, summarizer: callable, token_budget: int = None, summary_tokens: int = None):
+        """
+            :param summarizer: function(previous summary, messages to fold) -> new summary
+        """
+        self.logger = logging.getLogger('llm')
+        self.summarizer = summarizer
+        self.token_budget = token_budget or config('HISTORY_TOKEN_BUDGET', default=1500, cast=int)
+        # Part of the budget kept for the summary
+        self.summary_tokens = summary_tokens or config('HISTORY_SUMMARY_TOKENS', default=300, cast=int)
+
+    def apply(self, ticket_id: int, messages: list[BaseMessage]) -> list[BaseMessage]:
+        if count_tokens(messages) <= self.token_budget:
+            return messages
+
+        # Keep the most recent messages which fit in the budget, at least the last one
+        budget = self.token_budget - self.summary_tokens
+        kept, used = 0, 0
+        for message in reversed(messages):
+            tokens = estimate_tokens(message.content)
+            if kept and used + tokens > budget:
+                break
+            kept += 1
+            used += tokens
+
+        cutoff = len(messages) - kept
+        summary = self.get_summary(ticket_id, messages[:cutoff])
+
+        return [SystemMessage(content=summary)] + messages[cutoff:]
+
+    def get_summary(self, ticket_id: int, messages: list[BaseMessage]) -> str:
+        from ai.models import TicketConversationSummary
+
+        summary, _ = TicketConversationSummary.objects.get_or_create(ticket_id=ticket_id)
+        digest = digest_messages(messages)
+        if summary.summarized_messages == len(messages) and summary.summarized_digest == digest:
+            return summary.summary
+
+        if 0 < summary.summarized_messages < len(messages) and \
+                summary.summarized_digest == digest_messages(messages[:summary.summarized_messages]):
+            # Only fold the messages which fell out of the window since the last summary
+            previous, new_messages = summary.summary, messages[summary.summarized_messages:]
+        else:
+            # Messages summarized before were edited or removed, summarize the conversation again
+            previous, new_messages = '', messages
+
+        self.logger.info(f'Summarizing {len(new_messages)} messages of ticket #{ticket_id}')
+        summary.summary = self.summarizer(previous, new_messages)
+        summary.summarized_messages = len(messages)
+        summary.summarized_digest = digest
+        summary.save(update_fields=['summary', 'summarized_messages', 'summarized_digest'])
+
+        return summary.summary
+
+
+def format_history(messages: list[BaseMessage]) -> str:
+    roles = {'human': 'Customer', 'ai': 'Agent', 'system': 'Summary of the earlier conversation'}
+
+    return '\n'.join(f'{roles.get(message.type, message.type)}: {message.content}' for message in messages)
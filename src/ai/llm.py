@@ -1,8 +1,15 @@
 from __future__ import annotations
 
 import os
+import json
+import time
 import logging
+import threading
+from uuid import UUID
+from typing import Iterator
+from operator import itemgetter
 
+from django.db import transaction
 from django.contrib.auth import get_user_model
 
 from chromadb.config import Settings
@@ -11,20 +18,33 @@ from langchain_chroma import Chroma
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables import RunnableBranch
+from langchain_core.runnables import RunnableParallel
+from langchain_core.language_models import BaseChatModel
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.chat_models import ChatOllama
 from langchain.prompts import PromptTemplate
 from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.messages import AIMessage
-from langchain_core.messages import HumanMessage
 from sympy.physics.units import temperature
 
 from traceback_with_variables import format_exc
 
-from core.models import Ticket
+from core.instrumentation import span
+from core.instrumentation import record
 
-from ai.vectorizers.chroma import ChromaClient
+from ai.cache import semantic_cache
+from ai.cache import generation_cache
+from ai.utils import strip_html
+
+from ai.history import count_tokens
+from ai.history import format_history
+from ai.history import history_loader
+from ai.history import estimate_tokens
+from ai.history import HistoryWindowPolicy
+from ai.retrievers.hybrid import HybridSearcher
+from ai.vectorizers.factory import load_vector_db_client
 
 from decouple import config
 
@@ -38,6 +58,9 @@ logger = logging.getLogger('llm')
 # Lower temperature will make the model more deterministic
 llm = ChatOllama(model_name=config('OLLAMA_MODEL'), temperature=0.0)
 
+# hybrid (BM25 and vector search fused) or vector
+RETRIEVAL_MODE = config('RAG_RETRIEVAL_MODE', default='hybrid').lower()
+
 
 def get_session_history(session_id: int) -> ChatMessageHistory:
     """
@@ -47,21 +70,219 @@ def get_session_history(session_id: int) -> ChatMessageHistory:
         :return: The history of the ticket in Langchain format, usable by any ChatLLM
     """
     logger.info(f'Getting session history for ticket #{session_id}')
-    ticket = Ticket.objects.get(id=session_id)
-    history = ticket.get_history()
+    with span('history_load'):
+        messages = history_loader.load(session_id)
+        window = history_policy.apply(session_id, messages)
+    logger.info(f'History of ticket #{session_id}: {count_tokens(messages)} tokens, '
+                f'{count_tokens(window)} tokens sent to the model')
 
-    logger.info(f'History extracted: {history}')
+    # A new ChatMessageHistory each time, the chain appends the new messages to it
+    chat_history = ChatMessageHistory(messages=window)
 
-    chat_history = ChatMessageHistory()
-    chat_history.add_message(HumanMessage(content=history["initial_message"]))
+    return chat_history
 
-    for message in history["thread"]:
-        role = message["role"]
-        content = message["text"]
-        message = AIMessage(content=content) if role == 'agent' else HumanMessage(content=content)
-        chat_history.add_message(message)
 
-    return chat_history
+PROMPT = PromptTemplate.from_template(
+    """
+    You are an assistant for a support system. You should use the retrieved context to answer the tickets of users 
+    if necessary; if not, simply answer the question. If you don't know the answer, just say so. Please provide 
+    your response in a professional email format. Always keep the response as short as possible, three sentences 
+    maximum. They can exceed only if it's relevant for the answer.
+    Conversation: {history}
+    Question: {question}
+    Context: {context}
+    Answer:
+    """
+)
+
+SUMMARY_PROMPT = PromptTemplate.from_template(
+    """
+    You are summarizing a support ticket conversation between a customer and the support agents. Update the current
+    summary with the new messages. Keep the facts needed to answer the customer: the problem, the product names, the
+    error codes, what was already tried and what was answered. Answer with the summary only, in a few sentences.
+    Current summary: {summary}
+    New messages:
+    {messages}
+    Summary:
+    """
+)
+
+
+def summarize_conversation(summary: str, messages: list) -> str:
+    return (SUMMARY_PROMPT | llm | StrOutputParser()).invoke({
+        'summary': summary or 'None',
+        'messages': format_history(messages)
+    })
+
+
+history_policy = HistoryWindowPolicy(summarizer=summarize_conversation)
+
+# Compiled chains, one per app and model configuration
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+def format_docs(docs):
+    return '\n\n'.join([doc[0]['description'] for doc in docs['metadatas']])
+
+
+def format_conversation(history: list, question: str) -> str:
+    # The last message is usually the ticket or the comment which is answered, it's already given as question
+    if history and history[-1].content in strip_html(question):
+        history = history[:-1]
+
+    return format_history(history)
+
+
+def log_prompt(prompt):
+    logger.info(f'Prompt sent to the model: {estimate_tokens(prompt.to_string())} tokens')
+
+    return prompt
+
+
+def assemble_prompt(x: dict):
+    with span('prompt_assembly'):
+        return log_prompt(PROMPT.invoke({
+            'question': x['question'],
+            'context': format_docs(x['results']),
+            'history': format_conversation(x['history'], x['question'])
+        }))
+
+
+class GenerationTimer(BaseCallbackHandler):
+    """
+        Record the `generation` span of the model calls, and the `first_token` one when the answer is streamed
+    """
+
+    def __init__(self):
+        self._started_at = {}
+        self._streaming = set()
+
+    def on_llm_start(self, serialized: dict, prompts: list, *, run_id: UUID, **kwargs) -> None:
+        self._started_at[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized: dict, messages: list, *, run_id: UUID, **kwargs) -> None:
+        self._started_at[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs) -> None:
+        if run_id in self._started_at and run_id not in self._streaming:
+            self._streaming.add(run_id)
+            record('first_token', time.perf_counter() - self._started_at[run_id])
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs) -> None:
+        self._finish(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self._finish(run_id, error)
+
+    def _finish(self, run_id: UUID, error: BaseException = None) -> None:
+        self._streaming.discard(run_id)
+        started_at = self._started_at.pop(run_id, None)
+        if started_at is not None:
+            record('generation', time.perf_counter() - started_at, error)
+
+
+generation_timer = GenerationTimer()
+
+
+def get_model_signature(model: BaseChatModel) -> str:
+    """
+        Identify a chat model by its class and parameters (model name, temperature, ...), used as chain cache key
+    """
+    return json.dumps({'class': model.__class__.__name__, **model._identifying_params}, sort_keys=True, default=str)
+
+
+def get_rag_chain(app_name: str, model: BaseChatModel = None) -> RunnableWithMessageHistory:
+    """
+        Build the RAG chain of an app once and reuse it for every generation.
+        The chain takes {'input': question} and returns {'question', 'results', 'answer', ...}: the vectorstore is
+        queried exactly once per generation and its results are passed through to the caller. The answer comes from the
+        generation cache when the same question was already answered with the same context, history and model.
+        :param app_name: The name of the app, used to build the collection name in the vectorstore
+        :param model: The chat model to use, the default Ollama model if not set
+    """
+    model = model or llm
+    key = (app_name, get_model_signature(model))
+
+    chain = _chains.get(key)
+    if chain is not None:
+        return chain
+
+    with _chains_lock:
+        chain = _chains.get(key)
+        if chain is not None:
+            return chain
+
+        # TODO: Initially wanted to use my Chroma vectorstore as retriever, but not working as wanted, we will later,
+        #  so I did it manually. I think it's due to some issue with some deprecated packages: Langchain chroma
+        # Technical debt 😁
+
+        # huggingface_embedding = HuggingFaceEmbeddings(
+        #     model_name='paraphrase-multilingual-MiniLM-L12-v2',
+        #     model_kwargs={'device': 'cpu'},
+        #     encode_kwargs={'normalize_embeddings': False}
+        # )
+
+        # Chroma client settings
+        # chroma_settings = Settings()
+        # chroma_settings.chroma_server_host = config('CHROMA_HOST')
+        # chroma_settings.chroma_server_http_port = config('CHROMA_PORT')
+        # logger.info(f"Loading vectorstore collection {f'{app_name}_COLLECTION'}")
+        # vectorstore = Chroma(
+        #     client_settings=chroma_settings,
+        #     embedding_function=huggingface_embedding,
+        #     collection_name=f'{app_name}_COLLECTION'
+        # )
+        # retriever = vectorstore.as_retriever(
+        #     search_kwargs={
+        #         'k': 5
+        #     }
+        # )
+
+        # Manual usage as I told earlier
+        vector_db_client = load_vector_db_client()
+        collection_name = f'{app_name}_COLLECTION'
+
+        hybrid_searcher = HybridSearcher(vector_db_client, app_name, collection_name)
+
+        def retrieve(question: str) -> dict:
+            with span('retrieval'):
+                if RETRIEVAL_MODE == 'hybrid':
+                    return hybrid_searcher.query(question, n_results=3)
+                return vector_db_client.query_documents(question, collection_name, metadata_filter={}, n_results=3)
+
+        answer = (
+                RunnableLambda(assemble_prompt)
+                | model.with_config(callbacks=[generation_timer])
+                | StrOutputParser()
+        )
+
+        def cache_key(x: dict) -> str:
+            return generation_cache.make_key(app_name, x['question'], x['results'], x['history'], key[1])
+
+        runnable = (
+                RunnableParallel(question=itemgetter('input'), history=itemgetter('history'),
+                                 results=itemgetter('input') | RunnableLambda(retrieve))
+                | RunnablePassthrough.assign(cache_key=cache_key)
+                | RunnablePassthrough.assign(cached_answer=lambda x: generation_cache.get(x['cache_key']))
+                # The model is only called when the same prompt hasn't been answered yet
+                | RunnablePassthrough.assign(
+                    answer=RunnableBranch((lambda x: x['cached_answer'] is not None, itemgetter('cached_answer')),
+                                          answer)
+                )
+        )
+
+        chain = RunnableWithMessageHistory(
+            runnable,
+            get_session_history,
+            input_messages_key='input',
+            history_messages_key='history',
+            output_messages_key='answer'
+        )
+        _chains[key] = chain
+        logger.info(f'RAG chain compiled for app {app_name}')
+
+    return chain
 
 
 def generate_answer(question: str, ticket_id: int, app_name: str = None):
@@ -70,161 +291,191 @@ def generate_answer(question: str, ticket_id: int, app_name: str = None):
         @history: the thread history of the ticket if exists
         @app_name: The of the app (retrieve most of the time) used, it's also use to build collection name in the vectorstore
     """
+    chain = get_rag_chain(app_name)
 
-    # TODO: Initially wanted to use my Chroma vectorstore as retriever, but not working as wanted, we will later,
-    #  so I did it manually. I think it's due to some issue with some deprecated packages: Langchain chroma
-    # Technical debt 😁
-
-    # huggingface_embedding = HuggingFaceEmbeddings(
-    #     model_name='paraphrase-multilingual-MiniLM-L12-v2',
-    #     model_kwargs={'device': 'cpu'},
-    #     encode_kwargs={'normalize_embeddings': False}
-    # )
-
-    # Chroma client settings
-    # chroma_settings = Settings()
-    # chroma_settings.chroma_server_host = config('CHROMA_HOST')
-    # chroma_settings.chroma_server_http_port = config('CHROMA_PORT')
-    # logger.info(f"Loading vectorstore collection {f'{app_name}_COLLECTION'}")
-    # vectorstore = Chroma(
-    #     client_settings=chroma_settings,
-    #     embedding_function=huggingface_embedding,
-    #     collection_name=f'{app_name}_COLLECTION'
-    # )
-    # retriever = vectorstore.as_retriever(
-    #     search_kwargs={
-    #         'k': 5
-    #     }
-    # )
-
-    # Manual usage as I told earlier
-    chroma_client = ChromaClient()
-    results = chroma_client.query_documents(question, f'{app_name}_COLLECTION', metadata_filter={}, n_results=3)
-    logger.info(f'Results from vectorstore {results}')
-
-    prompt = PromptTemplate.from_template(
-        """
-        You are an assistant for a support system. You should use the retrieved context to answer the tickets of users 
-        if necessary; if not, simply answer the question. If you don't know the answer, just say so. Please provide 
-        your response in a professional email format. Always keep the response as short as possible, three sentences 
-        maximum. They can exceed only if it's relevant for the answer.
-        Question: {question}
-        Context: {context}
-        Answer:
-        """
-    )
-
-    def format_docs(docs):
-        return '\n\n'.join([doc[0]['description'] for doc in docs['metadatas']])
-
-    extract_input = RunnableLambda(lambda x: x['input'])
-    results = RunnableLambda(
-        lambda q: chroma_client.query_documents(q, f'{app_name}_COLLECTION', metadata_filter={}, n_results=3))
-    runnable = (
-            extract_input
-            | {'context': results | format_docs, 'question': RunnablePassthrough()}
-            | prompt
-            | llm
-            | StrOutputParser()
-    )
-
-    runnable_with_history = RunnableWithMessageHistory(
-        runnable,
-        get_session_history,
-        input_messages_key='input',
-        history_messages_key='history'
-    )
-
-    response = runnable_with_history.invoke({
+    output = chain.invoke({
         'input': question
     }, config={'configurable': {'session_id': ticket_id}})
 
-    return response
+    logger.info(f'Results from vectorstore {output["results"]}')
+
+    if output['cached_answer'] is None:
+        generation_cache.set(output['cache_key'], output['answer'])
 
+    return output['answer']
 
-# It's a little bit time-consuming, depending on the speed of the model. You can set it as celery task for example.
-def handling_response_generation(ticket_id: int | None, comment_id: int | None, is_comment: bool = None):
+
+def stream_answer(question: str, ticket_id: int, app_name: str = None) -> Iterator[str]:
     """
-        The aim of this task is to handle all the process of generating the response of the ticket
-        - Generate a response to the ticket
-        - Set as temporal response in AITemporaryComment model
-        - Send mails and notification to the company managers with the proposal response
+        Same as `generate_answer`, but yield the tokens of the answer as soon as the model generates them
+    """
+    chain = get_rag_chain(app_name)
 
-        @ticket_id: the id of the ticket object if it's a ticket object
-        @comment_id: the id of the comment object if it's a comment object
-        @is_comment: True if it's a comment object, False if it's a ticket object
+    output = {}
+    tokens = []
+    for chunk in chain.stream({
+        'input': question
+    }, config={'configurable': {'session_id': ticket_id}}):
+        if 'results' in chunk:
+            logger.info(f'Results from vectorstore {chunk["results"]}')
+        output.update({name: value for name, value in chunk.items() if name != 'answer'})
+        if chunk.get('answer'):
+            tokens.append(chunk['answer'])
+            yield chunk['answer']
+
+    if output.get('cached_answer') is None and output.get('cache_key'):
+        generation_cache.set(output['cache_key'], ''.join(tokens))
+
+
+def propose_answer(question: str, ticket_id: int, app_name: str = None) -> tuple[str, dict]:
+    """
+        Answer with the validated answer of a similar question when the semantic cache has one, generate the answer
+        otherwise.
+        :return: The answer and the cache fields to save on the AITemporalComment
+    """
+    with span('semantic_cache'):
+        entry, similarity = semantic_cache.lookup(question, app_name)
+    if entry is not None:
+        return entry.answer, {'is_cache_derived': True, 'cache_similarity': similarity}
+
+    return generate_answer(question, ticket_id, app_name=app_name), {'cache_similarity': similarity}
+
+
+def get_proposal(ticket_id: int, comment_id: int | None = None):
+    """
+        :return: The proposal already generated for the comment, or for the ticket itself when no comment is given
     """
-    from core.models import Ticket
-    from core.models import Comment
     from ai.models import AITemporalComment
 
-    from core.utils import send_simple_mail
+    if comment_id:
+        proposals = AITemporalComment.objects.filter(comment_id=comment_id)
+    else:
+        proposals = AITemporalComment.objects.filter(ticket_id=ticket_id, comment__isnull=True)
 
-    try:
-        if is_comment:
-            comment = Comment.objects.get(id=comment_id)
-            content = comment.content
+    return proposals.order_by('created_at').first()
 
-            # Generate response
-            # Handle context (history of the message with chat history feature of LLM)
-            response_proposal = generate_answer(content, comment.ticket.id, app_name=comment.ticket.app)
 
-            # Save the temporal response
-            AITemporalComment.objects.create(
-                comment=comment,
-                content=response_proposal,
-                app=comment.ticket.app
-            )
+def save_proposal(proposal, on_saved: callable = None):
+    """
+        Save the generated proposal and queue the notification of the agents, in one transaction, unless a proposal
+        was saved meanwhile for the same ticket or comment: only one is ever saved.
+
+        @proposal: the unsaved AITemporalComment
+        @on_saved: called in the transaction, to complete the generation job with it
+        :return: The proposal saved, the one saved before if any
+    """
+    from core.models import Ticket
+    from core.models import Comment
+
+    from core.enums import EmailKind
+    from core.utils import get_staff_emails
+    from core.services import EmailOutboxService
 
-            notification_email = f"""
+    comment = proposal.comment
+    ticket = comment.ticket if comment else proposal.ticket
+
+    if comment:
+        notification_email = f"""
             Hello dear manager,
 
-            We received a response to ticket #{comment.ticket} from {comment.ticket.open_by_email}.
+            We received a response to ticket #{ticket} from {ticket.open_by_email}.
             We created a comment for this email and our AI generated a response proposal for that, please take a look:
 
-            {response_proposal}
+            {proposal.content}
 
             ------
 
             You can go to your dashboard to update and/or validate this response before sending it to the customer.
             """
-
-            to_subject = f'Validation of AI Response on ticket #{comment.ticket.id}'
-        else:
-            ticket = Ticket.objects.get(id=ticket_id)
-
-            content = f'{ticket.title}\n\n{ticket.description}'
-
-            # Generate response
-            response_proposal = generate_answer(content, ticket.id, app_name=ticket.app)
-
-            # Save the temporal response
-            AITemporalComment.objects.create(
-                ticket=ticket,
-                content=response_proposal,
-                app=ticket.app
-            )
-
-            notification_email = f"""
+    else:
+        notification_email = f"""
             Hello dear manager,
 
             We received a ticket from {ticket.open_by_email}.
             We created a ticket for this email and our AI generated a response proposal for that, please take a look:
 
-            {response_proposal}
+            {proposal.content}
 
             ------
 
             You can go to your dashboard to update and/or validate this response before sending it to the customer.
             """
 
-            to_subject = f'Validation of AI Response on ticket #{ticket.id}'
+    # A failure in between leaves no proposal, the job is retried from scratch
+    with transaction.atomic():
+        # Concurrent generations of the same proposal (job and stream) are serialized on the answered row
+        if comment:
+            Comment.objects.select_for_update().filter(id=comment.id).exists()
+        else:
+            Ticket.objects.select_for_update().filter(id=ticket.id).exists()
+
+        existing = get_proposal(ticket.id, comment.id if comment else None)
+        if existing is None:
+            with span('proposal_save'):
+                proposal.save()
+
+            # Notify the company agents, the emails are sent by the `dispatch_emails` command
+            with span('notification'):
+                EmailOutboxService.queue(get_staff_emails(),
+                                         subject=f'Validation of AI Response on ticket #{ticket.id}',
+                                         message=notification_email, kind=EmailKind.PROPOSAL)
+
+        if on_saved is not None:
+            on_saved()
+
+    return existing or proposal
+
+
+# It's a little bit time-consuming, depending on the speed of the model, so it's run by the `run_ai_worker` command.
+def handling_response_generation(ticket_id: int | None, comment_id: int | None, is_comment: bool = None,
+                                 on_saved: callable = None):
+    """
+        The aim of this task is to handle all the process of generating the response of the ticket
+        - Generate a response to the ticket
+        - Set as temporal response in AITemporaryComment model
+        - Send mails and notification to the company managers with the proposal response
+        Nothing is generated when the ticket or the comment already has a proposal, a retried job saves only one.
+
+        @ticket_id: the id of the ticket object if it's a ticket object
+        @comment_id: the id of the comment object if it's a comment object
+        @is_comment: True if it's a comment object, False if it's a ticket object
+        @on_saved: called in the transaction which saves the proposal, to complete the job with it
+    """
+    from core.models import Ticket
+    from core.models import Comment
+    from ai.models import AITemporalComment
+
+    try:
+        if is_comment:
+            comment = Comment.objects.select_related('ticket').get(id=comment_id)
+            ticket = comment.ticket
+            content = comment.content
+        else:
+            comment = None
+            ticket = Ticket.objects.get(id=ticket_id)
+            content = f'{ticket.title}\n\n{ticket.description}'
+
+        if get_proposal(ticket.id, comment.id if comment else None) is not None:
+            logger.info(f'{"Comment" if comment else "Ticket"} {comment_id or ticket_id} already has a response '
+                        f'proposal')
+            return True
 
-        # Send mail to the company agents
-        agents = User.objects.filter(is_staff=True)
-        agents_email = [agent.email for agent in agents]
+        # Generate response
+        # Handle context (history of the message with chat history feature of LLM)
+        response_proposal, cache_fields = propose_answer(content, ticket.id, app_name=ticket.app)
 
-        send_simple_mail(to=agents_email, subject=to_subject, message=notification_email)
+        save_proposal(
+            AITemporalComment(
+                ticket=None if comment else ticket,
+                comment=comment,
+                content=response_proposal,
+                app=ticket.app,
+                **cache_fields
+            ),
+            on_saved=on_saved
+        )
+
+        return True
     except Comment.DoesNotExist:
         logger.error(f'Comment {comment_id} not found')
         return False
@@ -234,3 +485,55 @@ def handling_response_generation(ticket_id: int | None, comment_id: int | None,
     except Exception as e:
         logger.error(format_exc(e))
         return False
+
+
+def stream_response_generation(ticket_id: int, comment_id: int | None = None) -> Iterator[tuple[str, object]]:
+    """
+        Generate the response proposal of a ticket (or of one of its comments) while streaming it.
+        Yield ('token', text) events while the model generates, then save the full text as AITemporalComment, notify
+        the agents and yield ('done', proposal). The proposal already generated, if any, is streamed instead.
+
+        @ticket_id: the id of the ticket
+        @comment_id: the id of the comment to answer, the ticket itself is answered if not set
+    """
+    from core.models import Ticket
+    from core.models import Comment
+    from ai.models import AITemporalComment
+
+    if comment_id:
+        comment = Comment.objects.select_related('ticket').get(id=comment_id, ticket_id=ticket_id)
+        ticket = comment.ticket
+        content = comment.content
+    else:
+        comment = None
+        ticket = Ticket.objects.get(id=ticket_id)
+        content = f'{ticket.title}\n\n{ticket.description}'
+
+    proposal = get_proposal(ticket.id, comment_id)
+    if proposal is not None:
+        # Already generated, by the job queued with the ticket or the comment, or by a previous stream
+        yield 'token', proposal.content
+        yield 'done', proposal
+        return
+
+    with span('semantic_cache'):
+        entry, similarity = semantic_cache.lookup(content, ticket.app)
+    if entry is not None:
+        tokens = [entry.answer]
+        yield 'token', entry.answer
+    else:
+        tokens = []
+        for token in stream_answer(content, ticket.id, app_name=ticket.app):
+            tokens.append(token)
+            yield 'token', token
+
+    proposal = save_proposal(AITemporalComment(
+        ticket=None if comment else ticket,
+        comment=comment,
+        content=''.join(tokens),
+        app=ticket.app,
+        is_cache_derived=entry is not None,
+        cache_similarity=similarity
+    ))
+
+    yield 'done', proposal
@@ -0,0 +1,57 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from ai.models import AIResource
+
+
+class Command(BaseCommand):
+    help = ('Compute the content_hash of the AI resources saved before it existed, so that the ingestion deduplicates '
+            'the documents against them too. The resources identical to a resource already hashed are duplicates '
+            'ingested before the deduplication, they are reported and left without hash. Can be run again safely.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Resources hashed per transaction')
+
+    def handle(self, *args, **options):
+        last_id = 0
+        hashed = 0
+        duplicates = []
+
+        while True:
+            resources = list(
+                AIResource.objects.filter(content_hash__isnull=True, id__gt=last_id)
+                .only('id', 'app', 'link', 'data_type', 'content')
+                .order_by('id')[:options['batch_size']]
+            )
+            if not resources:
+                break
+            last_id = resources[-1].id
+
+            resources_by_hash = {}
+            for resource in resources:
+                content_hash = AIResource.compute_hash(resource.app, resource.link, resource.data_type,
+                                                       resource.content)
+                if content_hash in resources_by_hash:
+                    duplicates.append(resource.id)
+                    continue
+                resource.content_hash = content_hash
+                resources_by_hash[content_hash] = resource
+
+            with transaction.atomic():
+                existing_hashes = set(
+                    AIResource.objects.filter(content_hash__in=resources_by_hash)
+                    .values_list('content_hash', flat=True)
+                )
+                duplicates += [resources_by_hash.pop(content_hash).id for content_hash in existing_hashes]
+
+                AIResource.objects.bulk_update(resources_by_hash.values(), ['content_hash'])
+
+            hashed += len(resources_by_hash)
+            self.stdout.write(f'{hashed} resources hashed')
+
+        if duplicates:
+            self.stdout.write(self.style.WARNING(
+                f'{len(duplicates)} duplicated resources left without hash: {", ".join(map(str, sorted(duplicates)))}'
+            ))
+
+        self.stdout.write(self.style.SUCCESS(f'{hashed} resources hashed'))
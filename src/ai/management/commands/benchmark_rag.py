@@ -0,0 +1,278 @@
+import json
+import math
+import time
+import random
+import tempfile
+from unittest import mock
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessageChunk
+from langchain_core.documents import Document
+from langchain_core.outputs import ChatResult
+from langchain_core.outputs import ChatGeneration
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import generate_from_stream
+
+from core.models import Ticket
+from core.models import Comment
+from core.services import TicketService
+from core.services import CommentService
+from core.services import EmailOutboxService
+from core.instrumentation import SpanRecorder
+
+from core.enums import App
+
+from ai.enums import DataType
+from ai.enums import DataSourceType
+from ai.models import AIGenerationJob
+from ai.services import AIGenerationJobService
+from ai.retrievers.base import BaseRetriever
+from ai.retrievers.hybrid import lexical_index
+from ai.vectorizers.numpy_index import NumpyVectorClient
+
+User = get_user_model()
+
+STAGES = ('semantic_cache', 'history_load', 'retrieval', 'prompt_assembly', 'first_token', 'generation',
+          'notification', 'email_dispatch', 'total')
+WORDS = ('account', 'payment', 'refund', 'password', 'login', 'error', 'invoice', 'delivery', 'subscription', 'app',
+         'crash', 'update', 'card', 'order', 'email', 'support', 'timeout', 'upload', 'export', 'settings')
+
+
+class FakeChatModel(BaseChatModel):
+    """
+        Stand-in for the Ollama model: answers after `latency` seconds, then one word every `token_latency` seconds
+    """
+    latency: float = 0.2
+    token_latency: float = 0.01
+    tokens: int = 50
+    streaming: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return 'benchmark-fake'
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {'latency': self.latency, 'token_latency': self.token_latency, 'tokens': self.tokens,
+                'streaming': self.streaming}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.streaming:
+            return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+        time.sleep(self.latency + self.token_latency * self.tokens)
+        content = ' '.join(WORDS[index % len(WORDS)] for index in range(self.tokens))
+
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for index in range(self.tokens):
+            time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=f'{WORDS[index % len(WORDS)]} '))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class BenchmarkRetriever(BaseRetriever):
+    APP = App.TAVILY
+
+    def __init__(self, vector_db_client):
+        self.vector_db_client = vector_db_client
+        super(BenchmarkRetriever, self).__init__()
+
+    def load_vectordb_client(self, host: str = None, port: int = None, load_from_config: bool = True):
+        return self.vector_db_client
+
+
+@contextmanager
+def stand_ins(model: BaseChatModel, vector_db_client: NumpyVectorClient):
+    """
+        Replace the chat model, the vector store and the email backend of the generation by the local stand-ins
+    """
+    try:
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'), \
+                mock.patch('ai.llm.llm', model), \
+                mock.patch('ai.llm.load_vector_db_client', lambda: vector_db_client), \
+                mock.patch.dict('ai.llm._chains', clear=True):
+            lexical_index.reset()
+            yield
+    finally:
+        lexical_index.reset()
+        vector_db_client.reset_db()
+
+
+def percentile(values: list[float], rank: float) -> float:
+    values = sorted(values)
+    return values[max(math.ceil(rank / 100 * len(values)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = ('Measure the latency of each stage of the AI response generation (history load, retrieval, prompt '
+            'assembly, generation, notification and email dispatch) on a test database, with a fake chat model, an '
+            'in-process vector store and the locmem email backend')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10, help='Generations measured per scenario')
+        parser.add_argument('--warmup', type=int, default=1, help='Generations run before the measures')
+        parser.add_argument('--ticket-sizes', default='200,2000,8000', help='Sizes of the tickets, in characters')
+        parser.add_argument('--thread-lengths', default='0,5,20',
+                            help='Number of comments of the thread, 0 to answer the ticket itself')
+        parser.add_argument('--documents', type=int, default=1000, help='Documents of the knowledge base')
+        parser.add_argument('--agents', type=int, default=5, help='Staff users notified of each proposal')
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token of the model')
+        parser.add_argument('--token-latency', type=float, default=0.01, help='Seconds between two tokens')
+        parser.add_argument('--tokens', type=int, default=50, help='Tokens of each answer')
+        parser.add_argument('--streaming', action='store_true', help='Stream the tokens of the model')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the results as JSON to this file, - for the standard output')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between two runs')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        model = FakeChatModel(latency=options['latency'], token_latency=options['token_latency'],
+                              tokens=options['tokens'], streaming=options['streaming'])
+        vector_db_client = NumpyVectorClient(path=tempfile.mkdtemp(prefix='benchmark_rag_'))
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+
+        try:
+            with stand_ins(model, vector_db_client):
+                results = self.run(options, vector_db_client)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        self.report(results)
+        if options['output']:
+            output = json.dumps({
+                'parameters': {name: options[name] for name in (
+                    'iterations', 'ticket_sizes', 'thread_lengths', 'documents', 'agents', 'latency', 'token_latency',
+                    'tokens', 'streaming', 'seed'
+                )},
+                'scenarios': results
+            }, indent=2, sort_keys=True)
+
+            if options['output'] == '-':
+                self.stdout.write(output)
+            else:
+                with open(options['output'], 'w') as file:
+                    file.write(output + '\n')
+
+    def run(self, options: dict, vector_db_client: NumpyVectorClient) -> dict:
+        self.stdout.write(f'Embedding {options["documents"]} documents...')
+        self.seed(vector_db_client, options['documents'], options['agents'])
+
+        ticket_sizes = [int(size) for size in options['ticket_sizes'].split(',')]
+        thread_lengths = [int(length) for length in options['thread_lengths'].split(',')]
+
+        for _ in range(options['warmup']):
+            self.generate(ticket_sizes[0], thread_lengths[0])
+
+        results = {}
+        for ticket_size in ticket_sizes:
+            for thread_length in thread_lengths:
+                scenario = f'ticket_size={ticket_size},thread_length={thread_length}'
+                self.stdout.write(f'Running {scenario}...')
+
+                durations = {}
+                for _ in range(options['iterations']):
+                    for stage, values in self.generate(ticket_size, thread_length).items():
+                        durations.setdefault(stage, []).append(sum(values))
+
+                results[scenario] = {
+                    'samples': options['iterations'],
+                    'stages': {
+                        stage: {
+                            'mean': round(sum(values) / len(values) * 1000, 3),
+                            'p50': round(percentile(values, 50) * 1000, 3),
+                            'p95': round(percentile(values, 95) * 1000, 3),
+                            'p99': round(percentile(values, 99) * 1000, 3),
+                        }
+                        for stage, values in durations.items()
+                    }
+                }
+
+        return results
+
+    def seed(self, vector_db_client: NumpyVectorClient, documents: int, agents: int) -> None:
+        """
+            Embed the knowledge base and create the customer opening the tickets and the agents notified
+        """
+        BenchmarkRetriever(vector_db_client).embed_data(DataType.TEXT, DataSourceType.APP_FAQ, [
+            Document(page_content=self.text(500), metadata={
+                'title': f'Article {index}', 'link': f'https://example.com/{index}', 'description': self.text(100)
+            })
+            for index in range(documents)
+        ])
+
+        self.customer = User.objects.create_user(username='benchmark-customer', email='customer@example.com')
+        self.agent = None
+        for index in range(agents):
+            self.agent = User.objects.create_user(username=f'benchmark-agent-{index}',
+                                                  email=f'agent{index}@example.com', is_staff=True)
+
+    def generate(self, ticket_size: int, thread_length: int) -> dict:
+        """
+            Create a ticket, and its thread if any, through the services and run the generation job they enqueued
+            :return: The durations of the stages, in seconds
+        """
+        ticket = TicketService().create({
+            'title': self.text(60),
+            'description': self.text(ticket_size),
+            'open_by': self.customer,
+            'open_by_email': self.customer.email,
+            'app': App.TAVILY,
+        })
+
+        if thread_length:
+            # Only the generation of the last comment is measured
+            AIGenerationJob.objects.filter(ticket=ticket).delete()
+            Comment.objects.bulk_create([
+                Comment(ticket=ticket, content=self.text(300), created_by=self.agent if index % 2 else self.customer)
+                for index in range(thread_length - 1)
+            ])
+            CommentService().create({'ticket': ticket, 'content': self.text(300), 'created_by': self.customer})
+
+        job = AIGenerationJobService.claim()
+        with SpanRecorder(STAGES) as recorder:
+            started_at = time.perf_counter()
+            succeeded = AIGenerationJobService(job).run()
+            EmailOutboxService().dispatch()
+            recorder('total', time.perf_counter() - started_at)
+
+        if not succeeded:
+            self.stderr.write(f'Generation of ticket #{ticket.id} failed: {job.last_error}')
+
+        Ticket.objects.filter(id=ticket.id).delete()
+
+        return recorder.durations
+
+    def text(self, size: int) -> str:
+        # A random suffix makes each question unique, the generation cache never answers
+        words = [f'#{self.rng.randrange(10 ** 9)}']
+        while sum(len(word) + 1 for word in words) < size:
+            words.append(self.rng.choice(WORDS))
+
+        return ' '.join(words)[:size]
+
+    def report(self, results: dict) -> None:
+        self.stdout.write(f'{"scenario":<40}{"stage":<18}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        for scenario, result in results.items():
+            for stage in STAGES:
+                if stage in result['stages']:
+                    measures = result['stages'][stage]
+                    self.stdout.write(f'{scenario:<40}{stage:<18}{measures["p50"]:>10.1f}{measures["p95"]:>10.1f}'
+                                      f'{measures["p99"]:>10.1f}')
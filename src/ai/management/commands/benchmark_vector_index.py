@@ -0,0 +1,90 @@
+import time
+import random
+import statistics
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from traceback_with_variables import format_exc
+
+from ai.vectorizers.chroma import ChromaClient
+from ai.vectorizers.numpy_index import NumpyVectorClient
+from ai.vectorizers.embeddings import get_embedding_function
+from ai.vectorizers.embeddings import query_embedding_cache
+
+WORDS = ('account', 'payment', 'refund', 'password', 'login', 'error', 'invoice', 'delivery', 'subscription', 'app',
+         'crash', 'update', 'card', 'order', 'email', 'support', 'timeout', 'upload', 'export', 'settings')
+
+
+class Command(BaseCommand):
+    help = 'Compare the query latency of the in-process NumPy index and of the Chroma server on the same documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=5000, help='Number of documents to index')
+        parser.add_argument('--queries', type=int, default=200, help='Number of queries to run on each backend')
+        parser.add_argument('--n-results', type=int, default=3)
+        parser.add_argument('--backends', default='NUMPY,CHROMA', help='Comma separated list of backends to compare')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        documents = [' '.join(rng.choices(WORDS, k=40)) for _ in range(options['documents'])]
+        queries = [' '.join(rng.choices(WORDS, k=8)) for _ in range(options['queries'])]
+        if len(set(queries)) > query_embedding_cache.max_size:
+            raise CommandError(f'At most {query_embedding_cache.max_size} queries, the size of the query embeddings '
+                               f'cache (QUERY_EMBEDDING_CACHE_SIZE)')
+
+        self.stdout.write(f'Embedding {len(documents)} documents...')
+        embedding_function = get_embedding_function()
+        embeddings = [vector for start in range(0, len(documents), 256)
+                      for vector in embedding_function(documents[start:start + 256])]
+
+        backends = {'NUMPY': NumpyVectorClient, 'CHROMA': ChromaClient}
+        for name in options['backends'].upper().split(','):
+            if name not in backends:
+                raise CommandError(f'Unknown backend {name}')
+
+            try:
+                client = backends[name]()
+                self.run(name, client, documents, embeddings, queries, options['n_results'])
+            except Exception as e:
+                self.stderr.write(f'{name} benchmark failed: {e}')
+                self.stderr.write(format_exc(e))
+
+    def run(self, name, client, documents, embeddings, queries, n_results):
+        collection_name = 'BENCHMARK_COLLECTION'
+        if client.count(collection_name):
+            client.delete_collection(collection_name)
+
+        try:
+            collection = client.get_or_create_collection(collection_name)
+            started_at = time.perf_counter()
+            for start in range(0, len(documents), 1000):
+                client.save_documents(
+                    documents=documents[start:start + 1000],
+                    collection=collection,
+                    ids=[str(index) for index in range(start, min(start + 1000, len(documents)))],
+                    metadata=[{'position': index} for index in range(start, min(start + 1000, len(documents)))],
+                    create_or_update=True,
+                    embeddings=embeddings[start:start + 1000]
+                )
+            indexing = time.perf_counter() - started_at
+
+            # The queries are embedded before the measures, through the cache shared by the backends: every backend
+            # measures its search only, not the embedding model
+            client.embed_queries(queries)
+
+            durations = []
+            for query in queries:
+                started_at = time.perf_counter()
+                client.query_documents(query, collection_name, metadata_filter={}, n_results=n_results)
+                durations.append((time.perf_counter() - started_at) * 1000)
+
+            durations.sort()
+            self.stdout.write(
+                f'{name}: indexed {len(documents)} documents in {indexing:.2f}s, {len(queries)} queries '
+                f'mean {statistics.mean(durations):.2f}ms, p50 {durations[len(durations) // 2]:.2f}ms, '
+                f'p95 {durations[int(len(durations) * 0.95) - 1]:.2f}ms'
+            )
+        finally:
+            client.delete_collection(collection_name)
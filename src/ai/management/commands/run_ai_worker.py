@@ -0,0 +1,142 @@
+import hmac
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from django.db import connections
+from django.db import close_old_connections
+from django.core.management.base import BaseCommand
+
+from decouple import config
+
+from traceback_with_variables import format_exc
+
+from core.metrics import registry
+
+from ai.services import AIGenerationJobService
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+        Metrics of the workers in the Prometheus text format, only served to the scraper sending the `METRICS_TOKEN`
+        bearer token
+    """
+    token = config('METRICS_TOKEN', default='')
+
+    def do_GET(self):
+        if not self.token or not hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {self.token}'):
+            self.send_error(403)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Process the queued AI response generations with N concurrent workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=config('AI_WORKERS', default=2, cast=int),
+                            help='Number of concurrent workers')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait before polling again when the queue is empty')
+        parser.add_argument('--lease', type=int, default=AIGenerationJobService.LEASE,
+                            help='Seconds without heartbeat after which a running job is considered abandoned and '
+                                 'queued again, the heartbeat of the running jobs is sent every third of it')
+        parser.add_argument('--once', action='store_true', help='Exit as soon as the queue is empty')
+        parser.add_argument('--metrics-port', type=int, default=config('AI_WORKER_METRICS_PORT', default=0, cast=int),
+                            help='Expose the Prometheus metrics of the workers on this port, disabled if 0')
+        parser.add_argument('--metrics-host', default=config('AI_WORKER_METRICS_HOST', default='127.0.0.1'),
+                            help='Interface the metrics are exposed on, only the local host by default')
+
+    def handle(self, *args, **options):
+        self.logger = logging.getLogger('llm')
+        self.stop = threading.Event()
+        # Jobs run by the workers of the process, by worker
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.leases_kept_at = None
+        self.keep_leases(options['lease'])
+
+        if options['metrics_port'] and not MetricsHandler.token:
+            self.stderr.write('METRICS_TOKEN is not set, the metrics of the workers are not exposed')
+        elif options['metrics_port']:
+            server = ThreadingHTTPServer((options['metrics_host'], options['metrics_port']), MetricsHandler)
+            threading.Thread(target=server.serve_forever, name='ai-worker-metrics', daemon=True).start()
+            self.stdout.write(f'Metrics exposed on {options["metrics_host"]}:{options["metrics_port"]}')
+
+        workers = [
+            threading.Thread(target=self.work, args=(options['poll_interval'], options['once']),
+                             name=f'ai-worker-{index}', daemon=True)
+            for index in range(options['workers'])
+        ]
+        for worker in workers:
+            worker.start()
+
+        self.stdout.write(f'{len(workers)} AI workers started')
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(timeout=1)
+                self.keep_leases(options['lease'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping the workers after their current job...')
+            self.stop.set()
+            for worker in workers:
+                worker.join()
+
+    def keep_leases(self, lease: int) -> None:
+        """
+            Renew the lease of the jobs run by the workers, and queue again the jobs whose worker died, every third of
+            the lease
+        """
+        if self.leases_kept_at is not None and time.monotonic() - self.leases_kept_at < lease / 3:
+            return
+
+        self.leases_kept_at = time.monotonic()
+        try:
+            close_old_connections()
+            with self.running_lock:
+                job_ids = list(self.running.values())
+            AIGenerationJobService.heartbeat(job_ids)
+            requeued = AIGenerationJobService.requeue_stale(lease)
+            if requeued:
+                self.logger.warning(f'{requeued} abandoned generation jobs queued again')
+        except Exception as e:
+            self.logger.error(format_exc(e))
+
+    def work(self, poll_interval: float, once: bool) -> None:
+        while not self.stop.is_set():
+            try:
+                close_old_connections()
+                job = AIGenerationJobService.claim()
+                if job is None:
+                    if once:
+                        return
+                    self.stop.wait(poll_interval)
+                    continue
+
+                started_at = time.monotonic()
+                with self.running_lock:
+                    self.running[threading.get_ident()] = job.id
+                succeeded = AIGenerationJobService(job).run()
+                self.logger.info(f'Generation job #{job.id} {"succeeded" if succeeded else "failed"} '
+                                 f'in {time.monotonic() - started_at:.2f}s')
+            except Exception as e:
+                self.logger.error(format_exc(e))
+                self.stop.wait(poll_interval)
+            finally:
+                with self.running_lock:
+                    self.running.pop(threading.get_ident(), None)
+                close_old_connections()
+
+        connections.close_all()
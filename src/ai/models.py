@@ -1,4 +1,10 @@
+from __future__ import annotations
+
+import hashlib
+
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from core.base import BaseModel
@@ -7,6 +13,7 @@ from core.models import Ticket
 from core.models import Comment
 
 from ai.enums import DataType
+from ai.enums import JobStatus
 
 from core.enums import App
 
@@ -22,6 +29,17 @@ class AIResource(models.Model):
                                  help_text='This field contains type of data stored, Raw Text, PDF, MarkDown, Web link')
     content = models.TextField(blank=True, null=True)
     metadata = models.JSONField(blank=True, null=True)
+    content_hash = models.CharField(max_length=64, unique=True, blank=True, null=True, editable=False,
+                                    help_text='sha256 of the app, link, data type and content, used to deduplicate')
+
+    def save(self, *args, **kwargs):
+        if not self.content_hash:
+            self.content_hash = self.compute_hash(self.app, self.link, self.data_type, self.content)
+        super(AIResource, self).save(*args, **kwargs)
+
+    @staticmethod
+    def compute_hash(app: str, link: str | None, data_type: str, content: str | None) -> str:
+        return hashlib.sha256('\x1f'.join([app, link or '', str(data_type), content or '']).encode()).hexdigest()
 
 
 class AITemporalComment(BaseModel):
@@ -34,11 +52,132 @@ class AITemporalComment(BaseModel):
     content = CKEditor5Field()
     is_validated = models.BooleanField(default=False)
     app = models.CharField(max_length=255, choices=App.choices(), default=App.TAVILY)
+    is_cache_derived = models.BooleanField(default=False,
+                                           help_text='The proposal is the validated answer of a similar question')
+    cache_similarity = models.FloatField(blank=True, null=True,
+                                         help_text='Best similarity found in the semantic cache for the question')
 
     def __str__(self):
         return f'{self.content[:10]}...'
 
+    def get_question(self) -> str:
+        """
+            The content of the comment or of the ticket the proposal answers
+        """
+        if self.comment_id:
+            return self.comment.content
+
+        return f'{self.ticket.title}\n\n{self.ticket.description}'
+
     class Meta:
         verbose_name = _('AI Response proposal')
         verbose_name_plural = _('AI Response proposals')
         ordering = ('-created_at',)
+        indexes = [
+            models.Index(fields=['is_validated', '-created_at']),
+            # Review queue, the proposals waiting for an agent are a small part of the table
+            models.Index(fields=['-created_at'], condition=Q(is_validated=False), name='proposal_review_queue_idx'),
+        ]
+
+
+class AIGenerationJob(BaseModel):
+    """
+        Background job generating the AI response proposal of a ticket or of a comment, processed by `run_ai_worker`
+    """
+
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name='ai_jobs')
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='ai_jobs', blank=True, null=True)
+    status = models.CharField(max_length=255, choices=JobStatus.choices(), default=JobStatus.PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True,
+                                        help_text='Refreshed while a worker runs the job, the job is queued again when '
+                                                  'its lease expires')
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Generation job #{self.id} ({self.status})'
+
+    @property
+    def is_comment(self):
+        return self.comment_id is not None
+
+    class Meta:
+        verbose_name = _('AI generation job')
+        verbose_name_plural = _('AI generation jobs')
+        indexes = [
+            models.Index(fields=['status', 'run_after'])
+        ]
+        ordering = ('-created_at',)
+
+
+class AISemanticCacheEntry(BaseModel):
+    """
+        Validated answer of a question, proposed again for the near-duplicate questions asked on the same app
+    """
+
+    app = models.CharField(max_length=255, choices=App.choices(), default=App.TAVILY)
+    question = models.TextField()
+    answer = CKEditor5Field()
+    embedding = models.BinaryField(help_text='float32 normalized embedding of the question')
+    embedding_model = models.CharField(max_length=255)
+    proposal = models.ForeignKey(AITemporalComment, on_delete=models.SET_NULL, related_name='semantic_cache_entries',
+                                 blank=True, null=True)
+    hits = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.question[:10]}...'
+
+    class Meta:
+        verbose_name = _('Semantic cache entry')
+        verbose_name_plural = _('Semantic cache entries')
+        indexes = [
+            models.Index(fields=['app', 'embedding_model', 'id'])
+        ]
+        ordering = ('-created_at',)
+
+
+class TicketConversationSummary(BaseModel):
+    """
+        Rolling summary of the oldest messages of a ticket conversation, the ones which don't fit anymore in the
+        history token budget of the prompt
+    """
+
+    ticket = models.OneToOneField(Ticket, on_delete=models.CASCADE, related_name='conversation_summary')
+    summary = models.TextField(blank=True)
+    summarized_messages = models.PositiveIntegerField(default=0,
+                                                      help_text='Number of messages, from the first one, summarized')
+    summarized_digest = models.CharField(max_length=64, blank=True,
+                                         help_text='sha256 of the summarized messages, they are summarized again '
+                                                   'when one of them changed')
+
+    def __str__(self):
+        return f'Summary of ticket #{self.ticket_id}'
+
+    class Meta:
+        verbose_name = _('Conversation summary')
+        verbose_name_plural = _('Conversation summaries')
+        ordering = ('-created_at',)
+
+
+class AIEmbedding(models.Model):
+    """
+        Embedding of a chunk of text, kept so that the unchanged chunks of a re-crawled page aren't embedded again
+    """
+
+    embedding_model = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64, help_text='sha256 of the embedded text')
+    vector = models.BinaryField(help_text='float16 embedding of the text')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.embedding_model} {self.text_hash[:10]}'
+
+    class Meta:
+        verbose_name = _('Embedding')
+        verbose_name_plural = _('Embeddings')
+        constraints = [
+            models.UniqueConstraint(fields=['embedding_model', 'text_hash'], name='unique_embedding_per_model')
+        ]
@@ -0,0 +1,21 @@
+import json
+
+from rest_framework import renderers
+
+
+def format_event(event: str, data) -> str:
+    """Format one Server-Sent Event"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class EventStreamRenderer(renderers.BaseRenderer):
+    """
+        Allow the `text/event-stream` content negotiation, the stream itself is written by a StreamingHttpResponse.
+        Only the errors raised before the stream starts are rendered here, as an `error` event.
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event('error', data).encode(self.charset)
@@ -8,7 +8,18 @@ import abc
 import logging
 import requests
 
+from decouple import config
+
+from core.metrics import ingestion_batches
+from core.metrics import ingested_documents
+from core.instrumentation import span
+
 from ai.vectorizers.base import VectorDBBaseClient
+from ai.vectorizers.embeddings import embedding_cache
+from ai.vectorizers.embeddings import get_embedding_function
+
+from ai.cache import generation_cache
+from ai.retrievers.hybrid import lexical_index
 
 from ai.enums import DataType
 from ai.enums import DataSourceType
@@ -22,6 +33,10 @@ class BaseRetriever(abc.ABC):
          which can be used as knowledge base, feel free to add more
     """
     APP = None
+    # Number of documents inserted, embedded and upserted to the vector store at once
+    INGESTION_BATCH_SIZE = config('INGESTION_BATCH_SIZE', default=128, cast=int)
+    EMBEDDING_MODEL = None
+    EMBEDDING_DEVICE = None
 
     def __init__(self, username: str = None, password: str = None, token: str = None):
         self.logger = logging.getLogger()
@@ -29,6 +44,13 @@ class BaseRetriever(abc.ABC):
             self.session: requests.Session = self.authenticate(username, password, token)
         self.vector_db_client: VectorDBBaseClient = self.load_vectordb_client()
 
+    @property
+    def embedding_function(self) -> callable:
+        """
+            The embedding model of the retriever, taken from the process wide registry so that it's loaded only once
+        """
+        return get_embedding_function(self.EMBEDDING_MODEL, self.EMBEDDING_DEVICE)
+
     def authenticate(self, username: str = None, password: str = None, token: str = None) -> requests.Session:
         raise NotImplemented()
 
@@ -47,32 +69,77 @@ class BaseRetriever(abc.ABC):
             }
         )
 
-        for document in data:
+        for start in range(0, len(data), self.INGESTION_BATCH_SIZE):
+            with span('ingestion_batch'):
+                self.embed_batch(data_type, collection, data[start:start + self.INGESTION_BATCH_SIZE])
+            ingestion_batches.inc(app=self.APP)
+
+    def embed_batch(self, data_type: DataType, collection: object, documents: list) -> int:
+        """
+            Save a batch of documents as AIResource and in the vector store, the documents already ingested are
+            skipped thanks to their content hash.
+            :return: The number of new documents
+        """
+        documents_by_hash = {}
+        for document in documents:
             document.metadata['source'] = self.APP
             document.metadata['title'] = document.metadata['title']
 
-            ai_resource, created = AIResource.objects.get_or_create(
+            content_hash = AIResource.compute_hash(self.APP, document.metadata['link'], data_type,
+                                                   document.page_content)
+            documents_by_hash.setdefault(content_hash, document)
+
+        existing_hashes = set(
+            AIResource.objects.filter(content_hash__in=documents_by_hash).values_list('content_hash', flat=True)
+        )
+        new_documents = {
+            content_hash: document
+            for content_hash, document in documents_by_hash.items() if content_hash not in existing_hashes
+        }
+        ingested_documents.inc(len(documents) - len(documents_by_hash), app=self.APP, result='duplicate')
+        ingested_documents.inc(len(existing_hashes), app=self.APP, result='known')
+        if not new_documents:
+            return 0
+
+        # Rows inserted meanwhile by a concurrent ingestion are skipped by the unique index
+        AIResource.objects.bulk_create([
+            AIResource(
                 app=self.APP,
                 link=document.metadata['link'],
                 data_type=data_type,
                 content=document.page_content,
-                metadata=document.metadata
+                metadata=dict(document.metadata),
+                content_hash=content_hash
+            )
+            for content_hash, document in new_documents.items()
+        ], ignore_conflicts=True)
+
+        ai_resources = dict(
+            AIResource.objects.filter(content_hash__in=new_documents).values_list('content_hash', 'id')
+        )
+        for content_hash, document in new_documents.items():
+            document.metadata.update(
+                {
+                    'ai_resource': ai_resources[content_hash],
+                }
             )
 
-            if created:
-                document.metadata.update(
-                    {
-                        'ai_resource': ai_resource.id,
-                    }
-                )
-                self.logger.info(f'Document metadata: {document.metadata}')
-                self.vector_db_client.save_documents(
-                    documents=[document.page_content],
-                    collection=collection,
-                    ids=[str(document.metadata.get('ai_resource'))],
-                    metadata=[document.metadata],
-                    create_or_update=True
-                )
+        texts = [document.page_content for document in new_documents.values()]
+        self.vector_db_client.save_documents(
+            documents=texts,
+            collection=collection,
+            ids=[str(document.metadata['ai_resource']) for document in new_documents.values()],
+            metadata=[document.metadata for document in new_documents.values()],
+            create_or_update=True,
+            embeddings=embedding_cache.embed(texts, self.EMBEDDING_MODEL, self.EMBEDDING_DEVICE)
+        )
+        lexical_index.sync(self.APP)
+        # Inserted with bulk_create, which doesn't send the signals of the models
+        generation_cache.invalidate(self.APP)
+        ingested_documents.inc(len(new_documents), app=self.APP, result='new')
+        self.logger.info(f'{len(new_documents)} new documents embedded, {len(existing_hashes)} already known')
+
+        return len(new_documents)
 
     def get_faqs(self, limit: int = None, subject: str = None) -> list:
         return []
@@ -0,0 +1,154 @@
+######################################################################################################
+#    This module fetches the web pages used as knowledge base, concurrently and with strict limits   #
+#    so that one slow or huge page doesn't stall the whole retrieval                                 #
+######################################################################################################
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from typing import Iterator
+from collections import deque
+from urllib.parse import urlparse
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from bs4 import BeautifulSoup
+
+from decouple import config
+
+from langchain_core.documents import Document
+
+
+class PageTooLarge(Exception):
+    pass
+
+
+class PageFetcher:
+    """
+        Load web pages as langchain documents, the same way WebBaseLoader does, but concurrently:
+        - `max_workers` pages are fetched at the same time, at most `max_per_host` on the same host. The pages are
+          queued by host and only submitted when their host has a free slot, a busy host never holds the workers
+          while the pages of the other hosts wait
+        - the connection and the whole read are bounded by `connect_timeout` and `read_timeout` seconds
+        - the pages bigger than `max_bytes` are dropped
+        - a page which fails is logged and skipped, the others are still returned
+    """
+
+    def __init__(self, max_workers: int = None, max_per_host: int = None, connect_timeout: float = None,
+                 read_timeout: float = None, max_bytes: int = None):
+        self.logger = logging.getLogger()
+        self.max_workers = max_workers or config('FETCH_MAX_WORKERS', default=8, cast=int)
+        self.max_per_host = max_per_host or config('FETCH_MAX_PER_HOST', default=2, cast=int)
+        self.connect_timeout = connect_timeout or config('FETCH_CONNECT_TIMEOUT', default=5, cast=float)
+        self.read_timeout = read_timeout or config('FETCH_READ_TIMEOUT', default=15, cast=float)
+        self.max_bytes = max_bytes or config('FETCH_MAX_BYTES', default=5 * 1024 * 1024, cast=int)
+        self.headers = {'User-Agent': config('USER_AGENT', default='Mozilla/5.0 (compatible; CuSupaLM)')}
+
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+        self._local = threading.local()
+
+    def fetch_all(self, urls: list[str]) -> Iterator[Document]:
+        """
+            Yield the documents in completion order, so that the caller can process a page while the others are
+            still downloading
+        """
+        if not urls:
+            return
+
+        queues = {}
+        for url in urls:
+            queues.setdefault(urlparse(url).netloc, deque()).append(url)
+        running = dict.fromkeys(queues, 0)
+        max_workers = min(self.max_workers, len(urls))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+
+            def submit():
+                for host, queue in queues.items():
+                    while queue and running[host] < self.max_per_host and len(futures) < max_workers:
+                        url = queue.popleft()
+                        running[host] += 1
+                        futures[executor.submit(self.fetch, url)] = (url, host)
+
+            submit()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, host = futures.pop(future)
+                    running[host] -= 1
+                    try:
+                        yield future.result()
+                    except Exception as e:
+                        self.logger.warning(f'Unable to fetch {url}: {e}')
+                submit()
+
+    def fetch(self, url: str) -> Document:
+        # fetch_all never runs more than `max_per_host` pages of a host, the semaphore bounds the concurrent calls
+        # sharing the fetcher
+        with self._host_semaphore(url):
+            content = self._download(url)
+
+        return self._parse(url, content)
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.max_per_host)
+
+            return self._hosts[host]
+
+    def _session(self) -> requests.Session:
+        # Sessions aren't thread safe, each worker keeps its own to reuse its connections
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(self.headers)
+
+        return self._local.session
+
+    def _download(self, url: str) -> bytes:
+        deadline = time.monotonic() + self.read_timeout
+
+        with self._session().get(url, timeout=(self.connect_timeout, self.read_timeout), stream=True) as response:
+            response.raise_for_status()
+
+            if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+                raise PageTooLarge(f'Page bigger than {self.max_bytes} bytes')
+
+            # read1 returns what a single read of the socket got, unlike iter_content which waits for a full chunk:
+            # the deadline is checked even when the server sends the page byte by byte
+            response.raw.decode_content = True
+            chunks = []
+            size = 0
+            while chunk := response.raw.read1(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise PageTooLarge(f'Page bigger than {self.max_bytes} bytes')
+                if time.monotonic() > deadline:
+                    raise requests.Timeout(f'Page not downloaded within {self.read_timeout}s')
+                chunks.append(chunk)
+
+        return b''.join(chunks)
+
+    @staticmethod
+    def _parse(url: str, content: bytes) -> Document:
+        soup = BeautifulSoup(content, 'html.parser')
+
+        metadata = {'source': url}
+        if title := soup.find('title'):
+            metadata['title'] = title.get_text()
+        if description := soup.find('meta', attrs={'name': 'description'}):
+            metadata['description'] = description.get('content', 'No description found.')
+        else:
+            metadata['description'] = 'No description found.'
+        if html := soup.find('html'):
+            metadata['language'] = html.get('lang', 'No language found.')
+
+        return Document(page_content=soup.get_text(), metadata=metadata)
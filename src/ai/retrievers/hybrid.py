@@ -0,0 +1,240 @@
+######################################################################################################
+#    Hybrid retrieval: a BM25 inverted index over the AIResource contents finds the exact product   #
+#    names and error codes the embeddings miss, its ranking is fused with the vector store one      #
+######################################################################################################
+
+from __future__ import annotations
+
+import re
+import math
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from decouple import config
+
+from core.instrumentation import span
+
+from ai.vectorizers.base import VectorDBBaseClient
+
+# Keep the product names and the error codes (ERR-404, v2.1.3, E_TIMEOUT) as single terms
+TOKEN_PATTERN = re.compile(r'\w+(?:[-_.]\w+)*')
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class BM25Index:
+    """
+        In-memory BM25 inverted index of the AIResource contents, one per app.
+        The index is built from the database on first use, then synchronized incrementally with the rows inserted
+        since (by this process on ingestion, by the others at most every `sync_interval` seconds).
+        An update or a deletion of a resource, in any process, bumps the version of the index of its app in the
+        database (a CacheVersion): each synchronization compares it, and the number of indexed rows still in the
+        database, with the ones of the index, which is rebuilt when they differ.
+        The index is only read and written under the lock, the search threads never see a partial synchronization.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, sync_interval: float = None):
+        self.logger = logging.getLogger('llm')
+        self.k1 = k1
+        self.b = b
+        self.sync_interval = (sync_interval if sync_interval is not None
+                              else config('LEXICAL_INDEX_SYNC_INTERVAL', default=10, cast=float))
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def version_name(app: str) -> str:
+        return f'lexical-index:{app}'
+
+    def search(self, query: str, app: str, n_results: int = 10) -> list[tuple[str, float, dict]]:
+        """
+            :return: The (AIResource id, score, metadata) of the best matching resources, best first
+        """
+        self.sync(app, force=False)
+
+        terms = set(tokenize(query))
+        with self._lock:
+            index = self._indexes.get(app)
+            if index is None or not index['ids'] or not terms:
+                return []
+
+            scores = np.zeros(len(index['ids']), dtype=np.float32)
+            for term in terms:
+                postings = self._postings(index, term)
+                if postings is None:
+                    continue
+
+                positions, frequencies = postings
+                idf = math.log(1 + (len(index['ids']) - len(positions) + 0.5) / (len(positions) + 0.5))
+                scores[positions] += (idf * frequencies * (self.k1 + 1)
+                                      / (frequencies + self.k1 * index['norms'][positions]))
+
+            k = min(n_results, int(np.count_nonzero(scores)))
+            if not k:
+                return []
+
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+
+            return [(index['ids'][position], float(scores[position]), index['metadatas'][position])
+                    for position in top]
+
+    def sync(self, app: str, force: bool = True) -> None:
+        """
+            Add to the index of the app the resources inserted since the last synchronization, or rebuild it when
+            indexed resources were updated or deleted
+        """
+        from core.models import CacheVersion
+        from ai.models import AIResource
+
+        with self._lock:
+            index = self._indexes.get(app)
+            if not force and index is not None and time.monotonic() - index['synced_at'] < self.sync_interval:
+                return
+
+            version = CacheVersion.get(self.version_name(app))
+            if index is not None and (
+                    index['version'] != version or
+                    AIResource.objects.filter(app=app, id__lte=index['last_id']).count() != len(index['ids'])
+            ):
+                self.logger.info(f'Resources of {app} updated or deleted, rebuilding its lexical index')
+                index = None
+
+            if index is None:
+                index = self._indexes[app] = {
+                    'ids': [], 'metadatas': [], 'lengths': [], 'norms': np.empty(0, dtype=np.float32),
+                    'postings': {}, 'arrays': {}, 'last_id': 0, 'synced_at': None, 'version': version
+                }
+
+            rows = list(
+                AIResource.objects.filter(app=app, id__gt=index['last_id'])
+                .order_by('id').values_list('id', 'content', 'metadata')
+            )
+            for resource_id, content, metadata in rows:
+                position = len(index['ids'])
+                frequencies = {}
+                terms = tokenize(content)
+                for term in terms:
+                    frequencies[term] = frequencies.get(term, 0) + 1
+                for term, frequency in frequencies.items():
+                    postings = index['postings'].setdefault(term, ([], []))
+                    postings[0].append(position)
+                    postings[1].append(frequency)
+
+                index['ids'].append(str(resource_id))
+                index['metadatas'].append(metadata or {})
+                index['lengths'].append(len(terms))
+
+            if rows:
+                lengths = np.asarray(index['lengths'], dtype=np.float32)
+                index['norms'] = 1 - self.b + self.b * lengths / max(float(lengths.mean()), 1.0)
+                index['arrays'].clear()
+                index['last_id'] = rows[-1][0]
+                self.logger.info(f'{len(rows)} resources added to the lexical index of {app}')
+
+            index['synced_at'] = time.monotonic()
+
+    def invalidate(self, app: str) -> None:
+        """
+            Rebuild the index of the app in every process, on their next synchronization
+        """
+        from core.models import CacheVersion
+
+        CacheVersion.bump(self.version_name(app))
+        self.reset(app)
+
+    def reset(self, app: str = None) -> None:
+        """
+            Drop the index of the process only
+        """
+        with self._lock:
+            if app is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(app, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {app: {'documents': len(index['ids']), 'terms': len(index['postings'])}
+                    for app, index in self._indexes.items()}
+
+    @staticmethod
+    def _postings(index: dict, term: str) -> tuple[np.ndarray, np.ndarray] | None:
+        # The posting lists are converted to arrays once per synchronization, always called under the lock
+        arrays = index['arrays'].get(term)
+        if arrays is None:
+            postings = index['postings'].get(term)
+            if postings is None:
+                return None
+            arrays = (np.asarray(postings[0], dtype=np.int64), np.asarray(postings[1], dtype=np.float32))
+            index['arrays'][term] = arrays
+
+        return arrays
+
+
+lexical_index = BM25Index()
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    """
+        Fuse several rankings of ids, each id scores the sum of 1 / (k + rank) over the rankings it appears in
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, document_id in enumerate(ranking, start=1):
+            scores[document_id] = scores.get(document_id, 0.0) + 1 / (k + rank)
+
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridSearcher:
+    """
+        Query the vector store and the lexical index of an app in parallel and fuse their rankings.
+        The result has the same format as the vector store one, for a single query.
+    """
+    # The vector store query is sent from this pool while the lexical index is searched in the calling thread
+    executor = ThreadPoolExecutor(max_workers=config('HYBRID_SEARCH_WORKERS', default=4, cast=int))
+
+    def __init__(self, vector_db_client: VectorDBBaseClient, app: str, collection_name: str,
+                 index: BM25Index = None, candidates: int = None, rrf_k: int = None):
+        self.vector_db_client = vector_db_client
+        self.app = app
+        self.collection_name = collection_name
+        self.index = index or lexical_index
+        self.candidates = candidates or config('HYBRID_SEARCH_CANDIDATES', default=10, cast=int)
+        self.rrf_k = rrf_k or config('HYBRID_SEARCH_RRF_K', default=60, cast=int)
+
+    def query(self, question: str, n_results: int = 3) -> dict:
+        vector_future = self.executor.submit(self.vector_db_client.query_documents, question, self.collection_name,
+                                             metadata_filter={}, n_results=max(n_results, self.candidates))
+        with span('lexical_query'):
+            lexical = self.index.search(question, self.app, n_results=max(n_results, self.candidates))
+        vector = vector_future.result()
+
+        documents = {}
+        for position, document_id in enumerate(vector['ids'][0] if vector['ids'] else []):
+            documents[document_id] = {
+                'document': vector['documents'][0][position],
+                'metadata': vector['metadatas'][0][position],
+                'distance': vector['distances'][0][position],
+            }
+        for document_id, _, metadata in lexical:
+            documents.setdefault(document_id, {'document': None, 'metadata': metadata, 'distance': None})
+
+        fused = reciprocal_rank_fusion(
+            [vector['ids'][0] if vector['ids'] else [], [document_id for document_id, _, _ in lexical]], k=self.rrf_k
+        )[:n_results]
+
+        return {
+            'ids': [[document_id for document_id, _ in fused]],
+            'documents': [[documents[document_id]['document'] for document_id, _ in fused]],
+            'metadatas': [[documents[document_id]['metadata'] for document_id, _ in fused]],
+            'distances': [[documents[document_id]['distance'] for document_id, _ in fused]],
+            'scores': [[score for _, score in fused]],
+        }
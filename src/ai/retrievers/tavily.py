@@ -6,14 +6,14 @@ import os
 from decouple import config
 
 from langchain_community.tools import TavilySearchResults
-from langchain_community.document_loaders import WebBaseLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from ai.enums import DataType, DataSourceType
 from ai.retrievers.base import BaseRetriever
+from ai.retrievers.fetcher import PageFetcher
 
-from ai.vectorizers.chroma import ChromaClient
 from ai.vectorizers.base import VectorDBBaseClient
+from ai.vectorizers.factory import load_vector_db_client
 
 os.environ['TAVILY_API_KEY'] = config('TAVILY_API_KEY')
 
@@ -21,9 +21,13 @@ os.environ['TAVILY_API_KEY'] = config('TAVILY_API_KEY')
 class TavilyRetriever(BaseRetriever):
     APP = 'TAVILY'
 
+    def __init__(self, *args, fetcher: PageFetcher = None, **kwargs):
+        super(TavilyRetriever, self).__init__(*args, **kwargs)
+        self.fetcher = fetcher or PageFetcher()
+
     def load_vectordb_client(self, host: str = None, port: int = None,
                              load_from_config: bool = True) -> VectorDBBaseClient:
-        client = ChromaClient(host=host, port=port, load_from_config=load_from_config)
+        client = load_vector_db_client(host=host, port=port, load_from_config=load_from_config)
 
         return client
 
@@ -36,19 +40,17 @@ class TavilyRetriever(BaseRetriever):
         results = research_tool.invoke({'query': subject})
         splits = []
 
-        # Now let's chunk the provided data and store them in the vector store
-        for result in results:
-            loader = WebBaseLoader(web_path=[result['url']])
-
-            docs = loader.load()
-
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-            documents = text_splitter.split_documents(docs)
+        # Now let's chunk the provided data and store them in the vector store. The pages are split as soon as they
+        # are downloaded, while the others are still being fetched
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
+        for doc in self.fetcher.fetch_all([result['url'] for result in results]):
+            url = doc.metadata['source']
+            documents = text_splitter.split_documents([doc])
             for index, split in enumerate(documents):
                 split.metadata.update(
                     {
-                        'title': f'Split {index} of {result["url"]}',
-                        'link': result['url']
+                        'title': f'Split {index} of {url}',
+                        'link': url
                     }
                 )
 
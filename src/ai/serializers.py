@@ -1,5 +1,8 @@
 from rest_framework import serializers
 
+from core.models import Ticket
+from core.models import Comment
+
 from ai.models import AITemporalComment
 
 from ai.services import AITemporalCommentService
@@ -15,13 +18,25 @@ class AITemporalCommentSerializer(serializers.ModelSerializer):
         fields = ('id', 'ticket', 'comment', 'content', 'created_at', 'app', 'is_validated')
 
     def update(self, instance, validated_data):
-        tmp_comment = super(AITemporalCommentSerializer, self).update(instance, validated_data)
-
-        service = AITemporalCommentService(tmp_comment=tmp_comment)
-        service.update(validated_data)
+        # The service only writes the fields sent by the client
+        service = AITemporalCommentService(tmp_comment=instance)
 
-        return tmp_comment
+        return service.update(validated_data)
 
 
 class RetrieverSerializer(serializers.Serializer):
-    subject = serializers.CharField()
\ No newline at end of file
+    subject = serializers.CharField()
+
+
+class ProposalStreamSerializer(serializers.Serializer):
+    ticket = serializers.IntegerField()
+    comment = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if not Ticket.objects.filter(id=attrs['ticket']).exists():
+            raise serializers.ValidationError(f"Ticket {attrs['ticket']} doesn't exist")
+
+        if attrs.get('comment') and not Comment.objects.filter(id=attrs['comment'], ticket_id=attrs['ticket']).exists():
+            raise serializers.ValidationError(f"Comment {attrs['comment']} doesn't exist on ticket {attrs['ticket']}")
+
+        return attrs
@@ -1,16 +1,27 @@
 import logging
+from datetime import timedelta
+
+from django.db.models import F
 from django.utils import timezone
 from django.db import transaction
 from django.core.exceptions import ValidationError
 
+from decouple import config
+
 from traceback_with_variables import format_exc
 
+from ai.models import AIGenerationJob
 from ai.models import AITemporalComment
+
+from ai.enums import JobStatus
 from core.enums import TicketEvent
 
 from core.models import Comment
 from core.models import TicketHistory
+from core.metrics import generation_jobs
+from core.instrumentation import span
 
+from ai.cache import semantic_cache
 from ai.utils import handling_ai_validation_email_to_customer
 
 
@@ -23,21 +34,28 @@ class AITemporalCommentService:
         pass
 
     @transaction.atomic()
-    def update(self, data):
+    def update(self, data) -> AITemporalComment:
+        """
+            Save the changed fields of the proposal, and publish it as comment if it's validated
+        """
+        fields = [field.name for field in AITemporalComment._meta.concrete_fields
+                  if field.name in data and not field.primary_key]
+        for name in fields:
+            setattr(self.tmp_comment, name, data[name])
+        self.tmp_comment.save(update_fields=fields)
+
         try:
             if data.get('is_validated') is True:
                 # Means that the proposal is going to be validated, so create the corresponding comment
                 ai_comment = Comment.objects.create(
                     ticket=self.tmp_comment.ticket if self.tmp_comment.ticket else self.tmp_comment.comment.ticket,
                     content=self.tmp_comment.content,
-                    created_by=data.get('created_by'),
-                    role='agent'
+                    created_by=data.get('created_by')
                 )
 
                 ticket = ai_comment.ticket
-                ticket.updated_at = timezone.now()
                 ticket.last_reply_at = timezone.now()
-                ticket.save()
+                ticket.save(update_fields=['last_reply_at'])
 
                 TicketHistory.objects.create(
                     ticket=ai_comment.ticket,
@@ -45,6 +63,10 @@ class AITemporalCommentService:
                     event=TicketEvent.COMMENT_ADDED
                 )
 
+                # The validated answer can be proposed again for the similar questions
+                if not self.tmp_comment.is_cache_derived:
+                    transaction.on_commit(self.store_in_semantic_cache)
+
                 r = handling_ai_validation_email_to_customer(ai_comment.id)
                 if not r:
                     self.logger.warning(
@@ -52,3 +74,136 @@ class AITemporalCommentService:
         except Exception as e:
             self.logger.error(format_exc(e))
             raise ValidationError(f'Unable to handle update of the AI proposal #{self.tmp_comment.id}')
+
+        return self.tmp_comment
+
+    def store_in_semantic_cache(self) -> None:
+        try:
+            semantic_cache.store(
+                question=self.tmp_comment.get_question(),
+                answer=self.tmp_comment.content,
+                app=self.tmp_comment.app,
+                proposal=self.tmp_comment
+            )
+        except Exception as e:
+            self.logger.error(format_exc(e))
+
+
+class AIGenerationJobService:
+    """
+        DB backed queue of the AI response generations. Jobs are enqueued once the transaction which created the
+        ticket or the comment is committed, then processed by the `run_ai_worker` command.
+        A running job is leased to its worker, which refreshes `heartbeat_at` while it runs: the job is only queued
+        again once its lease expired. The worker which lost the lease of a job can't update it anymore.
+    """
+    RETRY_BACKOFF = config('AI_JOB_RETRY_BACKOFF', default=30, cast=int)
+    MAX_ATTEMPTS = config('AI_JOB_MAX_ATTEMPTS', default=5, cast=int)
+    LEASE = config('AI_JOB_LEASE', default=60, cast=int)
+
+    def __init__(self, job: AIGenerationJob = None):
+        self.job = job
+        self.logger = logging.getLogger('llm')
+
+    @classmethod
+    def enqueue(cls, ticket_id: int, comment_id: int = None) -> None:
+        def create_job():
+            AIGenerationJob.objects.create(ticket_id=ticket_id, comment_id=comment_id, max_attempts=cls.MAX_ATTEMPTS)
+
+        transaction.on_commit(create_job)
+
+    @classmethod
+    def claim(cls) -> AIGenerationJob | None:
+        """
+            Lock the next due job for the current worker, concurrent workers skip the rows already locked
+        """
+        now = timezone.now()
+
+        with transaction.atomic():
+            job = (
+                AIGenerationJob.objects.select_for_update(skip_locked=True)
+                .filter(status=JobStatus.PENDING, run_after__lte=now)
+                .order_by('run_after', 'id')
+                .first()
+            )
+            if job is None:
+                return None
+
+            AIGenerationJob.objects.filter(pk=job.pk).update(
+                status=JobStatus.RUNNING, attempts=F('attempts') + 1, locked_at=now, heartbeat_at=now, updated_at=now
+            )
+            job.status = JobStatus.RUNNING
+            job.attempts += 1
+            job.locked_at = job.heartbeat_at = now
+
+        return job
+
+    @classmethod
+    def heartbeat(cls, job_ids: list[int]) -> int:
+        """
+            Renew the lease of the jobs run by the workers of the process
+        """
+        if not job_ids:
+            return 0
+
+        return AIGenerationJob.objects.filter(id__in=job_ids, status=JobStatus.RUNNING).update(
+            heartbeat_at=timezone.now()
+        )
+
+    @classmethod
+    def requeue_stale(cls, lease: int = None) -> int:
+        """
+            Give back to the queue the running jobs whose lease expired, their worker died
+        """
+        limit = timezone.now() - timedelta(seconds=lease or cls.LEASE)
+
+        return AIGenerationJob.objects.filter(status=JobStatus.RUNNING, heartbeat_at__lt=limit).update(
+            status=JobStatus.PENDING, locked_at=None, heartbeat_at=None, updated_at=timezone.now()
+        )
+
+    def run(self) -> bool:
+        from ai.llm import handling_response_generation
+
+        def complete():
+            # Saved with the proposal, a job whose proposal is saved is never run again
+            if not self._update(status=JobStatus.SUCCEEDED, locked_at=None, heartbeat_at=None, last_error=''):
+                raise RuntimeError(f'The lease of generation job #{self.job.id} expired, it was queued again')
+
+        try:
+            with span('generation_job'):
+                succeeded = handling_response_generation(self.job.ticket_id, self.job.comment_id,
+                                                         is_comment=self.job.is_comment, on_saved=complete)
+            error = '' if succeeded else 'The generation failed, see the llm logs for details'
+        except Exception as e:
+            self.logger.error(format_exc(e))
+            succeeded, error = False, str(e)
+
+        generation_jobs.inc(status='succeeded' if succeeded else 'failed')
+
+        if succeeded:
+            if self.job.status != JobStatus.SUCCEEDED:
+                # The proposal was already saved, by a previous run of the job
+                self._update(status=JobStatus.SUCCEEDED, locked_at=None, heartbeat_at=None, last_error='')
+        elif self.job.attempts >= self.job.max_attempts:
+            self.logger.error(f'Generation job #{self.job.id} failed after {self.job.attempts} attempts')
+            self._update(status=JobStatus.FAILED, locked_at=None, heartbeat_at=None, last_error=error)
+        else:
+            # Exponential backoff: 1x, 2x, 4x, ... the base delay
+            delay = self.RETRY_BACKOFF * 2 ** (self.job.attempts - 1)
+            self.logger.warning(f'Generation job #{self.job.id} failed, retrying in {delay}s')
+            self._update(status=JobStatus.PENDING, locked_at=None, heartbeat_at=None, last_error=error,
+                         run_after=timezone.now() + timedelta(seconds=delay))
+
+        return succeeded
+
+    def _update(self, **fields) -> int:
+        """
+            :return: 0 when the job is not leased to this worker anymore, it's left unchanged
+        """
+        updated = AIGenerationJob.objects.filter(pk=self.job.pk, locked_at=self.job.locked_at).update(
+            updated_at=timezone.now(), **fields
+        )
+        if updated:
+            for name, value in fields.items():
+                setattr(self.job, name, value)
+
+        return updated
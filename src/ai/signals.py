@@ -0,0 +1,30 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+
+from ai.models import AIResource
+from ai.models import AISemanticCacheEntry
+
+from ai.cache import semantic_cache
+from ai.cache import generation_cache
+
+from ai.retrievers.hybrid import lexical_index
+
+
+@receiver(post_delete, sender=AISemanticCacheEntry)
+def reset_semantic_cache(sender, instance, **kwargs):
+    semantic_cache.reset(instance.app)
+
+
+@receiver(post_save, sender=AIResource)
+def invalidate_generation_cache_on_update(sender, instance, created, **kwargs):
+    generation_cache.invalidate(instance.app)
+    # The lexical index adds the new documents itself
+    if not created:
+        lexical_index.invalidate(instance.app)
+
+
+@receiver(post_delete, sender=AIResource)
+def invalidate_generation_cache_on_delete(sender, instance, **kwargs):
+    generation_cache.invalidate(instance.app)
+    lexical_index.invalidate(instance.app)
@@ -0,0 +1,233 @@
+import time
+import threading
+from unittest import mock
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from django.test import TestCase
+from django.test import SimpleTestCase
+from django.contrib.auth import get_user_model
+
+from core.models import Ticket
+from core.models import Comment
+from core.models import OutboxEmail
+
+from ai import llm
+from ai.models import AITemporalComment
+from ai.retrievers.fetcher import PageFetcher
+
+User = get_user_model()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+        /page?delay=s: page answered after `delay` seconds
+        /drip: page sent one byte every 0.1s, for 5s
+        /huge: page announcing more bytes than the fetcher accepts
+        /stream: page bigger than the fetcher accepts, without Content-Length
+        /error: server error
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        host = self.headers['Host']
+        server = self.server
+
+        with server.lock:
+            server.running[host] = server.running.get(host, 0) + 1
+            server.max_running[host] = max(server.max_running.get(host, 0), server.running[host])
+            server.max_total = max(server.max_total, sum(server.running.values()))
+        try:
+            if url.path == '/page':
+                time.sleep(float(parse_qs(url.query).get('delay', ['0'])[0]))
+                self.send_page(f'<html lang="en"><title>{url.query}</title><body>Page</body></html>'.encode())
+            elif url.path == '/drip':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for _ in range(50):
+                    self.wfile.write(b'x')
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            elif url.path == '/huge':
+                self.send_response(200)
+                self.send_header('Content-Length', str(10 * 1024 * 1024))
+                self.end_headers()
+            elif url.path == '/stream':
+                self.send_response(200)
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for _ in range(64):
+                    self.wfile.write(b'x' * 64 * 1024)
+            else:
+                self.send_error(500)
+        except (BrokenPipeError, ConnectionResetError):
+            # Closed by the fetcher
+            pass
+        finally:
+            with server.lock:
+                server.running[host] -= 1
+
+    def send_page(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PageFetcherTestCase(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.server.daemon_threads = True
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.port = cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.running = {}
+        self.server.max_running = {}
+        self.server.max_total = 0
+
+    def url(self, path: str, host: str = '127.0.0.1') -> str:
+        return f'http://{host}:{self.port}{path}'
+
+    def fetch(self, fetcher: PageFetcher, urls: list[str]) -> list:
+        return sorted(list(fetcher.fetch_all(urls)), key=lambda document: document.metadata['source'])
+
+    def test_concurrency_cap(self):
+        fetcher = PageFetcher(max_workers=3, max_per_host=10)
+        urls = [self.url(f'/page?delay=0.3&n={index}') for index in range(9)]
+
+        started_at = time.monotonic()
+        documents = self.fetch(fetcher, urls)
+
+        self.assertEqual(len(documents), 9)
+        self.assertEqual(self.server.max_total, 3)
+        # 3 rounds of 3 pages
+        self.assertLess(time.monotonic() - started_at, 0.3 * 9 / 2)
+
+    def test_per_host_limit(self):
+        fetcher = PageFetcher(max_workers=8, max_per_host=2)
+        urls = [self.url(f'/page?delay=0.3&n={index}', host=host) for host in ('127.0.0.1', 'localhost')
+                for index in range(4)]
+
+        documents = self.fetch(fetcher, urls)
+
+        self.assertEqual(len(documents), 8)
+        self.assertEqual(self.server.max_running, {f'127.0.0.1:{self.port}': 2, f'localhost:{self.port}': 2})
+        # The limit is per host, both hosts are fetched at the same time
+        self.assertEqual(self.server.max_total, 4)
+
+    def test_busy_host_does_not_block_the_others(self):
+        fetcher = PageFetcher(max_workers=2, max_per_host=1)
+        urls = [self.url(f'/page?delay=0.3&n={index}') for index in range(3)] + \
+               [self.url('/page?n=other', host='localhost'), self.url('/page?delay=0.3&n=4')]
+
+        started_at = time.monotonic()
+        documents = fetcher.fetch_all(urls)
+        first = next(documents)
+        waited = time.monotonic() - started_at
+        documents = [first] + list(documents)
+
+        # The page of the other host is fetched with the first one of the busy host, not after all of them
+        self.assertEqual(first.metadata['title'], 'n=other')
+        self.assertLess(waited, 0.3)
+        self.assertEqual(len(documents), 5)
+        self.assertEqual(self.server.max_running[f'127.0.0.1:{self.port}'], 1)
+
+    def test_timeouts(self):
+        fetcher = PageFetcher(max_workers=4, connect_timeout=1, read_timeout=0.5)
+
+        started_at = time.monotonic()
+        # No answer within the read timeout, then an answer too slow to be read within the read timeout
+        documents = self.fetch(fetcher, [self.url('/page?delay=2'), self.url('/drip'), self.url('/page?n=1')])
+
+        self.assertEqual([document.metadata['title'] for document in documents], ['n=1'])
+        self.assertLess(time.monotonic() - started_at, 1.5)
+
+    def test_partial_failures(self):
+        fetcher = PageFetcher(max_workers=8, max_bytes=1024 * 1024)
+        urls = [self.url('/page?n=1'), self.url('/error'), self.url('/huge'), self.url('/stream'),
+                f'http://127.0.0.1:{self.port + 1 if self.port < 65535 else 1}/refused', self.url('/page?n=2')]
+
+        documents = self.fetch(fetcher, urls)
+
+        self.assertEqual([document.metadata['title'] for document in documents], ['n=1', 'n=2'])
+        self.assertEqual(documents[0].metadata['language'], 'en')
+        self.assertEqual(documents[0].page_content, 'n=1Page')
+
+    def test_no_urls(self):
+        self.assertEqual(list(PageFetcher().fetch_all([])), [])
+
+
+@mock.patch.object(llm.semantic_cache, 'lookup', lambda question, app: (None, None))
+@mock.patch.object(llm, 'stream_answer', lambda question, ticket_id, app_name=None: iter(['Streamed ', 'answer']))
+@mock.patch.object(llm, 'propose_answer', lambda question, ticket_id, app_name=None: ('Generated answer', {}))
+class ProposalGenerationTestCase(TestCase):
+    """
+        The queued generation and the streamed one save a single proposal per ticket or comment, and notify the agents
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com')
+        cls.agent = User.objects.create_user('agent', 'agent@example.com', is_staff=True)
+        cls.ticket = Ticket.objects.create(title='Ticket', description='Description', open_by=cls.customer)
+        cls.comment = Comment.objects.create(ticket=cls.ticket, content='Question', created_by=cls.customer)
+
+    def stream(self, comment_id: int = None) -> list:
+        return list(llm.stream_response_generation(self.ticket.id, comment_id))
+
+    def test_stream_then_job(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            events = self.stream(self.comment.id)
+
+        self.assertEqual(events[:-1], [('token', 'Streamed '), ('token', 'answer')])
+        self.assertEqual(events[-1][1].content, 'Streamed answer')
+        self.assertEqual(OutboxEmail.objects.filter(recipient=self.agent.email).count(), 1)
+
+        on_saved = mock.Mock()
+        self.assertTrue(llm.handling_response_generation(self.ticket.id, self.comment.id, is_comment=True,
+                                                         on_saved=on_saved))
+        self.assertEqual(AITemporalComment.objects.filter(comment=self.comment).count(), 1)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+    def test_job_then_stream(self):
+        on_saved = mock.Mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(llm.handling_response_generation(self.ticket.id, None, is_comment=False,
+                                                             on_saved=on_saved))
+
+        on_saved.assert_called_once()
+        self.assertEqual(OutboxEmail.objects.filter(recipient=self.agent.email).count(), 1)
+
+        events = self.stream()
+        self.assertEqual(events, [('token', 'Generated answer'), ('done', events[-1][1])])
+        self.assertEqual(AITemporalComment.objects.filter(ticket=self.ticket, comment__isnull=True).count(), 1)
+
+    def test_proposal_saved_meanwhile(self):
+        existing = AITemporalComment.objects.create(ticket=self.ticket, content='First')
+        on_saved = mock.Mock()
+
+        proposal = llm.save_proposal(AITemporalComment(ticket=self.ticket, content='Second'), on_saved=on_saved)
+
+        self.assertEqual(proposal, existing)
+        on_saved.assert_called_once()
+        self.assertEqual(AITemporalComment.objects.filter(ticket=self.ticket).count(), 1)
+        self.assertFalse(OutboxEmail.objects.exists())
@@ -1,4 +1,7 @@
 import logging
+
+from bs4 import BeautifulSoup
+
 from traceback_with_variables import format_exc
 
 logger = logging.getLogger()
@@ -6,16 +9,19 @@ logger = logging.getLogger()
 
 def handling_ai_validation_email_to_customer(comment_id: int):
     """
-        The aim of this task is to send back the response to the customer who created the request initially
+        The aim of this task is to send back the response to the customer who created the request initially.
+        The email is queued in the outbox once the validation is committed.
     """
     from core.models import Comment
-    from core.utils import send_simple_mail
+    from core.enums import EmailKind
+    from core.services import EmailOutboxService
 
     try:
-        comment = Comment.objects.get(id=comment_id)
+        comment = Comment.objects.select_related('ticket').get(id=comment_id)
 
         subject = f"Re: {comment.ticket.title}"
-        send_simple_mail(to=comment.ticket.open_by_email, subject=subject, message=comment.content)
+        EmailOutboxService.queue(comment.ticket.open_by_email, subject=subject, message=comment.content,
+                                 kind=EmailKind.REPLY)
 
         return True
     except Comment.DoesNotExist as e:
@@ -24,3 +30,10 @@ def handling_ai_validation_email_to_customer(comment_id: int):
     except Exception as e:
         logger.error(format_exc(e))
         return False
+
+
+def strip_html(text: str) -> str:
+    """
+        Get the plain text of a CKEditor content
+    """
+    return BeautifulSoup(text or '', 'html.parser').get_text(' ', strip=True)
@@ -10,28 +10,46 @@ from typing import List
 
 from decouple import config
 
+from .embeddings import query_embedding_cache
+from .embeddings import get_embedding_function
+
 
 class VectorDBBaseClient(abc.ABC):
     DEFAULT_EMBEDDING = None
     NAME = ''
+    # Embedding model used by the client, shared process wide through the embedding registry
+    EMBEDDING_MODEL = None
+    EMBEDDING_DEVICE = None
+    # False for the stores running in the process, which have no host and port to configure
+    REQUIRES_SERVER = True
 
     def __init__(self, host: str = None, port: int = None, load_from_config: bool = True):
         self.logger = logging.getLogger('vectorizer')
-        if not host and not port and not load_from_config:
+        if not self.REQUIRES_SERVER:
+            self.host = None
+            self.port = None
+        elif not host and not port and not load_from_config:
             self.logger.warning("You can't set `load_from_config=False` and not set host and port")
             raise ValueError("You can't set `load_from_config=False` and not set host and port")
-
-        if load_from_config:
+        elif load_from_config:
             self.host = config(f'{self.NAME}_HOST')
             self.port = config(f'{self.NAME}_PORT', cast=int)
         else:
             self.host = host
             self.port = port
 
+        self.DEFAULT_EMBEDDING = get_embedding_function(self.EMBEDDING_MODEL, self.EMBEDDING_DEVICE)
+
     def save_documents(self, documents: list[str], collection: str | object, ids: list[str], metadata: list[dict],
-                       create_or_update: bool = False) -> bool:
+                       create_or_update: bool = False, embeddings: list = None) -> bool:
         raise NotImplemented()
 
+    def embed_queries(self, queries: list[str]) -> list:
+        """
+            Embed the queries on the client side, through the process wide LRU cache of the query embeddings
+        """
+        return query_embedding_cache.embed(queries, self.EMBEDDING_MODEL, self.EMBEDDING_DEVICE)
+
     def query_documents(self, query: str | List[str], collection: str, metadata_filter: dict,
                         n_result: int = 5) -> dict:
         pass
@@ -54,5 +72,8 @@ class VectorDBBaseClient(abc.ABC):
     def count(self, collection: str) -> int:
         pass
 
+    def delete_collection(self, name: str) -> None:
+        pass
+
     def reset_db(self) -> None:
         pass
@@ -1,15 +1,100 @@
 from __future__ import annotations
 
+import time
+import logging
+import threading
+
 import chromadb
-from chromadb.utils import embedding_functions
 
 from traceback_with_variables import format_exc
 
 from decouple import config
 
+from core.instrumentation import span
+
 from .base import VectorDBBaseClient
 
 
+class ChromaClientPool:
+    """
+        Keep one long-lived HTTP client per (host, port, token) for the whole process, so that the underlying
+        keep-alive connections are reused, and cache the collection handles to avoid a `get_or_create_collection`
+        round trip before each query.
+    """
+
+    def __init__(self, collection_ttl: int = 300):
+        self.logger = logging.getLogger('vectorizer')
+        self.collection_ttl = collection_ttl
+        self._clients = {}
+        self._collections = {}
+        self._lock = threading.Lock()
+        self.clients_created = 0
+        self.client_reuses = 0
+        self.collection_hits = 0
+        self.collection_misses = 0
+
+    def get_client(self, host: str, port: int, token: str) -> chromadb.HttpClient:
+        key = (host, port, token)
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.client_reuses += 1
+                return client
+
+            client = chromadb.HttpClient(host, port, headers={'X-Chroma-Token': token})
+            self._clients[key] = client
+            self.clients_created += 1
+            self.logger.info(f'Chroma client initialized, running at {host}:{port}')
+
+        return client
+
+    def get_collection(self, key: tuple, name: str, factory: callable) -> chromadb.Collection:
+        """
+            Return the cached collection handle, calling `factory` (a round trip to the server) only when the handle
+            is missing or expired
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            cached = self._collections.get((key, name))
+            if cached is not None and cached[1] > now:
+                self.collection_hits += 1
+                return cached[0]
+            self.collection_misses += 1
+
+        collection = factory()
+
+        with self._lock:
+            self._collections[(key, name)] = (collection, now + self.collection_ttl)
+
+        return collection
+
+    def invalidate(self, key: tuple, name: str = None) -> None:
+        with self._lock:
+            if name is not None:
+                self._collections.pop((key, name), None)
+            else:
+                for cached_key in [k for k in self._collections if k[0] == key]:
+                    del self._collections[cached_key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'clients_created': self.clients_created,
+                'client_reuses': self.client_reuses,
+                'cached_collections': len(self._collections),
+                'collection_hits': self.collection_hits,
+                'collection_misses': self.collection_misses,
+                # Each hit is a `get_or_create_collection` request which has not been sent to the server
+                'round_trips_saved': self.collection_hits,
+            }
+
+
+chroma_pool = ChromaClientPool(collection_ttl=config('CHROMA_COLLECTION_TTL', default=300, cast=int))
+
+
 class ChromaClient(VectorDBBaseClient):
     DEFAULT_EMBEDDING = None
     NAME = 'CHROMA'
@@ -17,32 +102,34 @@ class ChromaClient(VectorDBBaseClient):
     def __init__(self, host: str = None, port: int = None, load_from_config: bool = True):
         super(ChromaClient, self).__init__(host, port, load_from_config)
 
-        self.DEFAULT_EMBEDDING = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name='paraphrase-multilingual-MiniLM-L12-v2')
+        self.pool_key = (self.host, self.port, config('CHROMA_TOKEN'))
         try:
-            self.client = chromadb.HttpClient(self.host, self.port, headers={
-                'X-Chroma-Token': config('CHROMA_TOKEN')})
-            self.logger.info(f'Chroma client initialized, running at {config("CHROMA_HOST")}:{config("CHROMA_PORT")}')
+            self.client = chroma_pool.get_client(*self.pool_key)
         except Exception:
-            raise ValueError(f'Unable to initialize Chroma client at {config("CHROMA_HOST")}:{config("CHROMA_PORT")}')
+            raise ValueError(f'Unable to initialize Chroma client at {self.host}:{self.port}')
 
     def get_collection(self, name: str) -> chromadb.Collection:
-        return self.client.get_or_create_collection(name)
+        return self.get_or_create_collection(name)
 
     def save_documents(self, documents: list[str], collection: str | chromadb.Collection, ids: list[str],
-                       metadata: list[dict], create_or_update=False) -> None:
+                       metadata: list[dict], create_or_update=False, embeddings: list = None) -> None:
+        """
+            Save the documents in the collection, the embeddings are computed by the collection when not provided
+        """
         collection = self.get_or_create_collection(collection) if isinstance(collection, str) else collection
 
         self.logger.info(f'Saving {len(documents)} documents to {collection.name}')
         if create_or_update:
             collection.upsert(
                 documents=documents,
+                embeddings=embeddings,
                 metadatas=metadata,
                 ids=ids
             )
         else:
             collection.add(
                 documents=documents,
+                embeddings=embeddings,
                 metadatas=metadata,
                 ids=ids
             )
@@ -50,11 +137,13 @@ class ChromaClient(VectorDBBaseClient):
     def query_documents(self, query: str | list[str], collection: str | chromadb.Collection, metadata_filter: dict,
                         n_results: int = 5) -> dict:
         collection = self.get_collection(collection) if isinstance(collection, str) else collection
-        result = collection.query(
-            query_texts=[query] if isinstance(query, str) else query,
-            where=metadata_filter,
-            n_results=n_results
-        )
+        query_embeddings = self.embed_queries([query] if isinstance(query, str) else query)
+        with span('vector_query'):
+            result = collection.query(
+                query_embeddings=query_embeddings,
+                where=metadata_filter,
+                n_results=n_results
+            )
 
         return result
 
@@ -62,18 +151,33 @@ class ChromaClient(VectorDBBaseClient):
                                  embedding_function: callable = None) -> chromadb.Collection:
         embedding_function = embedding_function or self.DEFAULT_EMBEDDING
 
-        if not metadata:
-            collection = self.client.get_or_create_collection(
-                name=name,
-                embedding_function=embedding_function
-            )
-        else:
-            collection = self.client.get_or_create_collection(
+        def load_collection():
+            if not metadata:
+                return self.client.get_or_create_collection(
+                    name=name,
+                    embedding_function=embedding_function
+                )
+
+            return self.client.get_or_create_collection(
                 name=name,
                 metadata=metadata,
                 embedding_function=embedding_function
             )
 
+        # Only handles bound to the shared embedding model are cached, a custom one is always fetched
+        if embedding_function is not self.DEFAULT_EMBEDDING:
+            return load_collection()
+
+        return chroma_pool.get_collection(self.pool_key, name, load_collection)
+
+    def update_collection(self, name: str, data: dict) -> chromadb.Collection:
+        collection = self.get_collection(name)
+        collection.modify(**data)
+
+        chroma_pool.invalidate(self.pool_key, name)
+        if data.get('name'):
+            chroma_pool.invalidate(self.pool_key, data['name'])
+
         return collection
 
     def client_healthcheck(self) -> bool:
@@ -85,9 +189,15 @@ class ChromaClient(VectorDBBaseClient):
             return False
 
     def count(self, collection: str | chromadb.Collection) -> int:
-        collection = self.get_collection(collection)
+        collection = self.get_collection(collection) if isinstance(collection, str) else collection
 
         return collection.count()
 
+    def delete_collection(self, name: str) -> None:
+        self.client.delete_collection(name)
+        chroma_pool.invalidate(self.pool_key, name)
+
     def reset_db(self) -> None:
         self.client.reset()
+        chroma_pool.invalidate(self.pool_key)
+
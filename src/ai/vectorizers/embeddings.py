@@ -0,0 +1,229 @@
+# This module holds the process wide registry of embedding models. Loading a SentenceTransformer model is slow  #
+# and allocates hundreds of MB, so every vectorizer and retriever of the process shares the same instances.     #
+#################################################################################################################
+
+from __future__ import annotations
+
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from chromadb.utils import embedding_functions
+
+from decouple import config
+
+DEFAULT_EMBEDDING_MODEL = config('EMBEDDING_MODEL', default='paraphrase-multilingual-MiniLM-L12-v2')
+DEFAULT_EMBEDDING_DEVICE = config('EMBEDDING_DEVICE', default='cpu')
+
+
+class EmbeddingModelRegistry:
+    """
+        Load each embedding model once per (model name, device) and hand out the same instance afterward.
+        The registry is thread safe: concurrent requests for a model which is not loaded yet wait for the
+        first loader instead of loading it twice.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('vectorizer')
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.reuses = 0
+
+    def get(self, model_name: str = None, device: str = None) -> callable:
+        key = (model_name or DEFAULT_EMBEDDING_MODEL, device or DEFAULT_EMBEDDING_DEVICE)
+
+        # Fast path, the model is already warm
+        model = self._models.get(key)
+        if model is not None:
+            with self._lock:
+                self.reuses += 1
+            return model
+
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            model = self._models.get(key)
+            if model is not None:
+                with self._lock:
+                    self.reuses += 1
+                return model
+
+            self.logger.info(f'Loading embedding model {key[0]} on {key[1]}')
+            model = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=key[0], device=key[1])
+
+            with self._lock:
+                self._models[key] = model
+                self.loads += 1
+
+        return model
+
+    def is_loaded(self, model_name: str = None, device: str = None) -> bool:
+        return (model_name or DEFAULT_EMBEDDING_MODEL, device or DEFAULT_EMBEDDING_DEVICE) in self._models
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'models': [f'{name}@{device}' for name, device in self._models],
+                'loads': self.loads,
+                'reuses': self.reuses,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+            self._locks.clear()
+            self.loads = 0
+            self.reuses = 0
+
+
+embedding_registry = EmbeddingModelRegistry()
+
+
+def get_embedding_function(model_name: str = None, device: str = None) -> callable:
+    return embedding_registry.get(model_name, device)
+
+
+class EmbeddingCache:
+    """
+        Persistent cache of the embeddings, keyed by (model name, sha256 of the text) in the AIEmbedding table.
+        The vectors are stored as float16, and the vectors computed by the model are rounded the same way, so that a
+        text always gets the same embedding whether it comes from the cache or not.
+    """
+
+    def __init__(self, enabled: bool = None, batch_size: int = None):
+        self.logger = logging.getLogger('vectorizer')
+        self.enabled = enabled if enabled is not None else config('EMBEDDING_CACHE_ENABLED', default=True, cast=bool)
+        self.batch_size = batch_size or config('EMBEDDING_CACHE_BATCH_SIZE', default=500, cast=int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def embed(self, texts: list[str], model_name: str = None, device: str = None) -> list[np.ndarray]:
+        """
+            Embed the texts, only the ones which aren't in the cache yet are sent to the model
+        """
+        from ai.models import AIEmbedding
+
+        embedding_function = get_embedding_function(model_name, device)
+        if not self.enabled:
+            return embedding_function(texts)
+
+        model_name = model_name or DEFAULT_EMBEDDING_MODEL
+        hashes = [self.hash(text) for text in texts]
+
+        vectors = {}
+        for start in range(0, len(hashes), self.batch_size):
+            vectors.update(
+                (text_hash, np.frombuffer(bytes(vector), dtype=np.float16).astype(np.float32))
+                for text_hash, vector in AIEmbedding.objects.filter(
+                    embedding_model=model_name, text_hash__in=hashes[start:start + self.batch_size]
+                ).values_list('text_hash', 'vector')
+            )
+
+        # The same text can appear several times in the batch
+        missing = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in vectors}
+        if missing:
+            computed = [np.asarray(vector, dtype=np.float32).astype(np.float16)
+                        for vector in embedding_function(list(missing.values()))]
+            # Rows written meanwhile by a concurrent ingestion are skipped by the unique constraint
+            AIEmbedding.objects.bulk_create([
+                AIEmbedding(embedding_model=model_name, text_hash=text_hash, vector=vector.tobytes())
+                for text_hash, vector in zip(missing, computed)
+            ], batch_size=self.batch_size, ignore_conflicts=True)
+            vectors.update((text_hash, vector.astype(np.float32)) for text_hash, vector in zip(missing, computed))
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        self.logger.info(f'{len(texts) - len(missing)} embeddings found in the cache, {len(missing)} computed')
+
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+embedding_cache = EmbeddingCache()
+
+
+class QueryEmbeddingCache:
+    """
+        Bounded LRU cache of the query embeddings, keyed by model, device and the text with its whitespaces normalized.
+        A question is embedded again each time its proposal is regenerated, retried or compared to the semantic
+        cache, with this cache the model is only called the first time.
+    """
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or config('QUERY_EMBEDDING_CACHE_SIZE', default=1024, cast=int)
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def embed(self, queries: list[str], model_name: str = None, device: str = None) -> list:
+        model_name = model_name or DEFAULT_EMBEDDING_MODEL
+        device = device or DEFAULT_EMBEDDING_DEVICE
+        keys = [(model_name, device, self.normalize(query)) for query in queries]
+
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                if key in self._vectors:
+                    self._vectors.move_to_end(key)
+                    vectors[key] = self._vectors[key]
+            self.hits += sum(1 for key in keys if key in vectors)
+            self.misses += sum(1 for key in keys if key not in vectors)
+
+        # Embedded outside the lock, the other queries don't wait for the model
+        missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+        if missing:
+            computed = get_embedding_function(model_name, device)([key[2] for key in missing])
+            with self._lock:
+                for key, vector in zip(missing, computed):
+                    vectors[key] = self._vectors[key] = vector
+                    self._vectors.move_to_end(key)
+                while len(self._vectors) > self.max_size:
+                    self._vectors.popitem(last=False)
+
+        return [vectors[key] for key in keys]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._vectors),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vectors.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+query_embedding_cache = QueryEmbeddingCache()
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from decouple import config
+
+from .base import VectorDBBaseClient
+from .chroma import ChromaClient
+from .numpy_index import NumpyVectorClient
+
+VECTOR_DB_CLIENTS = {
+    ChromaClient.NAME: ChromaClient,
+    NumpyVectorClient.NAME: NumpyVectorClient,
+}
+
+
+def load_vector_db_client(host: str = None, port: int = None, load_from_config: bool = True) -> VectorDBBaseClient:
+    """
+        Instantiate the vector store client selected by the `VECTOR_DB_BACKEND` setting (CHROMA or NUMPY)
+    """
+    backend = config('VECTOR_DB_BACKEND', default=ChromaClient.NAME).upper()
+    if backend not in VECTOR_DB_CLIENTS:
+        raise ValueError(f'Unknown vector store backend {backend}, available: {", ".join(VECTOR_DB_CLIENTS)}')
+
+    return VECTOR_DB_CLIENTS[backend](host=host, port=port, load_from_config=load_from_config)
@@ -0,0 +1,322 @@
+######################################################################################################
+#    In-process vector store for the small and medium knowledge bases: the embeddings of each       #
+#    collection are kept in a memory-mapped float32 matrix on the local disk and searched by brute  #
+#    force, which is faster than a network round trip to a vector database server                  #
+######################################################################################################
+
+from __future__ import annotations
+
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+
+from decouple import config
+
+from traceback_with_variables import format_exc
+
+from core.instrumentation import span
+
+from .base import VectorDBBaseClient
+
+
+def matches(metadata: dict, where: dict) -> bool:
+    """
+        Evaluate a Chroma `where` filter ($eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $and, $or) on a metadata
+    """
+    for key, condition in where.items():
+        if key == '$and':
+            if not all(matches(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(metadata, sub_filter) for sub_filter in condition):
+                return False
+        else:
+            value = metadata.get(key)
+            operators = condition if isinstance(condition, dict) else {'$eq': condition}
+            for operator, operand in operators.items():
+                try:
+                    if operator == '$eq' and not value == operand:
+                        return False
+                    if operator == '$ne' and not value != operand:
+                        return False
+                    if operator == '$gt' and not (value is not None and value > operand):
+                        return False
+                    if operator == '$gte' and not (value is not None and value >= operand):
+                        return False
+                    if operator == '$lt' and not (value is not None and value < operand):
+                        return False
+                    if operator == '$lte' and not (value is not None and value <= operand):
+                        return False
+                    if operator == '$in' and value not in operand:
+                        return False
+                    if operator == '$nin' and value in operand:
+                        return False
+                except TypeError:
+                    return False
+
+    return True
+
+
+class NumpyCollection:
+    """
+        Snapshot of a collection: a sidecar JSON file (ids, documents, metadatas) pointing to the generation of the
+        embeddings matrix it was written with. Writers never modify a generation, they write a new one and replace the
+        sidecar atomically, so the readers of any process always see a consistent snapshot.
+    """
+
+    def __init__(self, name: str, metadata: dict, ids: list, documents: list, metadatas: list,
+                 embeddings: np.ndarray | None, generation: str | None):
+        self.name = name
+        self.metadata = metadata
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.embeddings = embeddings
+        self.generation = generation
+
+    def count(self) -> int:
+        return len(self.ids)
+
+
+class NumpyVectorClient(VectorDBBaseClient):
+    NAME = 'NUMPY'
+    REQUIRES_SERVER = False
+
+    def __init__(self, host: str = None, port: int = None, load_from_config: bool = True, path: str = None):
+        super(NumpyVectorClient, self).__init__(host, port, load_from_config)
+
+        if path is None:
+            from django.conf import settings
+            path = config('NUMPY_INDEX_DIR', default='') or str(Path(settings.BASE_DIR) / 'vector_index')
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def _sidecar(self, name: str) -> Path:
+        return self.path / f'{name}.json'
+
+    def _matrix(self, name: str, generation: str) -> Path:
+        return self.path / f'{name}.{generation}.npy'
+
+    @contextmanager
+    def _write_lock(self, name: str):
+        """Serialize the writers of a collection, across processes"""
+        with open(self.path / f'{name}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self, name: str) -> NumpyCollection | None:
+        """
+            Return the current snapshot of the collection, reloaded only when another writer replaced it
+        """
+        sidecar = self._sidecar(name)
+        try:
+            stat = sidecar.stat()
+        except FileNotFoundError:
+            return None
+
+        # Each write replaces the sidecar by a new file
+        version = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._snapshots.get(name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        with open(sidecar) as file:
+            data = json.load(file)
+
+        embeddings = None
+        if data['generation']:
+            try:
+                embeddings = np.load(self._matrix(name, data['generation']), mmap_mode='r')
+            except FileNotFoundError:
+                # Two writes happened since the sidecar was read, read the new one
+                return self._load(name)
+
+        collection = NumpyCollection(name, data['metadata'], data['ids'], data['documents'], data['metadatas'],
+                                     embeddings, data['generation'])
+        with self._lock:
+            self._snapshots[name] = (version, collection)
+
+        return collection
+
+    def _write(self, name: str, metadata: dict, ids: list, documents: list, metadatas: list,
+               embeddings: np.ndarray | None, previous: NumpyCollection = None) -> NumpyCollection:
+        generation = None
+        if embeddings is not None and len(ids):
+            generation = uuid.uuid4().hex
+            tmp_matrix = self.path / f'.{name}.{generation}.npy'
+            np.save(tmp_matrix, np.ascontiguousarray(embeddings, dtype=np.float32))
+            os.replace(tmp_matrix, self._matrix(name, generation))
+
+        tmp_sidecar = self.path / f'.{name}.json'
+        with open(tmp_sidecar, 'w') as file:
+            json.dump({'name': name, 'metadata': metadata, 'generation': generation, 'ids': ids,
+                       'documents': documents, 'metadatas': metadatas}, file)
+        os.replace(tmp_sidecar, self._sidecar(name))
+
+        # The readers which already opened the previous generation keep their mapping, but the older ones are removed
+        keep = {generation, previous.generation if previous else None}
+        for matrix in self.path.glob(f'{name}.*.npy'):
+            if matrix.name.split('.')[-2] not in keep:
+                matrix.unlink(missing_ok=True)
+
+        return self._load(name)
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings[np.newaxis, :]
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+
+        return embeddings / norms
+
+    def get_client(self) -> NumpyVectorClient:
+        return self
+
+    def get_or_create_collection(self, name: str, metadata: dict = None,
+                                 embedding_function: callable = None) -> NumpyCollection:
+        collection = self._load(name)
+        if collection is not None:
+            return collection
+
+        with self._write_lock(name):
+            return self._load(name) or self._write(name, metadata or {}, [], [], [], None)
+
+    def get_collection(self, name: str) -> NumpyCollection:
+        return self.get_or_create_collection(name)
+
+    def save_documents(self, documents: list[str], collection: str | NumpyCollection, ids: list[str],
+                       metadata: list[dict], create_or_update=False, embeddings: list = None) -> None:
+        name = collection if isinstance(collection, str) else collection.name
+        self.logger.info(f'Saving {len(documents)} documents to {name}')
+
+        new_embeddings = self._normalize(embeddings if embeddings is not None else self.DEFAULT_EMBEDDING(documents))
+
+        with self._write_lock(name):
+            current = self._load(name) or self._write(name, {}, [], [], [], None)
+            positions = {document_id: index for index, document_id in enumerate(current.ids)}
+
+            all_ids, all_documents, all_metadatas = list(current.ids), list(current.documents), list(current.metadatas)
+            matrix = (np.array(current.embeddings) if current.embeddings is not None
+                      else np.empty((0, new_embeddings.shape[1]), dtype=np.float32))
+            appended = []
+
+            for index, document_id in enumerate(ids):
+                if document_id in positions:
+                    # Same as Chroma, `add` ignores the existing ids
+                    if create_or_update:
+                        position = positions[document_id]
+                        all_documents[position] = documents[index]
+                        all_metadatas[position] = metadata[index]
+                        matrix[position] = new_embeddings[index]
+                    continue
+
+                positions[document_id] = len(all_ids)
+                all_ids.append(document_id)
+                all_documents.append(documents[index])
+                all_metadatas.append(metadata[index])
+                appended.append(index)
+
+            if appended:
+                matrix = np.vstack([matrix, new_embeddings[appended]])
+
+            self._write(name, current.metadata, all_ids, all_documents, all_metadatas, matrix, previous=current)
+
+    def query_documents(self, query: str | list[str], collection: str | NumpyCollection, metadata_filter: dict,
+                        n_results: int = 5) -> dict:
+        queries = [query] if isinstance(query, str) else query
+
+        query_embeddings = self.embed_queries(queries)
+        with span('vector_query'):
+            return self.search(query_embeddings, collection, metadata_filter, n_results)
+
+    def search(self, query_embeddings: list, collection: str | NumpyCollection, metadata_filter: dict,
+               n_results: int = 5) -> dict:
+        """
+            Brute force cosine top-k, the result has the same format as the Chroma one
+        """
+        name = collection if isinstance(collection, str) else collection.name
+        collection = self._load(name)
+        queries = self._normalize(query_embeddings)
+        result = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+
+        if collection is None or collection.embeddings is None:
+            for _ in queries:
+                for values in result.values():
+                    values.append([])
+            return result
+
+        if metadata_filter:
+            rows = np.array([index for index, metadata in enumerate(collection.metadatas)
+                             if matches(metadata, metadata_filter)], dtype=np.int64)
+            matrix = collection.embeddings[rows]
+        else:
+            rows = None
+            matrix = collection.embeddings
+
+        k = min(n_results, matrix.shape[0])
+        similarities = queries @ matrix.T if k else np.empty((len(queries), 0), dtype=np.float32)
+
+        for scores in similarities:
+            top = np.argpartition(-scores, k - 1)[:k] if k else np.empty(0, dtype=np.int64)
+            top = top[np.argsort(-scores[top])]
+            positions = rows[top] if rows is not None else top
+
+            result['ids'].append([collection.ids[position] for position in positions])
+            result['documents'].append([collection.documents[position] for position in positions])
+            result['metadatas'].append([collection.metadatas[position] for position in positions])
+            result['distances'].append([float(1 - scores[index]) for index in top])
+
+        return result
+
+    def client_healthcheck(self) -> bool:
+        try:
+            return os.access(self.path, os.W_OK)
+        except Exception as e:
+            self.logger.error(format_exc(e))
+            return False
+
+    def update_collection(self, name: str, data: dict) -> NumpyCollection:
+        with self._write_lock(name):
+            current = self._load(name) or self._write(name, {}, [], [], [], None)
+            metadata = {**current.metadata, **data.get('metadata', {})}
+
+            return self._write(name, metadata, current.ids, current.documents, current.metadatas,
+                               current.embeddings, previous=current)
+
+    def count(self, collection: str | NumpyCollection) -> int:
+        name = collection if isinstance(collection, str) else collection.name
+        collection = self._load(name)
+
+        return collection.count() if collection else 0
+
+    def delete_collection(self, name: str) -> None:
+        with self._write_lock(name):
+            self._sidecar(name).unlink(missing_ok=True)
+            for matrix in self.path.glob(f'{name}.*.npy'):
+                matrix.unlink(missing_ok=True)
+
+        with self._lock:
+            self._snapshots.pop(name, None)
+
+    def reset_db(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        with self._lock:
+            self._snapshots.clear()
@@ -1,5 +1,10 @@
 import logging
 
+from django.db.models import Q
+from django.db.models import Avg
+from django.db.models import Count
+from django.http import StreamingHttpResponse
+
 from rest_framework import status
 from rest_framework import viewsets
 from rest_framework.response import Response
@@ -8,6 +13,7 @@ from rest_framework.exceptions import APIException
 from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import JSONRenderer
 
 from drf_yasg.utils import swagger_auto_schema
 
@@ -18,8 +24,21 @@ from core.pagination import PaginationWithTotalPage
 from ai.models import AITemporalComment
 from ai.serializers import AITemporalCommentSerializer
 from ai.serializers import RetrieverSerializer
+from ai.serializers import ProposalStreamSerializer
+
+from ai.llm import stream_response_generation
+
+from ai.renderers import format_event
+from ai.renderers import EventStreamRenderer
 
 from ai.retrievers.tavily import TavilyRetriever
+from ai.retrievers.hybrid import lexical_index
+
+from ai.cache import semantic_cache
+from ai.vectorizers.chroma import chroma_pool
+from ai.vectorizers.embeddings import embedding_cache
+from ai.vectorizers.embeddings import embedding_registry
+from ai.vectorizers.embeddings import query_embedding_cache
 
 
 logger = logging.getLogger()
@@ -28,9 +47,41 @@ class AITemporalCommentViewset(viewsets.ModelViewSet):
     queryset = AITemporalComment.objects.all()
     serializer_class = AITemporalCommentSerializer
     pagination_class = PaginationWithTotalPage
+    cursor_ordering = ('-created_at', '-id')
     http_method_names = ('get', 'patch')
     permission_classes = (IsAuthenticated, IsAdminUser)
 
+    @swagger_auto_schema(query_serializer=ProposalStreamSerializer)
+    @action(detail=False, methods=['get'], renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def stream(self, request, *args, **kwargs):
+        """
+        Generate the response proposal of a ticket, or of one of its comments, and stream its tokens as Server-Sent
+        Events. The proposal is saved once the generation is completed.
+        """
+        serializer = ProposalStreamSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        events = stream_response_generation(serializer.validated_data['ticket'],
+                                            serializer.validated_data.get('comment'))
+
+        response = StreamingHttpResponse(self.format_events(events), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Disable the proxy buffering (nginx) which would delay the first tokens
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
+    def format_events(self, events):
+        try:
+            for event, data in events:
+                if event == 'done':
+                    yield format_event(event, AITemporalCommentSerializer(data).data)
+                else:
+                    yield format_event(event, data)
+        except Exception as e:
+            logger.error(format_exc(e))
+            yield format_event('error', {'detail': 'Something went wrong while generating the proposal'})
+
 
 class AIManagementViewSet(viewsets.ViewSet):
     """
@@ -58,3 +109,38 @@ class AIManagementViewSet(viewsets.ViewSet):
         except Exception as e:
             logger.error(format_exc(e))
             raise APIException('Something went wrong while running the retrievers')
+
+    @action(detail=False, methods=['get'])
+    def embedding_models(self, request, *args, **kwargs):
+        """
+        Show the embedding models loaded in this process, how many times they were reused and the hit rates of the
+        embeddings caches
+        """
+        return Response({
+            **embedding_registry.stats(),
+            'cache': embedding_cache.stats(),
+            'query_cache': query_embedding_cache.stats()
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def vector_store(self, request, *args, **kwargs):
+        """
+        Show the usage of the pooled vector store clients, of the collection handles cache and the size of the lexical
+        indexes
+        """
+        return Response({**chroma_pool.stats(), 'lexical_indexes': lexical_index.stats()}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def answer_cache(self, request, *args, **kwargs):
+        """
+        Show the hit rate of the semantic cache and the similarities of the proposals, to tune the threshold
+        """
+        proposals = AITemporalComment.objects.filter(cache_similarity__isnull=False).aggregate(
+            proposals=Count('id'),
+            cache_derived=Count('id', filter=Q(is_cache_derived=True)),
+            average_similarity=Avg('cache_similarity'),
+            average_hit_similarity=Avg('cache_similarity', filter=Q(is_cache_derived=True)),
+            average_miss_similarity=Avg('cache_similarity', filter=Q(is_cache_derived=False)),
+        )
+
+        return Response({'process': semantic_cache.stats(), 'proposals': proposals}, status=status.HTTP_200_OK)
@@ -4,6 +4,9 @@ from pydantic_core.core_schema import model_field
 from core.models import Ticket
 from core.models import Comment
 from core.models import GlobalConfig
+from core.models import OutboxEmail
+from core.models import CacheVersion
+from core.models import TicketImport
 
 
 @admin.register(Ticket)
@@ -11,11 +14,29 @@ class TicketAdmin(admin.ModelAdmin):
     list_display = ('title', 'open_by', 'is_closed', 'created_at')
     list_filter = ('is_closed', 'is_draft', 'need_attention', 'ticket_type')
 
+
 @admin.register(Comment)
 class CommentAdmin(admin.ModelAdmin):
     list_display = ('ticket', 'created_by', 'created_at')
     list_filter = ('is_solution',)
 
+
 @admin.register(GlobalConfig)
 class GlobalConfigAdmin(admin.ModelAdmin):
-    pass
\ No newline at end of file
+    pass
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipient', 'kind', 'status', 'attempts', 'send_after')
+    list_filter = ('status', 'kind')
+
+
+@admin.register(CacheVersion)
+class CacheVersionAdmin(admin.ModelAdmin):
+    list_display = ('name', 'version', 'updated_at')
+
+
+@admin.register(TicketImport)
+class TicketImportAdmin(admin.ModelAdmin):
+    list_display = ('source', 'records', 'tickets', 'comments', 'skipped', 'ai_jobs', 'updated_at')
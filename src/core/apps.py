@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        import core.signals  # noqa: F401
+        from core.metrics import observe_span
+        from core.metrics import METRICS_ENABLED
+        from core.instrumentation import add_listener
+
+        if METRICS_ENABLED:
+            add_listener(observe_span)
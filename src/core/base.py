@@ -1,7 +1,34 @@
+from types import MappingProxyType
+
 from django.db import models
 
 
-class CustomEnum(object):
+class CustomEnumMeta(type):
+    """
+        Build the lookup tables of an enum once, when its class is created, from its upper case attributes
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(CustomEnumMeta, cls).__init__(name, bases, attrs)
+
+        names = [attr for attr in attrs if attr.isupper()]
+        cls._values_by_name = MappingProxyType({attr: attrs[attr] for attr in names})
+        cls._members_by_name = MappingProxyType({attr: cls.Enum(attr, attrs[attr], cls) for attr in names})
+
+        members_by_value = {}
+        for attr in names:
+            # The first member declared with a value wins, as in a scan of the class attributes
+            members_by_value.setdefault(attrs[attr], cls._members_by_name[attr])
+        cls._members_by_value = MappingProxyType(members_by_value)
+
+        # Tuples, shared by all the callers without being copied
+        cls._choices = tuple(sorted([(attrs[attr], attr) for attr in names], key=lambda x: x[0]))
+        cls._items = tuple(sorted([(attr, attrs[attr]) for attr in names], key=lambda x: x[1]))
+        cls._names_by_value = MappingProxyType(dict(cls._choices))
+        cls._display = ', '.join(names)
+
+
+class CustomEnum(object, metaclass=CustomEnumMeta):
     class Enum(object):
         name = None
         value = None
@@ -27,12 +54,10 @@ class CustomEnum(object):
 
     @classmethod
     def choices(cls):
-        attrs = [a for a in cls.__dict__.keys() if a.isupper()]
-        values = [
-            (cls.__dict__[v], CustomEnum.Enum(v, cls.__dict__[v], cls).__str__())
-            for v in attrs
-        ]
-        return sorted(values, key=lambda x: x[0])
+        """
+            Pairs (value, name), sorted by value
+        """
+        return cls._choices
 
     @classmethod
     def default(cls):
@@ -40,40 +65,34 @@ class CustomEnum(object):
         Returns default value, which is the first one by default.
         Override this method if you need another default value.
         """
-        return cls.choices()[0][0]
+        return cls._choices[0][0]
 
     @classmethod
     def get(cls, value):
         try:
             if type(value) is int:
-                return [
-                    CustomEnum.Enum(k, v, cls)
-                    for k, v in cls.__dict__.items()
-                    if k.isupper() and v == value
-                ][0]
-            key = value.upper()
-            return CustomEnum.Enum(key, cls.__dict__[key], cls)
+                return cls._members_by_value[value]
+            return cls._members_by_name[value.upper()]
         except Exception:
             return None
 
     @classmethod
     def key(cls, key):
         try:
-            return [value for name, value in cls.__dict__.items() if name == key.upper()][
-                0
-            ]
+            return cls._values_by_name[key.upper()]
         except Exception:
             return None
 
     @classmethod
     def get_counter(cls):
-        return {value: 0 for key, value in cls.__dict__.items() if key.isupper()}
+        return dict.fromkeys(cls._values_by_name.values(), 0)
 
     @classmethod
     def items(cls):
-        attrs = [a for a in cls.__dict__.keys() if a.isupper()]
-        values = [(v, cls.__dict__[v]) for v in attrs]
-        return sorted(values, key=lambda x: x[1])
+        """
+            Pairs (name, value), sorted by value
+        """
+        return cls._items
 
     @classmethod
     def is_valid_transition(cls, from_status, to_status):
@@ -87,18 +106,29 @@ class CustomEnum(object):
 
     @classmethod
     def get_name(cls, key):
-        choices_name = dict(cls.choices())
-        return choices_name.get(key)
+        return cls._names_by_value.get(key)
 
     @classmethod
     def display(cls):
-        attrs = [a for a in cls.__dict__.keys() if a.isupper()]
-        return ', '.join(attrs)
+        return cls._display
+
+
+class AutoDateTimeField(models.DateTimeField):
+    """
+        `auto_now` / `auto_now_add` date, except on the instances with `keep_dates` set, saved with the date they
+        hold. Used by the imports to write the dates of the previous helpdesk.
+    """
+
+    def pre_save(self, model_instance, add):
+        if getattr(model_instance, 'keep_dates', False):
+            return getattr(model_instance, self.attname)
+
+        return super().pre_save(model_instance, add)
 
 
 class BaseModel(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    created_at = AutoDateTimeField(auto_now_add=True)
+    updated_at = AutoDateTimeField(auto_now=True)
 
     class Meta:
         abstract = True
@@ -111,9 +141,19 @@ class BaseModel(models.Model):
             using=None,
             update_fields=None,
     ):
-        self.full_clean()
+        if update_fields is None:
+            self.full_clean()
+        else:
+            # Partial save: only the given fields are validated and written, plus the `auto_now` ones
+            update_fields = set(update_fields)
+            if update_fields:
+                update_fields |= {
+                    field.name for field in self._meta.concrete_fields if getattr(field, 'auto_now', False)
+                }
+            self.clean_fields(exclude=[field.name for field in self._meta.fields if field.name not in update_fields])
+
         super().save(*args,
-                     force_insert=False,
-                     force_update=False,
-                     using=None,
-                     update_fields=None, )
+                     force_insert=force_insert,
+                     force_update=force_update,
+                     using=using,
+                     update_fields=update_fields, )
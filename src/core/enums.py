@@ -23,3 +23,16 @@ class TicketEvent(CustomEnum):
 
 class App(CustomEnum):
     TAVILY = 'TAVILY'
+
+
+class EmailKind(CustomEnum):
+    PROPOSAL = 'PROPOSAL'
+    REPLY = 'REPLY'
+    NOTIFICATION = 'NOTIFICATION'
+
+
+class EmailStatus(CustomEnum):
+    PENDING = 'PENDING'
+    SENDING = 'SENDING'
+    SENT = 'SENT'
+    FAILED = 'FAILED'
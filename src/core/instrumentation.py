@@ -0,0 +1,98 @@
+######################################################################################################
+#    Lightweight timing of the stages of a request (history load, retrieval, generation, ...).      #
+#    The spans cost two clock reads when nobody listens, the listeners decide what to do with them  #
+######################################################################################################
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener: callable) -> None:
+    """
+        Register a callable called with (name, duration in seconds, error) at the end of each span
+    """
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: callable) -> None:
+    with _listeners_lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def record(name: str, duration: float, error: BaseException | None = None) -> None:
+    for listener in tuple(_listeners):
+        try:
+            listener(name, duration, error)
+        except Exception as e:
+            # A broken listener must never break the instrumented code
+            logger.warning(f'Span listener {listener} failed: {e}')
+
+
+@contextmanager
+def span(name: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        record(name, time.perf_counter() - started_at, e)
+        raise
+    record(name, time.perf_counter() - started_at)
+
+
+def timed(name: str):
+    """
+        Decorator version of `span`
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class SpanRecorder:
+    """
+        Listener keeping the durations of the spans, by name, while it's used as context manager
+    """
+
+    def __init__(self, names: list[str] = None):
+        self.names = set(names) if names else None
+        self.durations = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str, duration: float, error: BaseException | None = None) -> None:
+        if self.names is not None and name not in self.names:
+            return
+
+        with self._lock:
+            self.durations.setdefault(name, []).append(duration)
+            if error is not None:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def __enter__(self) -> SpanRecorder:
+        add_listener(self)
+        return self
+
+    def __exit__(self, *args) -> None:
+        remove_listener(self)
+
+    def total(self, name: str) -> float:
+        with self._lock:
+            return sum(self.durations.get(name, []))
@@ -0,0 +1,143 @@
+import re
+import random
+
+from django.db import connection
+from django.db import transaction
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core.enums import TicketEvent
+from core.models import Ticket
+from core.models import Comment
+from core.models import TicketHistory
+
+from ai.models import AITemporalComment
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ('Seed a test database, EXPLAIN the hot queries of the app (ticket thread, admin filters, API pages, ticket '
+            'history, review queue of the AI proposals, staff notification) and fail if one of them scans a whole '
+            'table instead of using an index')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickets', type=int, default=10000, help='Tickets seeded')
+        parser.add_argument('--comments', type=int, default=3, help='Comments, histories and proposals per ticket')
+        parser.add_argument('--staff', type=int, default=10, help='Staff users seeded, among 1000 customers')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--show-plans', action='store_true', help='Print the plan of each query')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between two runs')
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError(f'The query plans of {connection.vendor} are not supported')
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+
+        try:
+            self.seed(options)
+            failures = self.check(options['show_plans'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if failures:
+            raise CommandError(f'Sequential scan in the plan of: {", ".join(failures)}')
+
+        self.stdout.write(self.style.SUCCESS('All the hot queries use an index'))
+
+    def seed(self, options: dict) -> None:
+        rng = random.Random(options['seed'])
+        self.stdout.write(f'Seeding {options["tickets"]} tickets...')
+
+        User.objects.bulk_create(
+            [User(username=f'customer-{index}', email=f'customer{index}@example.com') for index in range(1000)] +
+            [User(username=f'agent-{index}', email=f'agent{index}@example.com', is_staff=True)
+             for index in range(options['staff'])],
+            batch_size=1000
+        )
+        customers = list(User.objects.filter(is_staff=False))
+        agents = list(User.objects.filter(is_staff=True))
+
+        # Most of the tickets of a helpdesk are closed, few need the attention of an agent
+        tickets = Ticket.objects.bulk_create([
+            Ticket(title=f'Ticket {index}', description='Description', open_by=rng.choice(customers),
+                   is_closed=rng.random() < 0.9, is_draft=rng.random() < 0.05, need_attention=rng.random() < 0.02)
+            for index in range(options['tickets'])
+        ], batch_size=1000)
+
+        comments = Comment.objects.bulk_create([
+            Comment(ticket=ticket, content='Comment', created_by=rng.choice(agents) if index % 2 else ticket.open_by)
+            for ticket in tickets for index in range(options['comments'])
+        ], batch_size=1000)
+        TicketHistory.objects.bulk_create([
+            TicketHistory(ticket=ticket, event=TicketEvent.STATUS_CHANGED)
+            for ticket in tickets for _ in range(options['comments'])
+        ], batch_size=1000)
+        AITemporalComment.objects.bulk_create([
+            AITemporalComment(ticket=comment.ticket, comment=comment, content='Proposal',
+                              is_validated=rng.random() < 0.95)
+            for comment in comments
+        ], batch_size=1000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def queries(self) -> list[tuple[str, str, object]]:
+        """
+            :return: The (name, table expected to be read through an index, queryset) of the hot queries
+        """
+        ticket = Ticket.objects.order_by('?').only('id').first()
+        page = 100
+
+        return [
+            ('ticket_thread', Comment._meta.db_table,
+             Comment.objects.filter(ticket=ticket).order_by('created_at')),
+            ('comment_page', Comment._meta.db_table,
+             Comment.objects.order_by('-created_at', '-id')[:page]),
+            ('ticket_page', Ticket._meta.db_table,
+             Ticket.objects.order_by('-updated_at', '-id')[:page]),
+            ('ticket_admin_filters', Ticket._meta.db_table,
+             Ticket.objects.filter(is_closed=False, is_draft=False, need_attention=True)
+             .order_by('-updated_at')[:page]),
+            ('open_tickets', Ticket._meta.db_table,
+             Ticket.objects.filter(is_closed=False).order_by('-updated_at')[:page]),
+            ('ticket_history', TicketHistory._meta.db_table,
+             TicketHistory.objects.filter(ticket=ticket).order_by('-created')),
+            ('proposal_review_queue', AITemporalComment._meta.db_table,
+             AITemporalComment.objects.filter(is_validated=False).order_by('-created_at')[:page]),
+            ('staff_emails', User._meta.db_table,
+             User.objects.filter(is_staff=True).exclude(email='').values_list('email', flat=True)),
+        ]
+
+    def check(self, show_plans: bool) -> list[str]:
+        failures = []
+
+        for name, table, queryset in self.queries():
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    # A sequential scan is then only chosen when no index can serve the query, whatever the data size
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+                    scan = re.compile(rf'Seq Scan on {table}\b')
+                else:
+                    scan = re.compile(rf'\bSCAN {table}\b(?! USING)')
+
+                plan = queryset.explain()
+
+            failed = scan.search(plan) is not None
+            if failed:
+                failures.append(name)
+
+            status = self.style.ERROR('SEQ SCAN') if failed else self.style.SUCCESS('ok')
+            self.stdout.write(f'{name:<28}{status}')
+            if show_plans or failed:
+                self.stdout.write('\n'.join(f'    {line}' for line in plan.splitlines()))
+
+        return failures
@@ -0,0 +1,47 @@
+import logging
+import threading
+
+from django.db import close_old_connections
+from django.core.management.base import BaseCommand
+
+from traceback_with_variables import format_exc
+
+from core.services import EmailOutboxService
+
+
+class Command(BaseCommand):
+    help = 'Send the emails of the outbox in batches, over one SMTP connection per batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of emails sent per connection')
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Seconds to wait before polling again when the outbox is empty')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Seconds after which an email being sent is considered abandoned and queued again')
+        parser.add_argument('--once', action='store_true', help='Exit as soon as the outbox is empty')
+
+    def handle(self, *args, **options):
+        self.logger = logging.getLogger()
+        stop = threading.Event()
+        service = EmailOutboxService()
+
+        requeued = EmailOutboxService.requeue_stale(options['stale_after'])
+        if requeued:
+            self.logger.warning(f'{requeued} abandoned emails queued again')
+
+        try:
+            while not stop.is_set():
+                try:
+                    close_old_connections()
+                    sent = service.dispatch(options['batch_size'])
+                    if sent:
+                        self.logger.info(f'{sent} emails dispatched')
+                        continue
+                    if options['once']:
+                        return
+                except Exception as e:
+                    self.logger.error(format_exc(e))
+
+                stop.wait(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Email dispatcher stopped')
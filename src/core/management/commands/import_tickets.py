@@ -0,0 +1,127 @@
+import csv
+import json
+import time
+from pathlib import Path
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core.models import TicketImport
+
+from core.services import TicketImportService
+
+CSV_TICKET_COLUMNS = ('title', 'description', 'solution', 'ticket_type', 'notes', 'is_closed', 'is_draft',
+                      'need_attention', 'app', 'open_by', 'open_by_email', 'created_at', 'closed_at')
+
+
+def read_jsonl(file, skip: int = 0):
+    """
+        One ticket per line, with its `comments` list. The skipped lines are not parsed.
+    """
+    index = 0
+    for line in file:
+        if not line.strip():
+            continue
+        index += 1
+        if index <= skip:
+            continue
+
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise CommandError(f'Invalid JSON in record {index}: {e}')
+
+
+def read_csv(file, skip: int = 0):
+    """
+        One row per comment: the consecutive rows with the same `id` are the thread of a ticket, whose fields are read
+        from its first row. `assigned_to` is a list of emails or usernames separated by `;`.
+    """
+    index = 0
+    record = None
+    for row in csv.DictReader(file):
+        ticket_id = row.get('id') or None
+        if record is None or ticket_id is None or ticket_id != record['id']:
+            if record is not None and index > skip:
+                yield record
+
+            index += 1
+            record = {name: row[name] for name in CSV_TICKET_COLUMNS if row.get(name)}
+            record['id'] = ticket_id
+            record['assigned_to'] = [user.strip() for user in (row.get('assigned_to') or '').split(';') if user.strip()]
+            record['comments'] = []
+
+        if index > skip and row.get('comment'):
+            record['comments'].append({
+                'content': row['comment'],
+                'created_by': row.get('comment_by'),
+                'created_at': row.get('comment_created_at'),
+                'is_solution': row.get('comment_is_solution'),
+            })
+
+    if record is not None and index > skip:
+        yield record
+
+
+class Command(BaseCommand):
+    help = ('Import the tickets and comments of another helpdesk from a JSONL or CSV file, by chunks of bulk inserts. '
+            'The import is resumed from the last committed chunk when it is run again on the same file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSONL or CSV file to import')
+        parser.add_argument('--format', choices=('jsonl', 'csv'),
+                            help='Format of the file, guessed from its extension by default')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Tickets imported per transaction')
+        parser.add_argument('--source', help='Name under which the progress of the import is saved, the absolute path '
+                                             'of the file by default')
+        parser.add_argument('--restart', action='store_true', help='Ignore the progress of a previous run')
+        parser.add_argument('--create-users', action='store_true',
+                            help='Create the unknown users as customers, the tickets of an unknown user are skipped '
+                                 'otherwise')
+        parser.add_argument('--with-ai', action='store_true',
+                            help='Queue the AI response generation of the open tickets waiting for an answer')
+
+    def handle(self, *args, **options):
+        path = Path(options['path']).resolve()
+        if not path.is_file():
+            raise CommandError(f'{path} does not exist')
+
+        file_format = options['format'] or ('csv' if path.suffix.lower() == '.csv' else 'jsonl')
+        progress, _ = TicketImport.objects.get_or_create(source=options['source'] or str(path))
+        if options['restart']:
+            progress.records = progress.tickets = progress.comments = progress.skipped = progress.ai_jobs = 0
+            progress.save()
+        if progress.records:
+            self.stdout.write(f'Resuming after the {progress.records} records already imported')
+
+        service = TicketImportService(create_users=options['create_users'], generate_with_ai=options['with_ai'])
+        reader = read_csv if file_format == 'csv' else read_jsonl
+        started_at = time.perf_counter()
+        imported = 0
+
+        with open(path, newline='' if file_format == 'csv' else None, encoding='utf-8') as file:
+            records = reader(file, skip=progress.records)
+            while True:
+                chunk = list(islice(records, options['chunk_size']))
+                if not chunk:
+                    break
+
+                chunk_started_at = time.perf_counter()
+                # The progress is saved in the transaction of the chunk, a failed run restarts from the first chunk
+                # not committed
+                stats = service.import_chunk(chunk, progress=progress)
+
+                rows = stats['tickets'] + stats['comments']
+                imported += rows
+                self.stdout.write(
+                    f'{progress.records} records: {stats["tickets"]} tickets, {stats["comments"]} comments, '
+                    f'{stats["skipped"]} skipped, {rows / (time.perf_counter() - chunk_started_at):.0f} rows/s'
+                )
+
+        duration = time.perf_counter() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f'{progress.tickets} tickets and {progress.comments} comments imported, '
+            f'{progress.skipped} tickets skipped, {progress.ai_jobs} AI generations queued '
+            f'({imported / duration if duration else 0:.0f} rows/s)'
+        ))
@@ -0,0 +1,137 @@
+######################################################################################################
+#    In-process Prometheus metrics: the spans of core.instrumentation feed a histogram per stage,   #
+#    and the registry is rendered in the Prometheus text format by the /metrics endpoint            #
+######################################################################################################
+
+from __future__ import annotations
+
+import bisect
+import threading
+
+from decouple import config
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    labels += [f'{name}="{escape(value)}"' for name, value in (extra or {}).items()]
+
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{format_labels(self.labels, key)} {format_value(value)}'
+                    for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, the +Inf one, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in sorted(self._values.items())]
+
+        samples = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                samples.append(f'{self.name}_bucket{format_labels(self.labels, key, {"le": format_value(bound)})} '
+                               f'{cumulative}')
+            samples.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(counts[-1])}')
+            samples.append(f'{self.name}_count{format_labels(self.labels, key)} {cumulative}')
+
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = 'cusupalm'):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter(f'{self.prefix}_{name}', description, labels))
+
+    def histogram(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(f'{self.prefix}_{name}', description, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.samples())
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+
+registry = MetricsRegistry()
+
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+
+stage_duration = registry.histogram('stage_duration_seconds', 'Duration of the stages of the requests and jobs',
+                                    ('stage', 'status'))
+ingested_documents = registry.counter('ingested_documents_total', 'Documents given to the retrievers ingestion',
+                                      ('app', 'result'))
+generation_jobs = registry.counter('generation_jobs_total', 'AI generation jobs run, by outcome', ('status',))
+ingestion_batches = registry.counter('ingestion_batches_total', 'Batches embedded by the retrievers', ('app',))
+
+
+def observe_span(name: str, duration: float, error: BaseException | None = None) -> None:
+    stage_duration.observe(duration, stage=name, status='error' if error is not None else 'ok')
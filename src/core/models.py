@@ -1,5 +1,9 @@
+import time
+import threading
+
 from django.db import models
-from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
 from django.db.utils import ProgrammingError
 from django.db.utils import OperationalError
 from django.contrib.auth import get_user_model
@@ -10,11 +14,16 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 
 from django_ckeditor_5.fields import CKEditor5Field
 
+from decouple import config
+
 from core.enums import App
 from core.enums import TicketType
 from core.enums import TicketEvent
+from core.enums import EmailKind
+from core.enums import EmailStatus
 
 from core.base import BaseModel
+from core.base import AutoDateTimeField
 
 User = get_user_model()
 
@@ -68,7 +77,11 @@ class Ticket(BaseModel):
         """
             This function is used to get history directly from comments as dict
         """
-        comments = self.comments.order_by('created_at')
+        comments = list(
+            self.comments.select_related('created_by')
+            .only('id', 'ticket', 'content', 'created_at', 'created_by__is_staff')
+            .order_by('created_at')
+        )
 
         history = {
             'title': self.title,
@@ -76,20 +89,26 @@ class Ticket(BaseModel):
             'thread': []
         }
 
-        if comments.exists():
-            if except_last:
-                comments = comments.exclude(id=comments.last().id)
+        if except_last:
+            comments = comments[:-1]
 
-            for comment in comments:
-                history['thread'].append({
-                    'role': 'agent' if comment.created_by.is_staff else 'customer',
-                    'text': comment.content
-                })
+        for comment in comments:
+            history['thread'].append({
+                'role': 'agent' if comment.created_by.is_staff else 'customer',
+                'text': comment.content
+            })
 
         return history
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Admin filters, then the default ordering
+            models.Index(fields=['is_closed', 'is_draft', 'need_attention', '-updated_at']),
+            # Default ordering and the keyset pagination of the API
+            models.Index(fields=['-updated_at', '-id']),
+            models.Index(fields=['-updated_at'], condition=Q(is_closed=False), name='ticket_open_updated_idx'),
+        ]
 
 
 class Comment(BaseModel):
@@ -100,7 +119,7 @@ class Comment(BaseModel):
     content = CKEditor5Field()
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments')
     is_solution = models.BooleanField(default=False)
-    last_reply_at = models.DateTimeField(auto_now=True)
+    last_reply_at = AutoDateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.content[:10]}...'
@@ -114,7 +133,10 @@ class Comment(BaseModel):
         verbose_name = _('Ticket comment')
         verbose_name_plural = _('Ticket comments')
         indexes = [
-            models.Index(fields=['created_by'])
+            models.Index(fields=['created_by']),
+            # Thread of a ticket, `get_history`
+            models.Index(fields=['ticket', 'created_at']),
+            models.Index(fields=['-created_at', '-id']),
         ]
         ordering = ('-created_at',)
 
@@ -124,8 +146,8 @@ class TicketHistory(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, blank=True, null=True)
     related_id = models.CharField(max_length=255, blank=True, null=True)
     related_object = GenericForeignKey('content_type', 'related_id')
-    created = models.DateTimeField(auto_now_add=True)
-    updated = models.DateTimeField(auto_now=True)
+    created = AutoDateTimeField(auto_now_add=True)
+    updated = AutoDateTimeField(auto_now=True)
     event = models.CharField(_('Event happened on the ticket'), max_length=255, choices=TicketEvent.choices())
     previous_status = models.CharField(_('Previous status'), max_length=255, blank=True, null=True)
     current_status = models.CharField(_('Current status'), max_length=255, blank=True, null=True)
@@ -137,39 +159,94 @@ class TicketHistory(models.Model):
         verbose_name = _('History')
         verbose_name_plural = _('Histories')
         ordering = ['-created']
+        indexes = [
+            models.Index(fields=['ticket', '-created'])
+        ]
 
 
 class Singleton(models.Model):
+    """
+        Model with a single row, loaded once per process and kept in memory. Each save bumps the `version` of the row,
+        the processes compare it with the version of their instance at most every `CHECK_INTERVAL` seconds and
+        reload the row when it changed.
+    """
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    CHECK_INTERVAL = config('SINGLETON_CHECK_INTERVAL', default=5, cast=float)
+
+    # Instances loaded by the process, by model: (instance, time of the last version check)
+    _instances = {}
+    _tables = set()
+    _lock = threading.Lock()
+
     class Meta:
         abstract = True
 
     def save(self, *args, **kwargs):
         self.pk = 1
+        if self.__class__.objects.filter(pk=1).exists():
+            # The version of the instance may be outdated, it's never written back: only bumped below
+            update_fields = kwargs.pop('update_fields', None)
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'version' and
+                (update_fields is None or field.name in update_fields)
+            ]
+            kwargs.pop('force_insert', None)
         super(Singleton, self).save(*args, **kwargs)
+        # Bumped in the database, concurrent saves from several processes still get different versions
+        self.__class__.objects.filter(pk=1).update(version=models.F('version') + 1)
+        self.refresh_from_db(fields=['version'])
         self.set_cache()
 
     def delete(self, using=None, keep_parents=False):
         raise ValidationError(_('Unable to delete this model'))
 
     def set_cache(self):
-        cache.set(self.__class__.__name__, self)
+        with Singleton._lock:
+            Singleton._instances[self.__class__] = (self, time.monotonic())
 
     @classmethod
-    def load(cls):
+    def table_exists(cls) -> bool:
+        # The tables don't disappear while the process runs, a table found once isn't looked up anymore
+        if cls._meta.db_table in Singleton._tables:
+            return True
+
         from django.db import connection
 
-        if 'core_globalconfig' not in connection.introspection.table_names():
+        if cls._meta.db_table not in connection.introspection.table_names():
+            return False
+
+        with Singleton._lock:
+            Singleton._tables.add(cls._meta.db_table)
+
+        return True
+
+    @classmethod
+    def load(cls):
+        instance, checked_at = Singleton._instances.get(cls, (None, None))
+        if instance is not None and time.monotonic() - checked_at < cls.CHECK_INTERVAL:
+            return instance
+
+        if not cls.table_exists():
             return
 
         try:
-            if cache.get(cls.__name__) is None:
-                unique_instance, created = cls.objects.get_or_create(pk=1)
-                if not created:
-                    unique_instance.set_cache()
+            if instance is not None:
+                version = cls.objects.filter(pk=1).values_list('version', flat=True).first()
+                if version == instance.version:
+                    instance.set_cache()
+                    return instance
+
+            unique_instance, created = cls.objects.get_or_create(pk=1)
+            if not created:
+                unique_instance.set_cache()
         except (ProgrammingError, OperationalError) as e:
             pass
 
-        return cache.get(cls.__name__)
+        instance, _ = Singleton._instances.get(cls, (None, None))
+
+        return instance
 
 
 class GlobalConfig(Singleton):
@@ -185,3 +262,91 @@ class GlobalConfig(Singleton):
 
     class Meta:
         ordering = ['-id']
+
+
+class OutboxEmail(BaseModel):
+    """
+        Email waiting to be sent by the `dispatch_emails` command, one row per recipient
+    """
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    kind = models.CharField(max_length=255, choices=EmailKind.choices(), default=EmailKind.NOTIFICATION)
+    status = models.CharField(max_length=255, choices=EmailStatus.choices(), default=EmailStatus.PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    send_after = models.DateTimeField(default=timezone.now,
+                                      help_text='The email is not sent before, used by the retries and the digests')
+    locked_at = models.DateTimeField(blank=True, null=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'{self.subject} to {self.recipient}'
+
+    class Meta:
+        verbose_name = _('Outbox email')
+        verbose_name_plural = _('Outbox emails')
+        indexes = [
+            models.Index(fields=['status', 'send_after']),
+            models.Index(fields=['recipient', 'kind', 'status'])
+        ]
+        ordering = ('-created_at',)
+
+
+class CacheVersion(models.Model):
+    """
+        Version of a data kept in memory or in a cache by the processes (web, AI workers), bumped by the process which
+        changes the data. The readers compare it with the version of their copy, which invalidates the copies of all
+        the processes whatever the cache backend.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name} v{self.version}'
+
+    @classmethod
+    def get(cls, name: str) -> int:
+        return cls.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, name: str) -> None:
+        """
+            Increment the version in the database, in the transaction of the change, the other processes see the new
+            version once the change is committed
+        """
+        if cls.objects.filter(name=name).update(version=models.F('version') + 1, updated_at=timezone.now()):
+            return
+
+        _, created = cls.objects.get_or_create(name=name, defaults={'version': 1})
+        if not created:
+            # Created by a concurrent bump in the meantime
+            cls.objects.filter(name=name).update(version=models.F('version') + 1, updated_at=timezone.now())
+
+    class Meta:
+        verbose_name = _('Cache version')
+        verbose_name_plural = _('Cache versions')
+        ordering = ('name',)
+
+
+class TicketImport(BaseModel):
+    """
+        Progress of an `import_tickets` run, updated in the transaction of each imported chunk: a run stopped at any
+        point resumes after the last committed chunk, without importing a record twice
+    """
+    source = models.CharField(max_length=1024, unique=True, help_text='Absolute path of the imported file')
+    records = models.PositiveIntegerField(default=0, help_text='Records of the file already imported or skipped')
+    tickets = models.PositiveIntegerField(default=0)
+    comments = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    ai_jobs = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.source
+
+    class Meta:
+        verbose_name = _('Ticket import')
+        verbose_name_plural = _('Ticket imports')
+        ordering = ('-created_at',)
@@ -1,18 +1,231 @@
+import json
+import math
+import base64
+
+from decouple import config
+
+from django.db import connections
+from django.db.models import Q
+from django.core.paginator import Page
+from django.core.paginator import EmptyPage
+from django.core.paginator import PageNotAnInteger
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
 from rest_framework import pagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import remove_query_param
+from rest_framework.utils.urls import replace_query_param
+
+# Below this estimate the exact count is cheap enough, and the planner statistics of the small tables are unreliable
+APPROXIMATE_COUNT_THRESHOLD = config('APPROXIMATE_COUNT_THRESHOLD', default=10000, cast=int)
+
+
+def approximate_count(queryset) -> int:
+    """
+        Number of rows of the queryset estimated from the PostgreSQL planner statistics: `pg_class.reltuples` for a
+        whole table, the row estimate of the EXPLAIN plan for a filtered queryset.
+        Exact count on the other databases and below APPROXIMATE_COUNT_THRESHOLD.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    queryset = queryset.order_by()
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            estimate = row[0] if row else -1
+        else:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            estimate = int(plan[0]['Plan']['Plan Rows'])
+
+    # -1 when the table was never analyzed
+    if estimate < APPROXIMATE_COUNT_THRESHOLD:
+        return queryset.count()
+
+    return estimate
+
+
+class ApproximatePage(Page):
+    def __init__(self, object_list, number, paginator):
+        # One more row than the page size is fetched, an underestimated count must not hide the next pages
+        object_list = list(object_list)
+        self.more = len(object_list) > paginator.per_page
+        super(ApproximatePage, self).__init__(object_list[:paginator.per_page], number, paginator)
+
+    def has_next(self):
+        return self.more
+
+
+class ApproximateCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return approximate_count(self.object_list)
+
+    def validate_number(self, number):
+        # The estimated number of pages can be lower than the real one, only the first page is a bound
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['min_page'])
+
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+
+        return ApproximatePage(self.object_list[bottom:bottom + self.per_page + 1], number, self)
 
 
 class PaginationWithTotalPage(pagination.PageNumberPagination):
+    """
+        Page number pagination, or keyset pagination when the client asks for `?pagination=cursor` (then follows the
+        `next` and `previous` links). The keyset pages are read with a `WHERE (ordering) < (cursor)` filter on the
+        `cursor_ordering` of the view, instead of an OFFSET scan growing with the page number, `?ordering` is refused.
+        `?count=approximate` replaces the COUNT(*) by the PostgreSQL planner estimate, which is the default of the
+        keyset pages (`?count=exact` to count them). The response has the same format in every mode.
+    """
     page_size = 100
     page_size_query_param = 'page_size'
 
+    mode_query_param = 'pagination'
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    # Must end with a unique field, each position of the keyset is then unique
+    cursor_ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.keyset = False
+        self.approximate = request.query_params.get(self.count_query_param) == 'approximate'
+
+        if request.query_params.get(self.mode_query_param) != 'cursor' and \
+                self.cursor_query_param not in request.query_params:
+            self.django_paginator_class = ApproximateCountPaginator if self.approximate else Paginator
+            return super(PaginationWithTotalPage, self).paginate_queryset(queryset, request, view)
+
+        return self.paginate_keyset(queryset, request, view)
+
+    def paginate_keyset(self, queryset, request, view=None) -> list:
+        self.keyset = True
+        self.page_size = self.get_page_size(request)
+        self.ordering = tuple(getattr(view, 'cursor_ordering', self.cursor_ordering))
+        if request.query_params.get(api_settings.ORDERING_PARAM):
+            raise ValidationError({api_settings.ORDERING_PARAM: f'Not available with the cursor pagination, ordered by '
+                                                                f'{", ".join(self.ordering)}'})
+
+        # An exact COUNT(*) would scan all the rows on each page, which the keyset filter avoids
+        exact = request.query_params.get(self.count_query_param) == 'exact'
+        self.count = queryset.count() if exact else approximate_count(queryset)
+
+        self.cursor = self.decode_cursor(request, queryset.model)
+        reverse = self.cursor is not None and self.cursor['reverse']
+        ordering = tuple(self.flip(field) for field in self.ordering) if reverse else self.ordering
+
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None:
+            queryset = queryset.filter(self.keyset_filter(ordering, self.cursor['position']))
+
+        results = list(queryset[:self.page_size + 1])
+        more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        has_next, has_previous = (self.cursor is not None, more) if reverse else (more, self.cursor is not None)
+        self.next_position = self.position(results[-1]) if has_next and results else None
+        self.previous_position = self.position(results[0]) if has_previous and results else None
+
+        return results
+
     def get_paginated_response(self, data):
+        if self.keyset:
+            count = self.count
+            total_pages = max(math.ceil(count / self.page_size), 1)
+        else:
+            count = self.page.paginator.count
+            total_pages = max(self.page.paginator.num_pages, self.page.number)
+
         response_data = {
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
-            'count': self.page.paginator.count,
-            'total_pages': self.page.paginator.num_pages,
+            'count': count,
+            'total_pages': total_pages,
             'results': data
         }
 
         return Response(response_data)
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(PaginationWithTotalPage, self).get_next_link()
+
+        return self.cursor_link(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super(PaginationWithTotalPage, self).get_previous_link()
+
+        return self.cursor_link(self.previous_position, reverse=True)
+
+    def cursor_link(self, position: list | None, reverse: bool) -> str | None:
+        if position is None:
+            return None
+
+        url = remove_query_param(self.request.build_absolute_uri(), self.mode_query_param)
+        cursor = json.dumps({'p': position, 'r': int(reverse)}, separators=(',', ':'))
+
+        return replace_query_param(url, self.cursor_query_param,
+                                   base64.urlsafe_b64encode(cursor.encode()).decode().rstrip('='))
+
+    def decode_cursor(self, request, model) -> dict | None:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode())
+            if len(cursor['p']) != len(self.ordering):
+                raise ValueError(encoded)
+            position = [model._meta.get_field(field.lstrip('-')).to_python(value)
+                        for field, value in zip(self.ordering, cursor['p'])]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+        return {'position': position, 'reverse': bool(cursor.get('r'))}
+
+    def position(self, instance) -> list:
+        values = [getattr(instance, field.lstrip('-')) for field in self.ordering]
+
+        return [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+
+    @staticmethod
+    def flip(field: str) -> str:
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def keyset_filter(ordering: tuple, position: list) -> Q:
+        """
+            Rows after the position in the ordering: (a > x) OR (a = x AND b > y) OR ..., `<` for the descending fields
+        """
+        condition = Q()
+        for index, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = {f'{name}__lt' if field.startswith('-') else f'{name}__gt': position[index]}
+            lookup.update({other.lstrip('-'): position[rank] for rank, other in enumerate(ordering[:index])})
+            condition |= Q(**lookup)
+
+        return condition
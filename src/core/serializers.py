@@ -8,6 +8,8 @@ from core.models import Comment
 from core.services import TicketService
 from core.services import CommentService
 
+from ai.serializers import AITemporalCommentSerializer
+
 User = get_user_model()
 
 
@@ -28,6 +30,14 @@ class CommentSerializer(serializers.ModelSerializer):
 
         return attrs
 
+    def to_representation(self, instance):
+        data = super(CommentSerializer, self).to_representation(instance)
+        if 'ai_proposals' in self.context.get('include', ()):
+            data['ai_proposals'] = AITemporalCommentSerializer(instance.ai_proposals.all(), many=True,
+                                                               context=self.context).data
+
+        return data
+
     def create(self, validated_data):
         service = CommentService()
         comment = service.create(validated_data)
@@ -36,18 +46,41 @@ class CommentSerializer(serializers.ModelSerializer):
 
 
 class TicketSerializer(serializers.ModelSerializer):
+    ai_generation_status = serializers.SerializerMethodField()
+
     class Meta:
         model = Ticket
         fields = (
             'id', 'title', 'description', 'ticket_type', 'assigned_to', 'notes', 'need_attention', 'open_by_email',
-            'is_closed', 'app')
+            'is_closed', 'app', 'ai_generation_status')
         read_only_fields = ('solution', 'last_reply_at', 'open_by', 'open_by_email', 'is_closed', 'app')
 
+    def get_ai_generation_status(self, instance):
+        """Status of the latest AI response generation queued for the ticket"""
+        # Annotated by the viewset queryset
+        if hasattr(instance, 'latest_ai_job_status'):
+            return instance.latest_ai_job_status
+
+        job = instance.ai_jobs.order_by('-created_at').only('status').first()
+
+        return job.status if job else None
+
     def get_comments(self, instance):
-        serializer = CommentSerializer(instance.comments.all(), many=True)
+        serializer = CommentSerializer(instance.comments.all(), many=True, context=self.context)
 
         return serializer.data
 
+    def to_representation(self, instance):
+        data = super(TicketSerializer, self).to_representation(instance)
+        include = self.context.get('include', ())
+        if 'comments' in include:
+            data['comments'] = self.get_comments(instance)
+        if 'ai_proposals' in include:
+            data['ai_proposals'] = AITemporalCommentSerializer(instance.ai_proposals.all(), many=True,
+                                                               context=self.context).data
+
+        return data
+
     def validate(self, attrs):
         if 'assigned_to' in attrs:
             assigned = []
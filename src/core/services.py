@@ -1,18 +1,42 @@
+import logging
 from typing import Any
 from typing import Dict
+from typing import List
+from datetime import timedelta
 
+from django.conf import settings
+from django.db.models import F
+from django.db.models import Q
 from django.utils import timezone
 from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from django.core.mail import get_connection
+from django.core.mail import EmailMessage
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+
+from decouple import config
+
+from traceback_with_variables import format_exc
 
 from core.models import Ticket
 from core.models import Comment
 from core.models import GlobalConfig
+from core.models import OutboxEmail
 from core.models import TicketHistory
+from core.models import TicketImport
 
+from core.enums import App
+from core.enums import EmailKind
+from core.enums import TicketType
 from core.enums import TicketEvent
+from core.enums import EmailStatus
 
-from ai.llm import handling_response_generation
+from core.instrumentation import span
+
+from ai.models import AIGenerationJob
+from ai.services import AIGenerationJobService
 
 User = get_user_model()
 
@@ -37,7 +61,7 @@ class TicketService:
         )
 
         if self.global_config.generate_ticket_response_with_ai:
-            handling_response_generation(self.ticket.id, None, is_comment=False)
+            AIGenerationJobService.enqueue(ticket_id=self.ticket.id)
 
         return self.ticket
 
@@ -53,7 +77,7 @@ class CommentService:
 
         ticket = self.comment.ticket
         ticket.last_reply_at = timezone.now()
-        ticket.save()
+        ticket.save(update_fields=['last_reply_at'])
 
         if self.comment.created_by.is_staff is True:
             # Send notification
@@ -66,6 +90,343 @@ class CommentService:
         )
 
         if self.global_config.generate_ticket_response_with_ai:
-            handling_response_generation(ticket_id=None, comment_id=self.comment.id, is_comment=True)
+            AIGenerationJobService.enqueue(ticket_id=ticket.id, comment_id=self.comment.id)
 
         return self.comment
+
+
+class TicketImportService:
+    """
+        Import of the tickets of another helpdesk, one chunk per transaction. The rows are inserted with bulk_create,
+        without the validation, the history insert and the AI generation TicketService runs for each ticket.
+        The users are looked up by email or username once, then kept for the next chunks.
+
+        A record is a dict of the Ticket fields, with `open_by` and `assigned_to` given by email or username, and
+        its `comments` (content, created_by, created_at, is_solution).
+        The rows are built with `keep_dates`, they are inserted with the dates of the previous helpdesk instead of the
+        `auto_now` ones.
+    """
+    TICKET_FIELDS = ('title', 'description', 'solution', 'ticket_type', 'notes', 'is_closed', 'is_draft',
+                     'need_attention', 'app', 'open_by_email')
+    BOOLEAN_FIELDS = ('is_closed', 'is_draft', 'need_attention', 'is_solution')
+
+    def __init__(self, create_users: bool = False, generate_with_ai: bool = False):
+        self.logger = logging.getLogger()
+        self.create_users = create_users
+        self.generate_with_ai = generate_with_ai
+        self.users = {}
+        self.comment_type = ContentType.objects.get_for_model(Comment)
+
+    @staticmethod
+    def to_bool(value) -> bool:
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 'true', 'yes', 'y')
+
+        return bool(value)
+
+    @staticmethod
+    def to_datetime(value, default):
+        if not value:
+            return default
+
+        date = parse_datetime(value) if isinstance(value, str) else value
+        if date is None:
+            raise ValueError(f'Invalid date {value}')
+
+        return timezone.make_aware(date) if timezone.is_naive(date) else date
+
+    def resolve_users(self, identifiers: set) -> None:
+        """
+            Look up the users not met in the previous chunks, in one query, and create the missing ones as customers
+            when asked to
+        """
+        missing = {identifier for identifier in identifiers if identifier and identifier not in self.users}
+        if not missing:
+            return
+
+        for user in User.objects.filter(Q(email__in=missing) | Q(username__in=missing)):
+            for identifier in (user.email, user.username):
+                if identifier in missing:
+                    self.users.setdefault(identifier, user)
+
+        missing -= set(self.users)
+        if missing and self.create_users:
+            created = User.objects.bulk_create([
+                User(username=identifier, email=identifier if '@' in identifier else '', password=make_password(None))
+                for identifier in sorted(missing)
+            ])
+            self.users.update({user.username: user for user in created})
+            self.logger.info(f'{len(created)} users created')
+            missing.clear()
+
+        self.users.update(dict.fromkeys(missing))
+
+    @transaction.atomic()
+    def import_chunk(self, records: List[Dict], progress: TicketImport = None) -> Dict[str, int]:
+        """
+            :param progress: Import whose counters are updated in the transaction of the chunk
+        """
+        stats = {'tickets': 0, 'comments': 0, 'skipped': 0, 'ai_jobs': 0}
+        now = timezone.now()
+
+        identifiers = set()
+        for record in records:
+            identifiers.add(record.get('open_by'))
+            identifiers.update(record.get('assigned_to') or [])
+            identifiers.update(comment.get('created_by') for comment in record.get('comments') or [])
+        self.resolve_users(identifiers)
+
+        tickets, threads, assignments = [], [], []
+        for record in records:
+            try:
+                ticket, comments, assigned_to = self.build_ticket(record, now)
+            except ValueError as e:
+                stats['skipped'] += 1
+                self.logger.warning(f'Ticket {record.get("id", record.get("title"))} skipped: {e}')
+                continue
+
+            tickets.append(ticket)
+            threads.append(comments)
+            assignments.append(assigned_to)
+
+        self.insert(tickets, threads, assignments)
+
+        if self.generate_with_ai:
+            jobs = []
+            for ticket, thread in zip(tickets, threads):
+                if ticket.is_closed:
+                    continue
+                if not thread:
+                    jobs.append(AIGenerationJob(ticket=ticket, max_attempts=AIGenerationJobService.MAX_ATTEMPTS))
+                elif not thread[-1].created_by.is_staff:
+                    # The customer waits for an answer to their last comment
+                    jobs.append(AIGenerationJob(ticket=ticket, comment=thread[-1],
+                                                max_attempts=AIGenerationJobService.MAX_ATTEMPTS))
+            AIGenerationJob.objects.bulk_create(jobs)
+            stats['ai_jobs'] = len(jobs)
+
+        stats['tickets'] = len(tickets)
+        stats['comments'] = sum(len(thread) for thread in threads)
+
+        if progress is not None:
+            progress.records += len(records)
+            for name, value in stats.items():
+                setattr(progress, name, getattr(progress, name) + value)
+            progress.save(update_fields=['records', *stats])
+
+        return stats
+
+    def insert(self, tickets: List[Ticket], threads: List[List[Comment]], assignments: List[List]) -> None:
+        Ticket.objects.bulk_create(tickets)
+
+        Ticket.assigned_to.through.objects.bulk_create([
+            Ticket.assigned_to.through(ticket_id=ticket.id, user_id=user.id)
+            for ticket, assigned_to in zip(tickets, assignments) for user in assigned_to
+        ], ignore_conflicts=True)
+
+        comments = []
+        for ticket, thread in zip(tickets, threads):
+            for comment in thread:
+                comment.ticket = ticket
+                comments.append(comment)
+        Comment.objects.bulk_create(comments)
+
+        histories = (
+            [TicketHistory(ticket=ticket, event=TicketEvent.TICKET_OPENED, created=ticket.created_at,
+                           updated=ticket.created_at) for ticket in tickets] +
+            [TicketHistory(ticket=comment.ticket, content_type=self.comment_type, related_id=str(comment.id),
+                           event=TicketEvent.COMMENT_ADDED, created=comment.created_at, updated=comment.created_at)
+             for comment in comments]
+        )
+        for history in histories:
+            history.keep_dates = True
+        TicketHistory.objects.bulk_create(histories)
+
+    def build_ticket(self, record: Dict, now) -> tuple:
+        """
+            :return: The unsaved ticket, its comments sorted by date and its assigned agents
+            :raise ValueError: When the record can't be imported
+        """
+        if not record.get('title'):
+            raise ValueError('no title')
+
+        open_by = self.users.get(record.get('open_by'))
+        if open_by is None:
+            raise ValueError(f'unknown user {record.get("open_by")}')
+        if open_by.is_staff:
+            raise ValueError('only customer user are allowed to open ticket')
+
+        data = {name: record[name] for name in self.TICKET_FIELDS if record.get(name) not in (None, '')}
+        for name in self.BOOLEAN_FIELDS:
+            if name in data:
+                data[name] = self.to_bool(data[name])
+        if 'ticket_type' in data and TicketType.get_name(data['ticket_type']) is None:
+            raise ValueError(f'invalid ticket type {data["ticket_type"]}')
+        if 'app' in data and App.get_name(data['app']) is None:
+            raise ValueError(f'invalid app {data["app"]}')
+
+        created_at = self.to_datetime(record.get('created_at'), now)
+        ticket = Ticket(open_by=open_by, created_at=created_at, **data)
+        ticket.keep_dates = True
+
+        comments = []
+        for comment in record.get('comments') or []:
+            created_by = self.users.get(comment.get('created_by'))
+            if created_by is None or not comment.get('content'):
+                self.logger.warning(f'Comment of ticket {record.get("id", record["title"])} by '
+                                    f'{comment.get("created_by")} skipped')
+                continue
+            comment_created_at = self.to_datetime(comment.get('created_at'), created_at)
+            comments.append(Comment(content=comment['content'], created_by=created_by,
+                                    is_solution=self.to_bool(comment.get('is_solution', False)),
+                                    created_at=comment_created_at, updated_at=comment_created_at,
+                                    last_reply_at=comment_created_at))
+            comments[-1].keep_dates = True
+        comments.sort(key=lambda comment: comment.created_at)
+
+        ticket.last_reply_at = comments[-1].created_at if comments else None
+        ticket.updated_at = ticket.last_reply_at or created_at
+        if ticket.is_closed:
+            ticket.closed_at = self.to_datetime(record.get('closed_at'), ticket.updated_at)
+
+        assigned_to = [self.users[identifier] for identifier in record.get('assigned_to') or []
+                       if self.users.get(identifier) is not None and self.users[identifier].is_staff]
+
+        return ticket, comments, assigned_to
+
+
+class EmailOutboxService:
+    """
+        The emails are saved in the outbox once the transaction which produced them is committed, then sent by the
+        `dispatch_emails` command in batches, over one SMTP connection per batch.
+        With `EMAIL_DIGEST_WINDOW` set, the proposals notifications of an agent are held during this number of seconds
+        and sent as a single digest email.
+    """
+    RETRY_BACKOFF = config('EMAIL_RETRY_BACKOFF', default=60, cast=int)
+    MAX_ATTEMPTS = config('EMAIL_MAX_ATTEMPTS', default=5, cast=int)
+    DIGEST_WINDOW = config('EMAIL_DIGEST_WINDOW', default=0, cast=int)
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+
+    @classmethod
+    def queue(cls, recipients: str | List[str], subject: str, message: str,
+              kind: EmailKind = EmailKind.NOTIFICATION) -> None:
+        recipients = recipients.split(',') if isinstance(recipients, str) else recipients or []
+        delay = cls.DIGEST_WINDOW if kind == EmailKind.PROPOSAL else 0
+
+        def create_emails():
+            send_after = timezone.now() + timedelta(seconds=delay)
+            OutboxEmail.objects.bulk_create([
+                OutboxEmail(recipient=recipient.strip(), subject=subject, message=message, kind=kind,
+                            max_attempts=cls.MAX_ATTEMPTS, send_after=send_after)
+                for recipient in dict.fromkeys(recipients) if recipient and recipient.strip()
+            ])
+
+        transaction.on_commit(create_emails)
+
+    @classmethod
+    def claim(cls, batch_size: int) -> List[OutboxEmail]:
+        """
+            Lock the next due emails for the current dispatcher. In digest mode, the due proposals notifications take
+            along the other pending proposals of their recipient.
+        """
+        now = timezone.now()
+
+        with transaction.atomic():
+            emails = list(
+                OutboxEmail.objects.select_for_update(skip_locked=True)
+                .filter(status=EmailStatus.PENDING, send_after__lte=now)
+                .order_by('send_after', 'id')[:batch_size]
+            )
+            if cls.DIGEST_WINDOW:
+                recipients = {email.recipient for email in emails if email.kind == EmailKind.PROPOSAL}
+                claimed = {email.id for email in emails}
+                emails += [
+                    email for email in OutboxEmail.objects.select_for_update(skip_locked=True).filter(
+                        status=EmailStatus.PENDING, kind=EmailKind.PROPOSAL, recipient__in=recipients,
+                        attempts=0
+                    ).order_by('id')
+                    if email.id not in claimed
+                ]
+
+            OutboxEmail.objects.filter(id__in=[email.id for email in emails]).update(
+                status=EmailStatus.SENDING, attempts=F('attempts') + 1, locked_at=now, updated_at=now
+            )
+            for email in emails:
+                email.attempts += 1
+
+        return emails
+
+    @classmethod
+    def requeue_stale(cls, stale_after: int) -> int:
+        """
+            Give back to the outbox the emails whose dispatcher died while sending them
+        """
+        limit = timezone.now() - timedelta(seconds=stale_after)
+
+        return OutboxEmail.objects.filter(status=EmailStatus.SENDING, locked_at__lt=limit).update(
+            status=EmailStatus.PENDING, locked_at=None, updated_at=timezone.now()
+        )
+
+    def dispatch(self, batch_size: int = 100) -> int:
+        """
+            Send one batch of due emails
+            :return: The number of emails claimed, 0 when the outbox is empty
+        """
+        emails = self.claim(batch_size)
+        if not emails:
+            return 0
+
+        groups = {}
+        for email in emails:
+            # The digests group the proposals by recipient, the other emails are sent one by one
+            key = (email.recipient,) if self.DIGEST_WINDOW and email.kind == EmailKind.PROPOSAL else (email.id,)
+            groups.setdefault(key, []).append(email)
+
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as e:
+            self.logger.error(format_exc(e))
+            self._failed(emails, str(e))
+            return len(emails)
+
+        try:
+            with span('email_dispatch'):
+                for group in groups.values():
+                    try:
+                        connection.send_messages([self.build_message(group)])
+                        self._update(group, status=EmailStatus.SENT, sent_at=timezone.now(), locked_at=None,
+                                     last_error='')
+                    except Exception as e:
+                        self.logger.error(format_exc(e))
+                        self._failed(group, str(e))
+        finally:
+            connection.close()
+
+        return len(emails)
+
+    def build_message(self, emails: List[OutboxEmail]) -> EmailMessage:
+        if len(emails) == 1:
+            subject, body = emails[0].subject, emails[0].message
+        else:
+            subject = f'{len(emails)} AI response proposals to validate'
+            body = '\n\n'.join(f'{email.subject}\n\n{email.message}' for email in emails)
+
+        return EmailMessage(subject=subject, body=body, from_email=settings.FROM_EMAIL, to=[emails[0].recipient])
+
+    def _failed(self, emails: List[OutboxEmail], error: str) -> None:
+        for email in emails:
+            if email.attempts >= email.max_attempts:
+                self.logger.error(f'Email #{email.id} to {email.recipient} failed after {email.attempts} attempts')
+                self._update([email], status=EmailStatus.FAILED, locked_at=None, last_error=error)
+            else:
+                # Exponential backoff: 1x, 2x, 4x, ... the base delay
+                delay = self.RETRY_BACKOFF * 2 ** (email.attempts - 1)
+                self._update([email], status=EmailStatus.PENDING, locked_at=None, last_error=error,
+                             send_after=timezone.now() + timedelta(seconds=delay))
+
+    @staticmethod
+    def _update(emails: List[OutboxEmail], **fields) -> None:
+        OutboxEmail.objects.filter(id__in=[email.id for email in emails]).update(updated_at=timezone.now(), **fields)
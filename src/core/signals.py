@@ -0,0 +1,42 @@
+from django.db import connections
+from django.dispatch import receiver
+from django.db.models.signals import post_save
+from django.db.models.signals import post_migrate
+from django.db.models.signals import post_delete
+from django.contrib.auth import get_user_model
+
+from core.utils import invalidate_staff_emails
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+def invalidate_staff_emails_on_save(sender, instance, update_fields=None, **kwargs):
+    # The logins only update `last_login`, which doesn't change the recipients
+    if update_fields is None or set(update_fields) - {'last_login'}:
+        invalidate_staff_emails()
+
+
+@receiver(post_delete, sender=User)
+def invalidate_staff_emails_on_delete(sender, instance, **kwargs):
+    invalidate_staff_emails()
+
+
+@receiver(post_migrate, dispatch_uid='core.create_user_indexes')
+def create_user_indexes(sender, using='default', **kwargs):
+    """
+        The User model belongs to django.contrib.auth, its indexes can't be declared in a Meta.
+        The staff users, notified of each AI proposal, are a few rows of the table: a partial index covers them.
+    """
+    if sender.name != 'core':
+        return
+
+    connection = connections[using]
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS user_staff_email_idx ON {connection.ops.quote_name(User._meta.db_table)} '
+            f'(email) WHERE is_staff'
+        )
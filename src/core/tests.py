@@ -0,0 +1,260 @@
+import os
+from unittest import mock
+
+from django.test import TestCase
+from django.test import SimpleTestCase
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+
+from rest_framework.test import APIClient
+
+from core.models import Ticket
+from core.models import Comment
+from core.models import Singleton
+from core.models import GlobalConfig
+
+from core.enums import EmailStatus
+
+from core.services import CommentService
+
+from ai.models import AITemporalComment
+
+from ai.services import AITemporalCommentService
+
+User = get_user_model()
+
+
+class APIQueriesTestCase(TestCase):
+    """
+        The list endpoints run the same number of queries whatever the number of rows: the relations are prefetched,
+        never loaded per row
+    """
+    SIZES = (10, 100, 1000)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com')
+        cls.agent = User.objects.create_user('agent', 'agent@example.com', is_staff=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def seed(self, size: int) -> None:
+        """
+            Add tickets up to `size`, each with an agent assigned, a comment and a proposal on both
+        """
+        tickets = Ticket.objects.bulk_create([
+            Ticket(title=f'Ticket {index}', description='Description', open_by=self.customer)
+            for index in range(Ticket.objects.count(), size)
+        ])
+        Ticket.assigned_to.through.objects.bulk_create([
+            Ticket.assigned_to.through(ticket_id=ticket.id, user_id=self.agent.id) for ticket in tickets
+        ])
+        comments = Comment.objects.bulk_create([
+            Comment(ticket=ticket, content='Comment', created_by=self.customer) for ticket in tickets
+        ])
+        AITemporalComment.objects.bulk_create(
+            [AITemporalComment(ticket=ticket, content='Proposal') for ticket in tickets] +
+            [AITemporalComment(comment=comment, content='Proposal') for comment in comments]
+        )
+
+    def assertListQueries(self, url: str, queries: int) -> None:
+        for size in self.SIZES:
+            with self.subTest(url=url, size=size):
+                self.seed(size)
+                with self.assertNumQueries(queries):
+                    response = self.client.get(url)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['count'], size)
+                self.assertEqual(len(response.data['results']), min(size, 100))
+
+    def test_tickets(self):
+        # COUNT, page, assigned agents
+        self.assertListQueries('/tickets/', 3)
+
+    def test_tickets_with_comments_and_proposals(self):
+        # + comments, proposals of the comments, proposals of the tickets
+        self.assertListQueries('/tickets/?include=comments,ai_proposals', 6)
+
+        response = self.client.get('/tickets/?include=comments,ai_proposals')
+        ticket = response.data['results'][0]
+        self.assertEqual(len(ticket['comments']), 1)
+        self.assertEqual(len(ticket['comments'][0]['ai_proposals']), 1)
+        self.assertEqual(len(ticket['ai_proposals']), 1)
+
+    def test_comments(self):
+        # COUNT, page
+        self.assertListQueries('/comments/', 2)
+
+    def test_comments_with_proposals(self):
+        # + proposals of the comments
+        self.assertListQueries('/comments/?include=ai_proposals', 3)
+
+    def test_unknown_include(self):
+        for url in ('/tickets/?include=comments,history', '/comments/?include=comments'):
+            with self.subTest(url=url):
+                with self.assertNumQueries(0):
+                    response = self.client.get(url)
+
+                self.assertEqual(response.status_code, 400)
+
+
+class CursorPaginationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com')
+        Ticket.objects.bulk_create([
+            Ticket(title=f'Ticket {index}', description='Description', open_by=cls.customer) for index in range(3)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def test_pages(self):
+        response = self.client.get('/tickets/?pagination=cursor&page_size=2')
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(response.data['count'], 3)
+
+    def test_count(self):
+        with mock.patch('core.pagination.approximate_count', return_value=10 ** 6) as approximate_count:
+            response = self.client.get('/tickets/?pagination=cursor')
+            self.assertEqual(response.data['count'], 10 ** 6)
+
+            response = self.client.get('/tickets/?pagination=cursor&count=exact')
+            self.assertEqual(response.data['count'], 3)
+
+        approximate_count.assert_called_once()
+
+    def test_ordering(self):
+        response = self.client.get('/tickets/?pagination=cursor&ordering=title')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['attr'], 'ordering')
+
+
+class PartialSaveQueriesTestCase(TestCase):
+    """
+        The services only write the fields they change: the ticket is not validated again (which reads its assigned
+        agents) nor fully rewritten
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com')
+        cls.agent = User.objects.create_user('agent', 'agent@example.com', is_staff=True)
+        cls.ticket = Ticket.objects.create(title='Ticket', description='Description', open_by=cls.customer,
+                                           is_draft=False)
+        cls.ticket.assigned_to.set([cls.agent])
+        # Cached by the process, like in the long running servers
+        GlobalConfig.load()
+        ContentType.objects.get_for_model(Comment)
+
+    def test_comment_creation(self):
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        # Changed meanwhile by another request, must not be overwritten
+        Ticket.objects.filter(id=ticket.id).update(title='Renamed')
+        service = CommentService()
+
+        # Savepoint, foreign keys checks of the comment, comment insert, ticket last_reply_at update, history insert,
+        # release
+        with self.assertNumQueries(7):
+            comment = service.create({'ticket': ticket, 'content': 'Question', 'created_by': self.customer})
+
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.title, 'Renamed')
+        self.assertIsNotNone(ticket.last_reply_at)
+        self.assertTrue(ticket.histories.filter(related_id=str(comment.id)).exists())
+
+    def test_proposal_validation(self):
+        proposal = AITemporalComment.objects.create(ticket=self.ticket, content='Proposal')
+        AITemporalComment.objects.filter(id=proposal.id).update(cache_similarity=0.5)
+        proposal = AITemporalComment.objects.select_related('ticket').get(id=proposal.id)
+        proposal.cache_similarity = None
+        service = AITemporalCommentService(tmp_comment=proposal)
+
+        # Savepoint, proposal update, foreign keys checks of the comment, comment insert, ticket last_reply_at update,
+        # history insert, comment loaded by the customer notification, release
+        with self.assertNumQueries(9):
+            service.update({'content': 'Answer', 'is_validated': True, 'created_by': self.agent})
+
+        proposal.refresh_from_db()
+        self.assertEqual(proposal.content, 'Answer')
+        self.assertTrue(proposal.is_validated)
+        # Not sent by the client, left untouched
+        self.assertEqual(proposal.cache_similarity, 0.5)
+        self.assertTrue(self.ticket.comments.filter(content='Answer', created_by=self.agent).exists())
+
+
+class SingletonTestCase(TestCase):
+    def setUp(self):
+        # The instances are kept by the process, beyond the rollback of the previous tests
+        Singleton._instances.pop(GlobalConfig, None)
+
+    def test_stale_instance_save(self):
+        config = GlobalConfig.load()
+        stale = GlobalConfig.objects.get(pk=1)
+
+        # Saved by this process, which caches the new version
+        config.generate_ticket_response_with_ai = False
+        config.save()
+
+        # Saved by another process from an instance loaded before, the cache of this process is left as is
+        stale.generate_ticket_response_with_ai = True
+        with mock.patch.object(GlobalConfig, 'set_cache'):
+            stale.save()
+
+        self.assertEqual(stale.version, config.version + 1)
+        with mock.patch.object(GlobalConfig, 'CHECK_INTERVAL', 0):
+            self.assertTrue(GlobalConfig.load().generate_ticket_response_with_ai)
+
+
+class MetricsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = User.objects.create_user('customer', 'customer@example.com')
+        cls.agent = User.objects.create_user('agent', 'agent@example.com', is_staff=True)
+
+    def test_without_token(self):
+        with mock.patch.dict(os.environ, {'METRICS_TOKEN': ''}):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+            self.client.force_login(self.customer)
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+            self.client.force_login(self.agent)
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_with_token(self):
+        with mock.patch.dict(os.environ, {'METRICS_TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class CustomEnumTestCase(SimpleTestCase):
+    def test_lookups(self):
+        self.assertEqual(list(EmailStatus.choices()),
+                         [('FAILED', 'FAILED'), ('PENDING', 'PENDING'), ('SENDING', 'SENDING'), ('SENT', 'SENT')])
+        self.assertEqual(dict(EmailStatus.items())['SENT'], 'SENT')
+        self.assertEqual(EmailStatus.default(), 'FAILED')
+        self.assertEqual(EmailStatus.get('sent').value, 'SENT')
+        self.assertEqual(EmailStatus.key('pending'), 'PENDING')
+        self.assertEqual(EmailStatus.get_name('SENDING'), 'SENDING')
+        self.assertIsNone(EmailStatus.get('unknown'))
+
+    def test_shared_lists_are_immutable(self):
+        with self.assertRaises(AttributeError):
+            EmailStatus.choices().append(('DELETED', 'DELETED'))
+        with self.assertRaises(AttributeError):
+            EmailStatus.items().append(('DELETED', 'DELETED'))
+
+        self.assertEqual(len(EmailStatus.choices()), 4)
+        self.assertEqual(EmailStatus.choices(), EmailStatus.choices())
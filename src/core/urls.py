@@ -4,6 +4,7 @@ from rest_framework.routers import DefaultRouter
 
 from core.views import TicketViewset
 from core.views import CommentViewset
+from core.views import metrics
 
 router = DefaultRouter()
 
@@ -11,5 +12,6 @@ router.register('tickets', TicketViewset, basename='tickets')
 router.register('comments', CommentViewset, basename='comments')
 
 urlpatterns = [
+    path('metrics', metrics, name='metrics'),
     path('', include(router.urls))
 ]
@@ -1,29 +1,34 @@
 from __future__ import annotations
 
-import logging
 from typing import List
 
-from django.conf import settings
-from django.core.mail import send_mail
+STAFF_EMAILS_VERSION = 'staff-emails'
 
-from traceback_with_variables import format_exc
+# Copy of the process: (CacheVersion of the staff emails, emails)
+_staff_emails = (None, [])
 
-logger = logging.getLogger()
 
+def get_staff_emails() -> List[str]:
+    """
+        Emails of the staff users, notified of each AI proposal. Kept in process memory while the version of the
+        staff, bumped by any process which saves or deletes a user, doesn't change.
+    """
+    global _staff_emails
+    from core.models import CacheVersion
+    from django.contrib.auth import get_user_model
 
-def send_simple_mail(to: str | List, subject: str, message: str) -> None:
-    """Send a simple plain text email"""
-    from_email = settings.FROM_EMAIL
-    recipients = to.split(',') if isinstance(to, str) else to
-
-    try:
-        send_mail(
-            subject=subject,
-            message=message,
-            from_email=from_email,
-            recipient_list=recipients,
-            fail_silently=False,
+    version = CacheVersion.get(STAFF_EMAILS_VERSION)
+    cached_version, emails = _staff_emails
+    if cached_version != version:
+        emails = list(
+            get_user_model().objects.filter(is_staff=True).exclude(email='').values_list('email', flat=True)
         )
-    except Exception as e:
-        logger.error(format_exc(e))
-        raise e
+        _staff_emails = (version, emails)
+
+    return emails
+
+
+def invalidate_staff_emails() -> None:
+    from core.models import CacheVersion
+
+    CacheVersion.bump(STAFF_EMAILS_VERSION)
@@ -1,4 +1,16 @@
+import hmac
+
+from django.db.models import Prefetch
+from django.db.models import Subquery
+from django.db.models import OuterRef
+from django.http import HttpResponse
+from django.http import HttpResponseForbidden
+from django.contrib.auth import get_user_model
+
+from decouple import config
+
 from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
 
 from core.models import Ticket
 from core.models import Comment
@@ -6,14 +18,91 @@ from core.models import Comment
 from core.serializers import TicketSerializer
 from core.serializers import CommentSerializer
 
+from core.metrics import registry
+
+from ai.models import AIGenerationJob
+from ai.models import AITemporalComment
+
+User = get_user_model()
+
+
+class IncludeMixin:
+    """
+        Opt-in expansion of the related objects, `?include=comments,ai_proposals`. The requested relations are
+        prefetched by the viewset and given to the serializers through their context.
+    """
+    INCLUDES = ()
+
+    def get_includes(self) -> set:
+        include = {name.strip() for name in self.request.query_params.get('include', '').split(',') if name.strip()}
+        unknown = include - set(self.INCLUDES)
+        if unknown:
+            raise ValidationError({'include': f'Unknown relations {", ".join(sorted(unknown))}, '
+                                              f'available: {", ".join(self.INCLUDES)}'})
+
+        return include
+
+    def get_serializer_context(self):
+        context = super(IncludeMixin, self).get_serializer_context()
+        context['include'] = self.get_includes() if getattr(self, 'request', None) is not None else set()
+
+        return context
 
-class TicketViewset(viewsets.ModelViewSet):
+
+def get_proposals_prefetch() -> Prefetch:
+    return Prefetch('ai_proposals', queryset=AITemporalComment.objects.only(
+        'id', 'ticket', 'comment', 'content', 'created_at', 'app', 'is_validated'
+    ).order_by('created_at'))
+
+
+class TicketViewset(IncludeMixin, viewsets.ModelViewSet):
     serializer_class = TicketSerializer
     http_method_names = ('get', 'post')
     queryset = Ticket.objects.all()
+    cursor_ordering = ('-updated_at', '-id')
+    INCLUDES = ('comments', 'ai_proposals')
+
+    def get_queryset(self):
+        latest_job = AIGenerationJob.objects.filter(ticket=OuterRef('pk')).order_by('-created_at').values('status')[:1]
+        queryset = Ticket.objects.annotate(latest_ai_job_status=Subquery(latest_job)).prefetch_related(
+            Prefetch('assigned_to', queryset=User.objects.only('id'))
+        )
+
+        include = self.get_includes()
+        if 'comments' in include:
+            comments = Comment.objects.only('id', 'ticket', 'content').order_by('created_at')
+            if 'ai_proposals' in include:
+                comments = comments.prefetch_related(get_proposals_prefetch())
+            queryset = queryset.prefetch_related(Prefetch('comments', queryset=comments))
+        if 'ai_proposals' in include:
+            queryset = queryset.prefetch_related(get_proposals_prefetch())
+
+        return queryset
 
 
-class CommentViewset(viewsets.ModelViewSet):
+class CommentViewset(IncludeMixin, viewsets.ModelViewSet):
     serializer_class = CommentSerializer
     http_method_names = ('get', 'post')
-    queryset = Comment.objects.all()
\ No newline at end of file
+    queryset = Comment.objects.all()
+    cursor_ordering = ('-created_at', '-id')
+    INCLUDES = ('ai_proposals',)
+
+    def get_queryset(self):
+        queryset = Comment.objects.only('id', 'ticket', 'content', 'created_at')
+        if 'ai_proposals' in self.get_includes():
+            queryset = queryset.prefetch_related(get_proposals_prefetch())
+
+        return queryset
+
+
+def metrics(request):
+    """
+    Expose the metrics of this process in the Prometheus text format, to the scraper sending the `METRICS_TOKEN` as
+    bearer token, or to a staff user. Without token configured, only the staff users can read them.
+    """
+    token = config('METRICS_TOKEN', default='')
+    has_token = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not has_token and not request.user.is_staff:
+        return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -97,6 +97,34 @@ DATABASES = {
     },
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+GENERATION_CACHE_BACKEND = config('GENERATION_CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache')
+GENERATION_CACHE_MAX_ENTRIES = config('GENERATION_CACHE_MAX_ENTRIES', default=1000, cast=int)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Answers generated by the LLM, see ai.cache.GenerationCache
+    'generation': {
+        'BACKEND': GENERATION_CACHE_BACKEND,
+        'LOCATION': config('GENERATION_CACHE_LOCATION', default='generation'),
+        # Only understood by the Django backends, Redis and Memcached pass the options to their client and bound
+        # their size themselves
+        'OPTIONS': {
+            'MAX_ENTRIES': GENERATION_CACHE_MAX_ENTRIES,
+            # Evict only the least recently used entry when the cache is full
+            'CULL_FREQUENCY': GENERATION_CACHE_MAX_ENTRIES,
+        } if GENERATION_CACHE_BACKEND in (
+            'django.core.cache.backends.locmem.LocMemCache',
+            'django.core.cache.backends.db.DatabaseCache',
+            'django.core.cache.backends.filebased.FileBasedCache',
+        ) else {},
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 